@@ -0,0 +1,220 @@
+"""Инкрементальные резервные копии каталога data.
+
+Файлы режутся на куски по CHUNK_SIZE, каждый кусок хранится один раз
+(имя = sha256 содержимого, сжатие zlib) в backups/chunks. Снимок — это JSON
+со списком файлов и их кусков в backups/snapshots. Неизменённые файлы
+(тот же размер и mtime, что в прошлом снимке) даже не перечитываются.
+
+Используется сервером (фоновое расписание, действия backup_*) и GUI, когда
+сервер не запущен. Запуск вручную:
+    python backup_engine.py snapshot
+    python backup_engine.py list
+    python backup_engine.py restore <снимок> maps/map_1.json
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from contextlib import nullcontext
+from datetime import datetime
+
+CHUNK_SIZE = 1024 * 1024
+READ_RETRIES = 5
+# служебные файлы SQLite и незавершённые записи; сама база копируется после сброса WAL
+SKIP_SUFFIXES = ("-wal", "-shm", "-journal", ".tmp", ".part")
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupEngine:
+    def __init__(self, data_dir, backup_dir):
+        self.data_dir = data_dir
+        self.backup_dir = backup_dir
+        self.chunks_dir = os.path.join(backup_dir, "chunks")
+        self.snapshots_dir = os.path.join(backup_dir, "snapshots")
+
+    # === КУСКИ ===
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def _store_chunk(self, chunk):
+        """True — кусок новый и записан на диск"""
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(chunk, 6))
+        os.replace(tmp, path)
+        return digest, True
+
+    def _load_chunk(self, digest):
+        with open(self._chunk_path(digest), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise BackupError(f"Повреждён кусок {digest}")
+        return chunk
+
+    # === СНИМКИ ===
+    def list_snapshots(self):
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.snapshots_dir) if name.endswith(".json"))
+
+    def load_manifest(self, name):
+        # имя приходит от клиента (backup_restore): только снимки из списка, без выхода из каталога
+        if not isinstance(name, str) or "/" in name or "\\" in name or ".." in name \
+                or name not in self.list_snapshots():
+            raise BackupError(f"Снимок {name} не найден")
+        path = os.path.join(self.snapshots_dir, f"{name}.json")
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def checkpoint_wal(self):
+        """Без сервера: переносит -wal в сами базы SQLite в data, иначе снимок возьмёт базы без последних записей.
+        При работающем сервере это делает он сам (SqliteStore.frozen)"""
+        for root, _, filenames in os.walk(self.data_dir):
+            for filename in filenames:
+                db_path = os.path.join(root, filename[:-4])
+                if filename.endswith("-wal") and os.path.exists(db_path):
+                    conn = sqlite3.connect(db_path, timeout=30)
+                    try:
+                        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                    finally:
+                        conn.close()
+                    if busy:
+                        raise BackupError(f"База занята, WAL не перенесён: {db_path}")
+
+    def _read_stable(self, path):
+        """Читает файл по кускам; если он изменился во время чтения — повторяет"""
+        for _ in range(READ_RETRIES):
+            before = os.stat(path)
+            chunks = []
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    chunks.append(chunk)
+            after = os.stat(path)
+            if (before.st_mtime_ns, before.st_size) == (after.st_mtime_ns, after.st_size) \
+                    and sum(map(len, chunks)) == after.st_size:
+                return after, chunks
+        raise BackupError(f"Файл постоянно меняется: {path}")
+
+    def snapshot(self, guard=None, progress=None):
+        """Создаёт снимок и возвращает сводку.
+
+        guard(path) — контекстный менеджер на время чтения файла (сервер
+        передаёт path_lock файла и дожидается текущей записи из очереди).
+        """
+        guard = guard or (lambda path: nullcontext())
+        previous = {}
+        names = self.list_snapshots()
+        if names:
+            previous = self.load_manifest(names[-1]).get("files", {})
+
+        files = {}
+        stats = {"files": 0, "reused": 0, "new_chunks": 0, "new_bytes": 0, "bytes": 0}
+        for root, dirs, filenames in os.walk(self.data_dir):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(SKIP_SUFFIXES):
+                    continue
+                path = os.path.join(root, filename)
+                rel = os.path.relpath(path, self.data_dir).replace(os.sep, "/")
+                try:
+                    st = os.stat(path)
+                    old = previous.get(rel)
+                    if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                        files[rel] = old
+                        stats["reused"] += 1
+                    else:
+                        with guard(path):
+                            st, chunks = self._read_stable(path)
+                        digests = []
+                        for chunk in chunks:
+                            digest, new = self._store_chunk(chunk)
+                            digests.append(digest)
+                            if new:
+                                stats["new_chunks"] += 1
+                                stats["new_bytes"] += len(chunk)
+                        files[rel] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "chunks": digests}
+                except FileNotFoundError:
+                    continue  # удалён во время обхода
+                stats["files"] += 1
+                stats["bytes"] += files[rel]["size"]
+                if progress:
+                    progress(rel)
+
+        name = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if name in names:
+            name += f"_{len(names)}"
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        manifest = {"name": name, "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "files": files, "stats": stats}
+        tmp = os.path.join(self.snapshots_dir, f"{name}.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.snapshots_dir, f"{name}.json"))
+        stats["name"] = name
+        return stats
+
+    # === ХРАНЕНИЕ ===
+    def prune(self, keep):
+        """Оставляет keep последних снимков и удаляет куски, на которые никто не ссылается"""
+        names = self.list_snapshots()
+        removed = names[:-keep] if keep > 0 else []
+        for name in removed:
+            os.remove(os.path.join(self.snapshots_dir, f"{name}.json"))
+        if not removed:
+            return {"snapshots": 0, "chunks": 0}
+        used = set()
+        for name in self.list_snapshots():
+            for entry in self.load_manifest(name)["files"].values():
+                used.update(entry["chunks"])
+        freed = 0
+        for root, _, filenames in os.walk(self.chunks_dir):
+            for filename in filenames:
+                if filename not in used:
+                    os.remove(os.path.join(root, filename))
+                    freed += 1
+        return {"snapshots": len(removed), "chunks": freed}
+
+    # === ВОССТАНОВЛЕНИЕ ===
+    def restore_file(self, name, rel_path, target=None):
+        """Восстанавливает один файл снимка (по умолчанию на его место в data)"""
+        rel_path = rel_path.replace("\\", "/").lstrip("/")
+        entry = self.load_manifest(name)["files"].get(rel_path)
+        if entry is None:
+            raise BackupError(f"В снимке {name} нет файла {rel_path}")
+        target = target or os.path.join(self.data_dir, *rel_path.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = target + ".restore"
+        with open(tmp, "wb") as f:
+            for digest in entry["chunks"]:
+                f.write(self._load_chunk(digest))
+        os.replace(tmp, target)
+        return entry["size"]
+
+    def restore_all(self, name, target_dir):
+        for rel_path in self.load_manifest(name)["files"]:
+            self.restore_file(name, rel_path, os.path.join(target_dir, *rel_path.split("/")))
+
+
+if __name__ == "__main__":
+    base = os.path.dirname(os.path.abspath(__file__))
+    engine = BackupEngine(os.path.join(base, "data"), os.path.join(base, "backups"))
+    command = sys.argv[1] if len(sys.argv) > 1 else "snapshot"
+    if command == "snapshot":
+        engine.checkpoint_wal()
+        print(engine.snapshot())
+    elif command == "list":
+        print("\n".join(engine.list_snapshots()))
+    elif command == "restore" and len(sys.argv) == 4:
+        print(f"{sys.argv[3]}: {engine.restore_file(sys.argv[2], sys.argv[3])} байт")
+    else:
+        print(__doc__)
@@ -0,0 +1,110 @@
+"""Проверка, что дисковый ввод-вывод не блокирует event loop.
+
+Пока несколько клиентов непрерывно сохраняют большие карты через file_put,
+отдельный клиент засекает задержку мелких запросов (list_maps, list_groups)
+и печатает p50/p99/max.
+
+Запуск: python benchmark_io.py [--writers 4] [--switches 20000] [--seconds 10]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import websockets
+
+import server_ws
+
+
+def make_map(switches):
+    return {
+        "map": {"name": "benchmark"},
+        "switches": [
+            {"id": f"{{BENCH-{i}}}", "name": f"SW-{i}", "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+             "xy": {"x": i % 1900, "y": i % 1000}, "pingok": bool(i % 2),
+             "ports": [{"number": str(p), "description": "абонент"} for p in range(1, 9)]}
+            for i in range(switches)
+        ],
+    }
+
+
+async def writer(url, path, message, deadline):
+    async with websockets.connect(url, max_size=None) as ws:
+        n = 0
+        while time.monotonic() < deadline:
+            await ws.send(message)
+            await ws.recv()
+            n += 1
+        return n
+
+
+async def prober(url, deadline):
+    latencies = []
+    async with websockets.connect(url, max_size=None) as ws:
+        n = 0
+        while time.monotonic() < deadline:
+            action = ("list_maps", "list_groups")[n % 2]
+            start = time.perf_counter()
+            await ws.send(json.dumps({"action": action, "request_id": n}))
+            await ws.recv()
+            latencies.append((time.perf_counter() - start) * 1000)
+            n += 1
+            await asyncio.sleep(0.005)
+    return latencies
+
+
+def run_writers(url, paths, switches, seconds):
+    # клиенты живут в отдельном процессе, чтобы их собственная работа не мешала замерам сервера
+    payload = make_map(switches)
+
+    async def run():
+        deadline = time.monotonic() + seconds
+        messages = [json.dumps({"action": "file_put", "path": path, "data": payload, "request_id": path},
+                               ensure_ascii=False) for path in paths]
+        counts = await asyncio.gather(*(writer(url, path, msg, deadline) for path, msg in zip(paths, messages)))
+        return sum(counts), len(messages[0])
+
+    return asyncio.run(run())
+
+
+def run_prober(url, seconds):
+    return asyncio.run(prober(url, time.monotonic() + seconds))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def main(args):
+    server_ws.CONFIG["auth_required"] = False  # замеряется ввод-вывод, а не вход операторов
+    paths = [f"maps/_benchmark_{os.getpid()}_{i}.json" for i in range(args.writers)]
+    loop = asyncio.get_running_loop()
+    async with websockets.serve(server_ws.handler, "127.0.0.1", 0, max_size=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}"
+        try:
+            with ProcessPoolExecutor(max_workers=2) as pool:
+                writes = loop.run_in_executor(pool, run_writers, url, paths, args.switches, args.seconds)
+                probe = loop.run_in_executor(pool, run_prober, url, args.seconds)
+                (writes, size), latencies = await asyncio.gather(writes, probe)
+        finally:
+            for path in paths:
+                try:
+                    os.remove(server_ws.get_full_path(path))
+                except OSError:
+                    pass
+
+    print(f"map size: {size / 1024 / 1024:.1f} MB, writers: {args.writers}, file_put done: {writes}")
+    print(f"small requests: {len(latencies)}  p50 {percentile(latencies, 50):.1f} ms  "
+          f"p99 {percentile(latencies, 99):.1f} ms  max {max(latencies):.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--switches", type=int, default=20000)
+    parser.add_argument("--seconds", type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
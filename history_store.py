@@ -0,0 +1,463 @@
+"""История проверок устройств: доступность, RTT и аварии за период.
+
+- в памяти: на устройство кольцевой буфер последних проверок (array), record()
+  вызывается из event loop и не трогает диск;
+- на диске (history/): raw/<ip>.ring — последние RAW_CAPACITY проверок,
+  5m/<ip>.ring и 1h/<ip>.ring — свёртки по 5 минут и по часу. Каждый файл —
+  кольцо записей фиксированного размера: растёт до своей ёмкости, дальше
+  перезаписывает самое старое, так что место на диске ограничено. Читается
+  через mmap, нужный период находится двоичным поиском по времени;
+- flush() переносит накопленное в памяти на диск и обновляет свёртки
+  (сервер вызывает его в пуле ввода-вывода раз в history_flush_interval);
+- summary() — доступность %, RTT (среднее, p50/p95/p99, максимум) и интервалы
+  аварий. Период, который ещё покрывают сырые проверки, считается по ним,
+  более длинный — по свёртке 5m или 1h.
+
+Доступность считается по времени, а не по числу проверок: состояние действует
+от проверки до следующей (но не дольше MAX_GAP). Сканер проверяет недоступные
+устройства чаще доступных, и подсчёт по проверкам занижал бы процент.
+
+Просмотр вручную:
+    python history_store.py 10.0.0.1 [часов]
+"""
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+
+UP, DOWN, UNREACHABLE = 1, 0, 2
+RAW = struct.Struct("<Ifb")  # время, RTT мс (NaN — нет ответа), статус
+# начало интервала, секунд наблюдения, из них доступно, проверок, сумма RTT, максимум RTT, гистограмма RTT
+ROLLUP = struct.Struct("<IHHHff8H")
+HEADER = struct.Struct("<4sIII")  # метка, ёмкость (записей), следующая позиция, записей
+MAGIC = b"PHR1"
+RTT_EDGES = (1, 2, 5, 10, 20, 50, 100)  # границы корзин гистограммы, мс; последняя — «больше 100»
+RAW_CAPACITY = 8192
+TIERS = (("5m", 300, 4032), ("1h", 3600, 4392))  # имя, ширина (с), ёмкость: 14 дней и ~полгода
+MAX_GAP = 3600  # дольше без проверок — состояние неизвестно
+MAX_OUTAGES = 200
+LOCK_STRIPES = 64
+
+
+def file_name(ip):
+    return re.sub(r"[^0-9A-Za-z._-]", "_", ip) + ".ring"
+
+
+def rtt_bin(rtt):
+    for i, edge in enumerate(RTT_EDGES):
+        if rtt < edge:
+            return i
+    return len(RTT_EDGES)
+
+
+class RingFile:
+    """Файл-кольцо записей одного формата, логически от старых к новым"""
+
+    def __init__(self, path, record, capacity):
+        self.path = path
+        self.record = record
+        self.capacity = capacity
+
+    def append(self, records, replace_last=False):
+        """replace_last — первая запись заменяет последнюю в файле (ещё не закрытый интервал свёртки)"""
+        if not records:
+            return
+        size = self.record.size
+        try:
+            f = open(self.path, "r+b")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            f = open(self.path, "w+b")
+            f.write(HEADER.pack(MAGIC, self.capacity, 0, 0))
+        with f:
+            f.seek(0)
+            _, capacity, head, count = HEADER.unpack(f.read(HEADER.size))
+            if replace_last and count:
+                head = (head - 1) % capacity
+                count -= 1
+            data = b"".join(self.record.pack(*r) for r in records[-capacity:])
+            written = min(len(records), capacity)
+            pos = 0
+            while pos < len(data):
+                # подряд до конца кольца, остаток — с начала
+                part = data[pos:pos + (capacity - head) * size]
+                f.seek(HEADER.size + head * size)
+                f.write(part)
+                head = (head + len(part) // size) % capacity
+                pos += len(part)
+            count = min(count + written, capacity)
+            # заголовок — последним: при сбое посередине новые записи просто не видны
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, capacity, head, count))
+
+    def read(self, start=0, end=0xFFFFFFFF):
+        """Записи со временем (первое поле) в [start, end]"""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return []
+            magic, capacity, head, count = HEADER.unpack(header)
+            if magic != MAGIC or not count:
+                return []
+            size = self.record.size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                first = (head - count) % capacity
+
+                def offset(i):
+                    return HEADER.size + (first + i) % capacity * size
+
+                def first_at_or_after(t):
+                    lo, hi = 0, count
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if struct.unpack_from("<I", mm, offset(mid))[0] < t:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    return lo
+
+                lo = first_at_or_after(start)
+                hi = first_at_or_after(end + 1) if end < 0xFFFFFFFF else count
+                chunks = []
+                i = lo
+                while i < hi:
+                    # участок без перехода через конец кольца
+                    n = min(hi - i, capacity - (first + i) % capacity)
+                    chunks.append(mm[offset(i):offset(i) + n * size])
+                    i += n
+        return list(self.record.iter_unpack(b"".join(chunks)))
+
+    def last(self):
+        try:
+            with open(self.path, "rb") as f:
+                magic, capacity, head, count = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or not count:
+                    return None
+                f.seek(HEADER.size + (head - 1) % capacity * self.record.size)
+                return self.record.unpack(f.read(self.record.size))
+        except (FileNotFoundError, struct.error):
+            return None
+
+    def covers_from(self):
+        """С какого времени в файле полная история: 0 — кольцо ещё не переполнялось, None — файла нет"""
+        try:
+            with open(self.path, "rb") as f:
+                magic, capacity, head, count = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC:
+                    return None
+                if count < capacity:
+                    return 0
+                f.seek(HEADER.size + head * self.record.size)
+                return struct.unpack("<I", f.read(4))[0]
+        except (FileNotFoundError, struct.error):
+            return None
+
+
+class DeviceHistory:
+    """Последние проверки устройства в памяти; pending — сколько из них ещё не на диске"""
+    __slots__ = ("ts", "rtt", "status", "head", "count", "pending")
+
+    def __init__(self, capacity):
+        self.ts = array("I", [0]) * capacity
+        self.rtt = array("f", [0.0]) * capacity
+        self.status = array("b", [0]) * capacity
+        self.head = 0
+        self.count = 0
+        self.pending = 0
+
+    def add(self, ts, rtt, status):
+        capacity = len(self.ts)
+        self.ts[self.head], self.rtt[self.head], self.status[self.head] = ts, rtt, status
+        self.head = (self.head + 1) % capacity
+        self.count = min(self.count + 1, capacity)
+        self.pending += 1
+
+    def recent(self, n):
+        capacity = len(self.ts)
+        n = min(n, self.count)
+        return [(self.ts[i], self.rtt[i], self.status[i])
+                for i in ((self.head - n + k) % capacity for k in range(n))]
+
+
+class Bucket:
+    """Открытый интервал свёртки"""
+    __slots__ = ("start", "total", "up", "count", "rtt_sum", "rtt_max", "hist", "stored")
+
+    def __init__(self, start, record=None):
+        self.start = start
+        self.stored = record is not None  # уже лежит последней записью в файле
+        if record:
+            _, self.total, self.up, self.count, self.rtt_sum, self.rtt_max, *hist = record
+            self.hist = list(hist)
+        else:
+            self.total = self.up = self.count = 0
+            self.rtt_sum = self.rtt_max = 0.0
+            self.hist = [0] * (len(RTT_EDGES) + 1)
+
+    def pack(self):
+        return (self.start, self.total, self.up, self.count, self.rtt_sum, self.rtt_max, *self.hist)
+
+
+class Rollup:
+    """Свёртка одного устройства одного уровня: копит интервалы и закрывает их по времени"""
+
+    def __init__(self, ring, width):
+        self.ring = ring
+        self.width = width
+        self.bucket = None
+        self.closed = []
+
+    def _at(self, t):
+        start = t - t % self.width
+        if self.bucket is None:
+            last = self.ring.last()
+            self.bucket = Bucket(start, last if last and last[0] == start else None)
+        if start > self.bucket.start:
+            self.closed.append(self.bucket)
+            self.bucket = Bucket(start)
+        return self.bucket if start == self.bucket.start else None  # часы ушли назад — пропускаем
+
+    def span(self, t0, t1, up):
+        while t0 < t1:
+            bucket = self._at(t0)
+            end = min(t1, t0 - t0 % self.width + self.width)
+            if bucket:
+                bucket.total += end - t0
+                if up:
+                    bucket.up += end - t0
+            t0 = end
+
+    def sample(self, ts, rtt, status):
+        bucket = self._at(ts)
+        if bucket is None:
+            return
+        bucket.count = min(bucket.count + 1, 0xFFFF)
+        if status == UP and not math.isnan(rtt):
+            bucket.rtt_sum += rtt
+            bucket.rtt_max = max(bucket.rtt_max, rtt)
+            b = rtt_bin(rtt)
+            bucket.hist[b] = min(bucket.hist[b] + 1, 0xFFFF)
+
+    def store(self):
+        if self.bucket is None:
+            return
+        pending = self.closed + [self.bucket]
+        self.ring.append([b.pack() for b in pending], replace_last=pending[0].stored)
+        self.closed = []
+        self.bucket.stored = True
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+
+
+def hist_percentile(hist, rtt_max, p):
+    """Оценка перцентиля по гистограмме: линейно внутри корзины"""
+    total = sum(hist)
+    if not total:
+        return None
+    target = total * p / 100
+    edges = (0,) + RTT_EDGES + (max(rtt_max, RTT_EDGES[-1]),)
+    seen = 0
+    for i, n in enumerate(hist):
+        if n and seen + n >= target:
+            lo, hi = edges[i], min(edges[i + 1], rtt_max) if rtt_max else edges[i + 1]
+            return round(lo + (hi - lo) * (target - seen) / n, 2)
+        seen += n
+    return round(rtt_max, 2)
+
+
+class HistoryStore:
+    def __init__(self, history_dir, memory_samples=128):
+        self.history_dir = history_dir
+        self.memory_samples = memory_samples
+        self.devices = {}  # ip -> DeviceHistory
+        self.rollups = {}  # ip -> [Rollup по уровням TIERS]
+        self.last = {}     # ip -> последняя проверка на диске (время, статус)
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.dropped = 0
+
+    def _lock(self, ip):
+        return self.locks[hash(ip) % LOCK_STRIPES]
+
+    def raw(self, ip):
+        return RingFile(os.path.join(self.history_dir, "raw", file_name(ip)), RAW, RAW_CAPACITY)
+
+    def tier(self, ip, name, capacity):
+        return RingFile(os.path.join(self.history_dir, name, file_name(ip)), ROLLUP, capacity)
+
+    # === ЗАПИСЬ (event loop) ===
+    def record(self, ip, ts, rtt_ms, status):
+        device = self.devices.get(ip)
+        if device is None:
+            device = self.devices[ip] = DeviceHistory(self.memory_samples)
+        device.add(int(ts), math.nan if rtt_ms is None else rtt_ms, status)
+
+    def take_pending(self):
+        """Снимает ещё не записанные проверки: {ip: [(время, rtt, статус)]}"""
+        batch = {}
+        for ip, device in self.devices.items():
+            if device.pending:
+                if device.pending > device.count:
+                    self.dropped += device.pending - device.count  # диск не успевал — старые потеряны
+                batch[ip] = device.recent(device.pending)
+                device.pending = 0
+        return batch
+
+    def recent(self, ip):
+        device = self.devices.get(ip)
+        return device.recent(device.count) if device else []
+
+    # === ЗАПИСЬ НА ДИСК (пул ввода-вывода) ===
+    def flush(self, batch):
+        """Пишет пачку из take_pending(); возвращает {ip: исключение} для неудавшихся"""
+        errors = {}
+        for ip, samples in batch.items():
+            try:
+                with self._lock(ip):
+                    self._flush_device(ip, samples)
+            except Exception as e:
+                errors[ip] = e
+        return errors
+
+    def _flush_device(self, ip, samples):
+        raw = self.raw(ip)
+        previous = self.last.get(ip)
+        if previous is None:
+            last = raw.last()  # после перезапуска: последняя проверка, записанная прошлым процессом
+            previous = (last[0], last[2]) if last else None
+        raw.append(samples)
+        rollups = self.rollups.get(ip)
+        if rollups is None:
+            rollups = self.rollups[ip] = [Rollup(self.tier(ip, name, capacity), width)
+                                          for name, width, capacity in TIERS]
+        for ts, rtt, status in samples:
+            for rollup in rollups:
+                if previous and 0 < ts - previous[0] <= MAX_GAP:
+                    rollup.span(previous[0], ts, previous[1] == UP)
+                rollup.sample(ts, rtt, status)
+            previous = (ts, status)
+        self.last[ip] = previous
+        for rollup in rollups:
+            rollup.store()
+
+    # === ЗАПРОСЫ (пул ввода-вывода) ===
+    def summary(self, ip, start, end, recent=(), outages=True):
+        """Сводка по устройству за [start, end]; recent — проверки из памяти, ещё не записанные на диск"""
+        with self._lock(ip):
+            raw = self.raw(ip)
+            covers = raw.covers_from()
+            if covers is None or covers <= start:
+                stored = raw.read(max(0, start - MAX_GAP), end)
+                return self._from_samples(ip, start, end, stored, recent, outages)
+            # сырые проверки уже перезаписаны — самая подробная свёртка, покрывающая период
+            for name, width, capacity in TIERS:
+                tier = self.tier(ip, name, capacity)
+                covers = tier.covers_from()
+                if covers is not None and covers <= start or name == TIERS[-1][0]:
+                    return self._from_rollup(ip, start, end, name, width, tier.read(start - start % width, end),
+                                             outages)
+
+    @staticmethod
+    def _from_samples(ip, start, end, stored, recent, outages):
+        last_stored = stored[-1][0] if stored else -1
+        samples = stored + [s for s in recent if max(last_stored, start - MAX_GAP - 1) < s[0] <= end]
+        now = int(time.time())
+        total = up = 0
+        rtts = []
+        intervals = []
+        outage = None
+        for i, (ts, rtt, status) in enumerate(samples):
+            nxt = samples[i + 1][0] if i + 1 < len(samples) else min(end, now)
+            if nxt - ts <= MAX_GAP:
+                t0, t1 = max(ts, start), min(nxt, end)
+                if t1 > t0:
+                    total += t1 - t0
+                    if status == UP:
+                        up += t1 - t0
+            if ts < start:
+                # состояние на начало периода
+                outage = {"start": start, "end": None, "unreachable": status == UNREACHABLE} if status != UP else None
+                continue
+            if status == UP:
+                if not math.isnan(rtt):
+                    rtts.append(rtt)
+                if outage:
+                    outage["end"] = ts
+                    intervals.append(outage)
+                    outage = None
+            elif outage is None:
+                outage = {"start": ts, "end": None, "unreachable": status == UNREACHABLE}
+            elif status != UNREACHABLE:
+                outage["unreachable"] = False  # хотя бы раз пинговалось само — не только из-за вышестоящего
+        if outage:
+            intervals.append(outage)
+        rtts.sort()
+        result = {
+            "ip": ip, "from": start, "to": end, "resolution": "raw",
+            "samples": sum(1 for s in samples if s[0] >= start),
+            "observed_s": total, "down_s": total - up,
+            "availability": round(100 * up / total, 3) if total else None,
+            "rtt": {"avg": round(sum(rtts) / len(rtts), 2) if rtts else None,
+                    "p50": percentile(rtts, 50), "p95": percentile(rtts, 95), "p99": percentile(rtts, 99),
+                    "max": round(rtts[-1], 2) if rtts else None},
+            "outages_total": len(intervals),
+        }
+        if outages:
+            result["outages"] = [dict(o, duration_s=(o["end"] or min(end, now)) - o["start"])
+                                 for o in intervals[-MAX_OUTAGES:]]
+        return result
+
+    @staticmethod
+    def _from_rollup(ip, start, end, name, width, records, outages):
+        total = up = count = 0
+        rtt_sum, rtt_max = 0.0, 0.0
+        hist = [0] * (len(RTT_EDGES) + 1)
+        intervals = []
+        for b_start, b_total, b_up, b_count, b_sum, b_max, *b_hist in records:
+            total += b_total
+            up += b_up
+            count += b_count
+            rtt_sum += b_sum
+            rtt_max = max(rtt_max, b_max)
+            hist = [a + b for a, b in zip(hist, b_hist)]
+            if b_up < b_total:
+                # с точностью до интервала свёртки: соседние интервалы с простоем — одна авария
+                if intervals and intervals[-1]["end"] == b_start:
+                    intervals[-1]["end"] = b_start + width
+                    intervals[-1]["down_s"] += b_total - b_up
+                else:
+                    intervals.append({"start": b_start, "end": b_start + width, "down_s": b_total - b_up})
+        answered = sum(hist)
+        result = {
+            "ip": ip, "from": start, "to": end, "resolution": name,
+            "samples": count, "observed_s": total, "down_s": total - up,
+            "availability": round(100 * up / total, 3) if total else None,
+            "rtt": {"avg": round(rtt_sum / answered, 2) if answered else None,
+                    "p50": hist_percentile(hist, rtt_max, 50), "p95": hist_percentile(hist, rtt_max, 95),
+                    "p99": hist_percentile(hist, rtt_max, 99), "max": round(rtt_max, 2) if answered else None},
+            "outages_total": len(intervals),
+        }
+        if outages:
+            result["outages"] = intervals[-MAX_OUTAGES:]
+        return result
+
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    base = os.path.dirname(os.path.abspath(__file__))
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+    now = int(time.time())
+    print(HistoryStore(os.path.join(base, "history")).summary(sys.argv[1], now - int(hours * 3600), now))
+elif __name__ == "__main__":
+    print(__doc__)
@@ -1,98 +1,68 @@
 import sys
 import json
-import os
+import queue
 import subprocess
-import zipfile
-import threading
-import time
-import glob
 from datetime import datetime
+from websockets.sync.client import connect
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QLabel, QSpinBox, QTextEdit, QMessageBox
+    QPushButton, QLabel, QSpinBox, QTextEdit, QMessageBox, QTabWidget,
+    QTableWidget, QTableWidgetItem, QHeaderView
 )
 from PyQt6.QtCore import QTimer, QThread, pyqtSignal, Qt
 
+from backup_engine import BackupEngine
+
 
 # ========================================
-# 1. ПИНГ-РАБОТНИК (фоновый цикл)
+# 1. УПРАВЛЕНИЕ СЕРВЕРОМ (сканер живёт в server_ws.py)
 # ========================================
-class PingWorker(threading.Thread):
-    def __init__(self, gui, interval=30):
-        super().__init__(daemon=True)
-        self.gui = gui
-        self.interval = interval
-        self.stop_event = threading.Event()
-
-    def log(self, msg):
-        line = f"[{datetime.now().strftime('%H:%M:%S')}] {msg}"
-        self.gui.log_signal.emit(line)
+class ServerControl(QThread):
+    """Запросы к локальному серверу: настройки и статус фонового сканера, статистика.
 
-    def status(self, msg):
-        self.gui.status_signal.emit(msg)
+    Запросы уходят из потока ServerControl по одному соединению, открытому между
+    ними, — GUI не ждёт сеть: ответ приходит сигналом reply(action, ответ),
+    ошибка — failed(action, текст).
+    """
+    reply = pyqtSignal(str, dict)
+    failed = pyqtSignal(str, str)
 
-    def ping_ip(self, ip):
-        try:
-            cfg = self.gui.get_config()
-            cmd = [
-                'ping', '-n', str(cfg['packet_count']),
-                '-w', str(cfg['ping_timeout_ms']), ip
-            ]
-            out = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
-                                          timeout=cfg['ping_timeout_ms'] / 1000 + 2,
-                                          universal_newlines=True)
-            return "TTL=" in out
-        except Exception:
-            return False
-
-    def update_map(self, path):
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except Exception as e:
-            self.log(f"Ошибка чтения {path}: {e}")
-            return
+    def __init__(self, url="ws://127.0.0.1:8081"):
+        super().__init__()
+        self.url = url
+        self.queue = queue.Queue()
+        self.pending = set()  # действия в очереди: опрос по таймеру не копится, пока сервер занят
 
-        ips = {}
-        for typ in ("switches", "plan_switches"):
-            for dev in data.get(typ, []):
-                ip = dev.get("ip")
-                if ip and ip != "—":
-                    ips[ip] = (typ, dev)
-
-        for ip, (typ, dev) in ips.items():
-            if self.stop_event.is_set():
-                return
-            self.status(f"Ping: {ip}")
-            ok = self.ping_ip(ip)
-            dev["pingok"] = ok
-            self.status(f"Ping: {ip} – {'OK' if ok else 'FAIL'}")
-            self.log(f"Ping {ip} → {'OK' if ok else 'FAIL'}")
+    def post(self, action, **fields):
+        """Запрос без ожидания: уходит из потока ServerControl, ответ — сигналом"""
+        self.pending.add(action)
+        self.queue.put((action, fields))
 
-        try:
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            self.log(f"Ошибка записи {path}: {e}")
+    def stop(self):
+        self.queue.put(None)
+        self.wait(3000)
 
     def run(self):
-        while not self.stop_event.is_set():
-            start = time.time()
-            maps = glob.glob("data/maps/*.json")
-            self.log(f"Найдено карт: {len(maps)}")
-            for m in maps:
-                if self.stop_event.is_set():
-                    break
-                self.update_map(m)
-            elapsed = time.time() - start
-            sleep_time = max(0, self.interval - elapsed)
-            self.log(f"Цикл завершён за {elapsed:.1f}с, спим {sleep_time:.1f}с")
-            self.status("Idle")
-            self.stop_event.wait(sleep_time)
-
-    def stop(self):
-        self.stop_event.set()
-        self.log("PingWorker остановлен")
+        ws = None
+        while (item := self.queue.get()) is not None:
+            action, fields = item
+            try:
+                if ws is None:
+                    ws = connect(self.url, open_timeout=2, close_timeout=1)
+                ws.send(json.dumps({"action": action, "request_id": action, **fields}))
+                while (response := json.loads(ws.recv(timeout=5))).get("request_id") != action:
+                    pass
+                self.reply.emit(action, response)
+            except Exception as e:
+                # сервер перезапущен или ещё не поднялся — переподключимся на следующем запросе
+                if ws is not None:
+                    ws.close()
+                    ws = None
+                self.failed.emit(action, str(e))
+            finally:
+                self.pending.discard(action)
+        if ws is not None:
+            ws.close()
 
 
 # ========================================
@@ -114,18 +84,51 @@ class ServerThread(QThread):
 
 
 # ========================================
-# 3. ОСНОВНОЙ GUI
+# 3. BACKUP БЕЗ СЕРВЕРА
+# ========================================
+class BackupThread(QThread):
+    """Снимок data, когда сервер не запущен (иначе снимок делает сам сервер)"""
+    finished_backup = pyqtSignal(dict)
+
+    def run(self):
+        try:
+            engine = BackupEngine('data', 'backups')
+            engine.checkpoint_wal()
+            stats = engine.snapshot()
+            stats['pruned'] = engine.prune(self.keep)
+        except Exception as e:
+            stats = {'error': str(e)}
+        self.finished_backup.emit(stats)
+
+
+# ========================================
+# 4. ОСНОВНОЙ GUI
 # ========================================
 class ServerGUI(QMainWindow):
     log_signal = pyqtSignal(str)
     status_signal = pyqtSignal(str)
 
+    # колонки вкладки «Статистика»: заголовок, поле из server_stats
+    STATS_COLUMNS = [
+        ("Действие", None), ("Запросов", "count"), ("Ошибок, %", "error_rate"), ("p50, мс", "p50_ms"),
+        ("p95, мс", "p95_ms"), ("p99, мс", "p99_ms"), ("max, мс", "max_ms"),
+        ("Вход, Б", "avg_bytes_in"), ("Выход, Б", "avg_bytes_out"),
+    ]
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("NMS Server")
         self.setFixedSize(800, 600)
         self.process = None
-        self.ping_worker = None
+        self.control = ServerControl()
+        self.control.reply.connect(self.on_control_reply)
+        self.control.failed.connect(self.on_control_failed)
+        self.control.start()
+        self.backup_thread = None
+        self.scanner_timer = QTimer()
+        self.scanner_timer.timeout.connect(self.poll_scanner)
+        self.stats_timer = QTimer()
+        self.stats_timer.timeout.connect(self.poll_stats)
         self.shutdown_timer = QTimer()
         self.shutdown_timer.setSingleShot(True)
         self.shutdown_timer.timeout.connect(self.final_shutdown)
@@ -197,6 +200,19 @@ class ServerGUI(QMainWindow):
         scan_layout.addStretch()
         ping_settings_layout.addLayout(scan_layout)
 
+        # Параллельных пингов
+        concurrency_layout = QHBoxLayout()
+        concurrency_layout.addWidget(QLabel("Параллельных пингов:"))
+        self.spin_concurrency = QSpinBox()
+        self.spin_concurrency.setFixedSize(100, 30)
+        self.spin_concurrency.setRange(1, 512)
+        self.spin_concurrency.setValue(64)
+        self.spin_concurrency.valueChanged.connect(self.save_config)
+        self.spin_concurrency.setAlignment(Qt.AlignmentFlag.AlignRight)
+        concurrency_layout.addWidget(self.spin_concurrency, alignment=Qt.AlignmentFlag.AlignLeft)
+        concurrency_layout.addStretch()
+        ping_settings_layout.addLayout(concurrency_layout)
+
         layout.addLayout(ping_settings_layout)
 
         # Кнопки
@@ -215,10 +231,19 @@ class ServerGUI(QMainWindow):
             btns.addWidget(btn)
         layout.addLayout(btns)
 
-        # Логи
+        # Логи и статистика запросов
+        tabs = QTabWidget()
         self.logs = QTextEdit()
         self.logs.setReadOnly(True)
-        layout.addWidget(self.logs)
+        tabs.addTab(self.logs, "Логи")
+
+        self.stats_table = QTableWidget(0, len(self.STATS_COLUMNS))
+        self.stats_table.setHorizontalHeaderLabels([title for title, _ in self.STATS_COLUMNS])
+        self.stats_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.stats_table.verticalHeader().setVisible(False)
+        self.stats_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        tabs.addTab(self.stats_table, "Статистика")
+        layout.addWidget(tabs)
 
         # === СТАТУС-БАР ===
         self.status_bar = self.statusBar()
@@ -241,6 +266,11 @@ class ServerGUI(QMainWindow):
                 background-color: #444; color: #FFC107; border: 1px solid #555; border-radius: 4px; padding: 4px;
             }
             QTextEdit { background-color: #444; color: #FFC107; border: 1px solid #555; border-radius: 4px; border: 1px solid #FFC107; }
+            QTableWidget { background-color: #444; color: #FFC107; gridline-color: #555; border: 1px solid #FFC107; }
+            QHeaderView::section { background-color: #333; color: #FFC107; border: 1px solid #555; padding: 2px; }
+            QTabWidget::pane { border: none; }
+            QTabBar::tab { background-color: #444; color: #FFC107; padding: 4px 12px; }
+            QTabBar::tab:selected { background-color: #555; }
             QStatusBar { background-color: #333; color: #FFC107; }
         """)
         self.status.setStyleSheet("font-weight: bold; font-size: 14px;")
@@ -253,7 +283,8 @@ class ServerGUI(QMainWindow):
             'ping_timeout_ms': self.spin_timeout.value(),
             'packet_count': self.spin_packets.value(),
             'packet_interval': self.spin_interval.value(),
-            'scan_interval': self.spin_scan.value()
+            'scan_interval': self.spin_scan.value(),
+            'scan_concurrency': self.spin_concurrency.value()
         }
 
     def load_config(self):
@@ -264,14 +295,72 @@ class ServerGUI(QMainWindow):
                 self.spin_packets.setValue(cfg.get('packet_count', 3))
                 self.spin_interval.setValue(cfg.get('packet_interval', 1000))
                 self.spin_scan.setValue(cfg.get('scan_interval', 30))
+                self.spin_concurrency.setValue(cfg.get('scan_concurrency', 64))
         except FileNotFoundError:
             self.save_config()
 
     def save_config(self):
-        cfg = self.get_config()
+        # в config.json лежат и настройки сервера — сохраняем их, меняя только свои поля
+        try:
+            with open('config.json', 'r', encoding='utf-8') as f:
+                cfg = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cfg = {}
+        cfg.update(self.get_config())
         with open('config.json', 'w', encoding='utf-8') as f:
             json.dump(cfg, f, indent=4)
         self.append_log("Конфиг сохранён")
+        if self.process:
+            # работающий сервер подхватывает настройки сканера сразу
+            self.control.post("scanner_config", config=self.get_config())
+
+    def poll_scanner(self):
+        if "scanner_status" not in self.control.pending:
+            self.control.post("scanner_status")
+
+    def show_scanner(self, scanner):
+        cycle = scanner.get("last_cycle") or {}
+        if scanner.get("running"):
+            self.status_signal.emit("Сканирование...")
+        elif cycle:
+            self.status_signal.emit(
+                f"Устройств: {cycle['devices']}, доступно {cycle['up']}, недоступно {cycle['down']} "
+                f"(цикл {cycle['duration']}с, {cycle['finished']})")
+
+    def poll_stats(self):
+        if "server_stats" not in self.control.pending:
+            self.control.post("server_stats")
+
+    def on_control_reply(self, action, response):
+        if not response.get("success"):
+            self.on_control_failed(action, response.get("error"))
+        elif action == "server_stats":
+            self.show_stats(response["stats"])
+        elif action == "scanner_status":
+            self.show_scanner(response["scanner"])
+        elif action == "backup_now":
+            self.append_log("Backup запущен на сервере")
+
+    def on_control_failed(self, action, error):
+        # опросы по таймеру молчат: сервер мог ещё не подняться
+        if action == "scanner_config":
+            self.append_log(f"Сервер не принял настройки: {error}")
+        elif action == "backup_now":
+            self.append_log(f"Ошибка backup: {error}")
+
+    def show_stats(self, stats):
+        # сверху — действия, на которые сервер тратит больше всего времени
+        actions = sorted(stats["actions"].items(), key=lambda kv: kv[1]["count"] * kv[1]["avg_ms"], reverse=True)
+        self.stats_table.setRowCount(len(actions))
+        for row, (name, metrics) in enumerate(actions):
+            for col, (_, key) in enumerate(self.STATS_COLUMNS):
+                if key is None:
+                    value = name
+                elif key == "error_rate":
+                    value = f"{metrics[key] * 100:.1f}"
+                else:
+                    value = str(metrics[key])
+                self.stats_table.setItem(row, col, QTableWidgetItem(value))
 
     def start_server(self):
         if self.process:
@@ -290,28 +379,28 @@ class ServerGUI(QMainWindow):
         self.status_signal.emit("Сервер запущен")
         self.append_log("Сервер запущен")
 
-        # === ЗАПУСК ПИНГ-РАБОТНИКА ===
-        interval = self.spin_scan.value()
-        self.ping_worker = PingWorker(gui=self, interval=interval)
-        self.ping_worker.start()
-        self.append_log(f"PingWorker запущен (интервал {interval}с)")
+        # сканер запускается в самом сервере, GUI только показывает его статус
+        self.scanner_timer.start(5000)
+        self.stats_timer.start(2000)
 
     def stop_server(self):
         if self.process:
-            self.process.terminate()
+            # сервер сам дописывает данные и выходит; terminate на Windows убил бы его без этого
+            self.control.post("server_shutdown")
             try:
-                self.process.wait(timeout=5)
-            except:
-                pass
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=5)
+                except:
+                    pass
             self.process = None
             self.status.setText("Сервер: ОСТАНОВЛЕН")
             self.status_signal.emit("Сервер остановлен")
             self.append_log("Сервер остановлен")
-
-        if self.ping_worker:
-            self.ping_worker.stop()
-            self.ping_worker = None
-            self.append_log("PingWorker остановлен")
+        self.scanner_timer.stop()
+        self.stats_timer.stop()
 
     def emergency_stop(self):
         if not self.process:
@@ -331,24 +420,40 @@ class ServerGUI(QMainWindow):
             self.status.setText("Сервер: АВАРИЙНО ОСТАНОВЛЕН")
             self.status_signal.emit("АВАРИЙНОЕ ВЫКЛЮЧЕНИЕ!")
             self.append_log("АВАРИЙНОЕ ВЫКЛЮЧЕНИЕ!")
-
-        if self.ping_worker:
-            self.ping_worker.stop()
-            self.ping_worker = None
+        self.scanner_timer.stop()
+        self.stats_timer.stop()
 
     def backup(self):
+        if self.process:
+            # сервер сам пишет в data — снимок делает он, под своими блокировками
+            self.control.post("backup_now")
+            return
+        if self.backup_thread and self.backup_thread.isRunning():
+            return
+        self.backup_thread = BackupThread()
+        self.backup_thread.keep = self.backup_keep()
+        self.backup_thread.finished_backup.connect(self.on_backup_finished)
+        self.backup_thread.start()
+        self.append_log("Backup запущен")
+
+    def backup_keep(self):
         try:
-            name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
-            with zipfile.ZipFile(name, 'w') as zf:
-                for root, _, files in os.walk('data'):
-                    for f in files:
-                        path = os.path.join(root, f)
-                        arcname = os.path.relpath(path, 'data')
-                        zf.write(path, f"data/{arcname}")
-            self.append_log(f"Backup: {name}")
-            QMessageBox.information(self, "Backup", f"Создан: {name}")
-        except Exception as e:
-            self.append_log(f"Ошибка backup: {e}")
+            with open('config.json', 'r', encoding='utf-8') as f:
+                return json.load(f).get('backup_keep', 14)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 14
+
+    def on_backup_finished(self, stats):
+        if 'error' in stats:
+            self.append_log(f"Ошибка backup: {stats['error']}")
+            return
+        self.append_log(f"Backup {stats['name']}: файлов {stats['files']}, "
+                        f"новых данных {stats['new_bytes'] // 1024} КБ")
+        QMessageBox.information(self, "Backup", f"Создан снимок: {stats['name']}")
+
+    def closeEvent(self, event):
+        self.control.stop()
+        super().closeEvent(event)
 
     def append_log(self, text):
         timestamp = datetime.now().strftime("%H:%M:%S")
@@ -2,18 +2,82 @@ import asyncio
 import websockets
 import json
 import os
+import sys
 import subprocess
 import csv
+import socket
+import struct
+import time
+import hashlib
+import hmac
+import queue
+import random
+import secrets
+import threading
+import atexit
+import signal
+import bisect
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 import pickle
 import base64
+from backup_engine import BackupEngine, BackupError
+from storage_sqlite import SqliteStore
+from history_store import HistoryStore, UP, DOWN, UNREACHABLE
+
+try:
+    from PIL import Image  # миниатюры моделей; без Pillow отдаются оригиналы
+except ImportError:
+    Image = None
 
 # === КОНФИГ ===
 CONFIG = {
     "ping_timeout_ms": 3000,
     "packet_count": 1,
     "packet_interval": 1000,
-    "scan_interval": 240
+    "scan_interval": 240,
+    "scan_concurrency": 64,
+    "scanner_enabled": True,
+    "scan_up_max_interval": 900,
+    "scan_confirm_interval": 5,
+    "scan_confirm_count": 2,
+    "scan_down_min_interval": 30,
+    "scan_down_max_interval": 1800,
+    "scan_dependencies": True,
+    "doc_cache_mb": 64,
+    "io_workers": 4,
+    "max_inflight": 16,
+    "max_queued": 256,
+    "stream_flush_ms": 50,
+    "image_chunk_size": 256 * 1024,
+    "upload_chunk_timeout": 30,
+    "upload_max_mb": 64,
+    "thumb_cache_mb": 128,
+    "activity_flush_interval": 30,
+    # вход обязателен только после перехода клиентов на resume_session: старый клиент
+    # логинится на одном сокете, а работает на других — без сессии
+    "auth_required": False,
+    "session_ttl_hours": 12,
+    "backup_interval_hours": 24,
+    "backup_keep": 14,
+    "storage": "files",
+    "write_coalesce_ms": 20,
+    "fsync": True,
+    "history_enabled": True,
+    "history_flush_interval": 30,
+    "history_memory_samples": 128,
+    "auto_issues": True,
+    "auto_issue_severity": "Авария",
+    "auto_issue_flap_window": 900,
+    "log_level": "INFO",
+    "log_action_sample": 1.0,
+    "log_flush_interval": 0.5,
+    "log_max_bytes": 5 * 1024 * 1024,
+    "log_rotate_hours": 24,
+    "log_backup_count": 5
 }
 
 # === ПУТИ ===
@@ -25,6 +89,7 @@ GLOBALS_DIR = os.path.join(DATA_DIR, "globals")
 LISTS_DIR = os.path.join(DATA_DIR, "lists")
 MODELS_DIR = os.path.join(DATA_DIR, "models")
 IMAGES_DIR = os.path.join(DATA_DIR, "images")
+THUMBS_DIR = os.path.join(BASE_DIR, "cache", "images")  # производные, можно удалять в любой момент
 
 os.makedirs(MAPS_DIR, exist_ok=True)
 os.makedirs(OPERATORS_DIR, exist_ok=True)
@@ -32,29 +97,317 @@ os.makedirs(GLOBALS_DIR, exist_ok=True)
 os.makedirs(LISTS_DIR, exist_ok=True)
 os.makedirs(MODELS_DIR, exist_ok=True)
 os.makedirs(IMAGES_DIR, exist_ok=True)
+os.makedirs(THUMBS_DIR, exist_ok=True)
+
+BACKUP_DIR = os.path.join(BASE_DIR, "backups")
+HISTORY_DIR = os.path.join(BASE_DIR, "history")  # вне data: кольца меняются постоянно, в резервные копии не идут
+CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
+
+
+def load_config():
+    """Подмешивает config.json (его сохраняет GUI) поверх значений по умолчанию"""
+    try:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            loaded = json.load(f)
+        for key in list(loaded):
+            # неверная настройка сканера остаётся по умолчанию, а не роняет его
+            error = check_scanner_settings({key: loaded[key]})
+            if error:
+                log(f"Config error: {error}", "WARNING")
+                del loaded[key]
+        CONFIG.update(loaded)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log(f"Config error: {e}", "WARNING")
 
 
 # === ЛОГИРОВАНИЕ ===
-def log(msg):
-    line = f"{datetime.now().strftime('%H:%M:%S')} - {msg}"
-    print(line)
-    log_path = os.path.join(BASE_DIR, "logs", "server.log")
-    os.makedirs(os.path.dirname(log_path), exist_ok=True)
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+
+class BufferedLogger:
+    """Строки лога копятся в очереди, фоновый поток пишет их пачками.
+
+    Файл держится открытым и ротируется по размеру (log_max_bytes) и времени
+    (log_rotate_hours): server.log -> server.log.1 -> ... -> server.log.N.
+    В stdout строки идут тоже — его читает ServerThread в GUI.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.file = None
+        self.opened_at = 0
+
+    def write(self, line):
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+        self.queue.put(line)
+
+    def close(self):
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def _rotate(self):
+        self.file.close()
+        count = CONFIG["log_backup_count"]
+        for i in range(count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _flush(self, batch):
+        text = "\n".join(batch) + "\n"
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass
+        try:
+            if self.file is None:
+                self._open()
+            self.file.write(text)
+            self.file.flush()
+            if (self.file.tell() >= CONFIG["log_max_bytes"]
+                    or time.time() - self.opened_at >= CONFIG["log_rotate_hours"] * 3600):
+                self._rotate()
+        except OSError as e:
+            sys.stderr.write(f"Log write error: {e}\n")
+
+    def _run(self):
+        while True:
+            line = self.queue.get()
+            batch = [line]
+            # короткая пауза, чтобы набралась пачка строк на один системный вызов
+            time.sleep(CONFIG["log_flush_interval"])
+            try:
+                while len(batch) < 10000:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in batch
+            batch = [b for b in batch if b is not None]
+            if batch:
+                self._flush(batch)
+            if stop:
+                if self.file:
+                    self.file.close()
+                return
+
+
+LOGGER = BufferedLogger(os.path.join(BASE_DIR, "logs", "server.log"))
+
+
+def log(msg, level="INFO"):
+    if LOG_LEVELS.get(level, 20) < LOG_LEVELS.get(CONFIG["log_level"], 20):
+        return
+    prefix = "" if level == "INFO" else f"[{level}] "
+    LOGGER.write(f"{datetime.now().strftime('%H:%M:%S')} - {prefix}{msg}")
+
+
+def log_action(msg):
+    """Строки на каждый запрос: можно проредить (log_action_sample < 1) или отключить (0)"""
+    rate = CONFIG["log_action_sample"]
+    if rate >= 1 or (rate > 0 and random.random() < rate):
+        log(msg)
 
 
 # === ПИНГ УСТРОЙСТВА ===
-def ping_device(ip, timeout_ms):
+def ping_device_subprocess(ip, timeout_ms):
+    """Запасной вариант: системный ping (если ICMP-сокет открыть нельзя)"""
     try:
-        # Windows-style ping by default (change if needed for Linux)
-        cmd = ['ping', '-n', '1', '-w', str(timeout_ms), ip]
+        if os.name == "nt":
+            cmd = ['ping', '-n', '1', '-w', str(timeout_ms), ip]
+        else:
+            cmd = ['ping', '-c', '1', '-W', str(max(1, round(timeout_ms / 1000))), ip]
         output = subprocess.check_output(
             cmd, stderr=subprocess.STDOUT, timeout=timeout_ms/1000 + 2
         )
-        return {"success": b'TTL=' in output, "ip": ip}
+        return {"success": b'TTL=' in output.upper(), "ip": ip, "rtt_ms": None}
     except Exception:
-        return {"success": False, "ip": ip}
+        return {"success": False, "ip": ip, "rtt_ms": None}
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def icmp_message(packet):
+    """ICMP-сообщение из принятого пакета.
+
+    Raw-сокет всегда отдаёт и IP-заголовок, DGRAM — на Linux без него, на macOS с ним,
+    поэтому смотрим на сам пакет: первый байт IPv4-заголовка — версия 4 и длина (IHL),
+    а у ICMP там тип, и сообщений с типом 64..79 не бывает."""
+    if packet and packet[0] >> 4 == 4:
+        header = (packet[0] & 0x0F) * 4
+        if header >= 20:
+            return packet[header:]
+    return packet
+
+
+class IcmpPinger:
+    """Асинхронный ICMP echo: один сокет на все проверки, ответы сопоставляются по (ip, seq).
+
+    Сначала пробуем непривилегированный SOCK_DGRAM (Linux/macOS), затем SOCK_RAW
+    (root / администратор). Если не вышло ни то, ни другое — системный ping в потоках.
+    """
+
+    def __init__(self):
+        self.sock = None
+        self.raw = False
+        self.loop = None
+        self.reader_task = None
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = 0
+        self.waiters = {}
+        self.fallback = asyncio.Semaphore(64)
+
+    def _open(self):
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+            except OSError:
+                continue
+            sock.setblocking(False)
+            if sock_type == socket.SOCK_RAW and os.name == "nt":
+                # Windows не принимает recvfrom на raw-сокете без bind
+                try:
+                    sock.bind(("", 0))
+                except OSError:
+                    sock.close()
+                    continue
+            self.sock = sock
+            self.raw = sock_type == socket.SOCK_RAW
+            return True
+        return False
+
+    def _ensure(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # новый event loop (например, перезапуск сервера) — открываем заново
+            self.close()
+            self.loop = loop
+            if self._open():
+                self.reader_task = loop.create_task(self._reader())
+                log(f"ICMP pinger: {'raw' if self.raw else 'datagram'} socket")
+            else:
+                log("ICMP pinger: no ICMP socket permission, falling back to system ping", "WARNING")
+        return self.sock is not None
+
+    def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+            self.reader_task = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        for fut in self.waiters.values():
+            if not fut.done():
+                fut.cancel()
+        self.waiters.clear()
+        self.loop = None
+
+    async def _reader(self):
+        while True:
+            try:
+                packet, addr = await self.loop.sock_recvfrom(self.sock, 2048)
+            except asyncio.CancelledError:
+                raise
+            except OSError:
+                await asyncio.sleep(0.01)
+                continue
+            received = time.perf_counter()
+            packet = icmp_message(packet)
+            if len(packet) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", packet[:8])
+            # в DGRAM-режиме идентификатор подменяет ядро, и чужие ответы к нам не попадают
+            if icmp_type != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+                continue
+            fut = self.waiters.pop((addr[0], seq), None)
+            if fut and not fut.done():
+                fut.set_result(received)
+
+    def _next_seq(self, addr):
+        for _ in range(0x10000):
+            self.seq = (self.seq + 1) & 0xFFFF
+            if (addr, self.seq) not in self.waiters:
+                return self.seq
+        raise RuntimeError("Too many ICMP probes in flight")
+
+    async def _resolve(self, ip):
+        try:
+            socket.inet_aton(ip)
+            return ip
+        except OSError:
+            infos = await self.loop.getaddrinfo(ip, None, family=socket.AF_INET)
+            return infos[0][4][0]
+
+    async def ping(self, ip, timeout_ms):
+        if not self._ensure():
+            async with self.fallback:
+                return await asyncio.to_thread(ping_device_subprocess, ip, timeout_ms)
+
+        try:
+            addr = await self._resolve(ip)
+        except OSError:
+            return {"success": False, "ip": ip, "rtt_ms": None}
+
+        seq = self._next_seq(addr)
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        payload = b"pinger" + struct.pack("!H", seq)
+        checksum = icmp_checksum(header + payload)
+        packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, self.ident, seq) + payload
+
+        fut = self.loop.create_future()
+        self.waiters[(addr, seq)] = fut
+        try:
+            sent = time.perf_counter()
+            await self.loop.sock_sendto(self.sock, packet, (addr, 0))
+            received = await asyncio.wait_for(fut, timeout_ms / 1000)
+            return {"success": True, "ip": ip, "rtt_ms": round((received - sent) * 1000, 2)}
+        except (asyncio.TimeoutError, OSError):
+            return {"success": False, "ip": ip, "rtt_ms": None}
+        finally:
+            self.waiters.pop((addr, seq), None)
+
+
+PINGER = IcmpPinger()
+
+
+async def ping_device(ip, timeout_ms):
+    return await PINGER.ping(ip, timeout_ms)
+
+
+async def ping_many(ips, timeout_ms):
+    """Пингует все адреса одновременно — общее время ≈ один таймаут"""
+    return await asyncio.gather(*(ping_device(ip, timeout_ms) for ip in ips))
 
 
 # === ПОЛНЫЙ ПУТЬ К ФАЙЛУ ===
@@ -66,6 +419,697 @@ def get_full_path(path):
     return full_path
 
 
+# === ХРАНИЛИЩЕ (дисковый ввод-вывод вне event loop) ===
+IO_EXECUTOR = None
+
+
+async def run_io(func, *args):
+    """Выполняет блокирующую файловую операцию в отдельном пуле, не останавливая остальных клиентов"""
+    global IO_EXECUTOR
+    if IO_EXECUTOR is None:
+        IO_EXECUTOR = ThreadPoolExecutor(max_workers=CONFIG["io_workers"], thread_name_prefix="storage-io")
+    future = asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # поток не прервать: ждём его, чтобы path_lock не освободился посреди записи файла
+        await asyncio.wait([future])
+        raise
+
+
+_MISSING = object()
+PATH_LOCKS = {}  # полный путь -> asyncio.Lock: записи одного файла идут строго по очереди
+
+
+def path_lock(file_path):
+    lock = PATH_LOCKS.get(file_path)
+    if lock is None:
+        lock = PATH_LOCKS[file_path] = asyncio.Lock()
+    return lock
+
+
+# === ХРАНИЛИЩЕ JSON: ФАЙЛЫ ИЛИ SQLITE ===
+# "storage": "files" — документы лежат в data/*.json как раньше;
+# "storage": "sqlite" — в data/storage.sqlite3 (см. storage_sqlite.py), пути документов те же.
+STORAGE = None
+STORAGE_DB_PATH = os.path.join(DATA_DIR, "storage.sqlite3")
+
+
+def open_storage():
+    """Вызывается из main() после load_config(); при первом включении SQLite импортирует data/*.json"""
+    global STORAGE
+    if CONFIG["storage"] != "sqlite" or STORAGE is not None:
+        return
+    STORAGE = SqliteStore(STORAGE_DB_PATH)
+    if STORAGE.is_empty():
+        count = STORAGE.import_tree(DATA_DIR)
+        log(f"SQLite storage: imported {count} JSON documents from {DATA_DIR}")
+    log(f"Storage: SQLite ({STORAGE_DB_PATH})")
+
+
+def storage_key(path):
+    """Путь документа в STORAGE или None, если документ хранится файлом"""
+    if STORAGE is None or not path.endswith(".json"):
+        return None
+    rel = os.path.relpath(path, DATA_DIR)
+    if rel.startswith(".."):
+        return None
+    return rel.replace(os.sep, "/")
+
+
+def read_json(path, default=None):
+    """Читает JSON; если файла нет — возвращает default. Ещё не сброшенная запись видна сразу"""
+    pending = WRITER.peek(path)
+    if pending is not _MISSING:
+        return pending
+    key = storage_key(path)
+    if key is not None:
+        try:
+            return STORAGE.read(key)
+        except FileNotFoundError:
+            if default is not None:
+                return default
+            raise
+    if default is not None and not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# === АТОМАРНАЯ ЗАПИСЬ ФАЙЛОВ ===
+# Файл пишется рядом во временный, сбрасывается на диск и переименовывается поверх старого:
+# читатель (file_get, GUI, резервная копия) видит либо старую, либо новую версию целиком.
+def replace_file(src, dst):
+    for attempt in range(5):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            # Windows: файл в этот момент открыт другим процессом
+            if attempt == 4:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+
+def fsync_dir(directory):
+    """Фиксирует переименование в каталоге (на Windows не требуется и не поддерживается)"""
+    if not CONFIG["fsync"] or os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, write, mode="w", sync_dir=True, **open_args):
+    """write(f) заполняет временный файл; False в sync_dir — каталог синхронизирует вызывающий"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if "b" not in mode:
+        open_args.setdefault("encoding", "utf-8")
+    try:
+        with open(tmp, mode, **open_args) as f:
+            write(f)
+            f.flush()
+            if CONFIG["fsync"]:
+                os.fsync(f.fileno())
+        replace_file(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync_dir:
+        fsync_dir(directory)
+
+
+def write_json(path, data, sync_dir=True):
+    key = storage_key(path)
+    if key is not None:
+        STORAGE.write(key, data)
+        return
+    atomic_write(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=4), sync_dir=sync_dir)
+
+
+def delete_json(path):
+    key = storage_key(path)
+    if key is not None:
+        STORAGE.delete(key)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_json_many(items):
+    """[(путь, данные)]; данные None — удалить. В SQLite — одной транзакцией"""
+    keys = [storage_key(path) for path, _ in items]
+    if STORAGE is not None and None not in keys:
+        STORAGE.write_many([(key, data) for key, (_, data) in zip(keys, items)])
+        return
+    for path, data in items:
+        if data is None:
+            delete_json(path)
+        else:
+            write_json(path, data)
+
+
+def json_exists(path):
+    if WRITER.peek(path) is not _MISSING:
+        return True
+    key = storage_key(path)
+    return STORAGE.exists(key) if key is not None else os.path.exists(path)
+
+
+def doc_stat(path):
+    """(mtime_ns, size) файла или (версия, 0) документа в SQLite; FileNotFoundError, если нет"""
+    key = storage_key(path)
+    try:
+        if key is None:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        version = STORAGE.version(key)
+        if version is None:
+            raise FileNotFoundError(path)
+        return version, 0
+    except FileNotFoundError:
+        if WRITER.peek(path) is _MISSING:
+            raise
+        return -1, -1  # новый документ ещё в очереди записи; после сброса WRITER обновит кэш
+
+
+def doc_stats(paths):
+    """{путь: doc_stat} одним заданием в пуле ввода-вывода; отсутствующие пропускаются"""
+    stats = {}
+    for path in paths:
+        try:
+            stats[path] = doc_stat(path)
+        except OSError:
+            pass
+    return stats
+
+
+async def load_json(path, default=None):
+    return await run_io(read_json, path, default)
+
+
+async def save_json(path, data):
+    async with path_lock(path):
+        written = WRITER.submit(path, data)
+    await written
+
+
+async def save_json_many(items):
+    # блокировки берутся в одном порядке — два таких вызова не заблокируют друг друга
+    paths = sorted({path for path, _ in items})
+    for path in paths:
+        await path_lock(path).acquire()
+    try:
+        await run_io(write_json_many, items)
+    finally:
+        for path in paths:
+            path_lock(path).release()
+
+
+def list_json_files(directory):
+    if STORAGE is not None:
+        rel = os.path.relpath(directory, DATA_DIR)
+        if not rel.startswith(".."):
+            return [f for f in STORAGE.list(rel.replace(os.sep, "/")) if f.endswith(".json")]
+    return [f for f in os.listdir(directory) if f.endswith(".json")]
+
+
+def read_binary(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_binary(path, content):
+    atomic_write(path, lambda f: f.write(content), mode="wb")
+
+
+# === ОЧЕРЕДЬ ЗАПИСИ JSON ===
+class PendingWrite:
+    __slots__ = ("data", "future")
+
+    def __init__(self, data, future):
+        self.data = data
+        self.future = future
+
+
+class JsonWriter:
+    """Единая точка записи JSON-документов сервера.
+
+    - запись атомарная (временный файл + rename), torn JSON никто не увидит;
+    - записи копятся write_coalesce_ms: несколько сохранений одного файла подряд
+      дают одну запись на диск с последними данными, а все файлы пачки сбрасываются
+      одним заданием в пуле ввода-вывода (fsync каталога — один раз на каталог);
+    - пачки пишутся строго по очереди, поэтому порядок записей одного файла сохраняется;
+    - пока запись не на диске, read_json/json_exists/doc_stat видят её данные.
+    submit() ставит документ в очередь и возвращает future, завершающийся после записи.
+    """
+
+    def __init__(self):
+        self.pending = {}   # путь -> PendingWrite, ещё не начатые
+        self.flushing = {}  # путь -> PendingWrite, пишутся сейчас
+        self.wakeup = None
+        self.task = None
+        self.writes = 0
+        self.coalesced = 0
+
+    def peek(self, path):
+        entry = self.pending.get(path) or self.flushing.get(path)
+        return entry.data if entry else _MISSING
+
+    def submit(self, path, data):
+        entry = self.pending.get(path)
+        if entry:
+            # следующая версия того же файла — предыдущая на диск уже не попадёт
+            entry.data = data
+            self.coalesced += 1
+            return entry.future
+        loop = asyncio.get_running_loop()
+        entry = self.pending[path] = PendingWrite(data, loop.create_future())
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+        return entry.future
+
+    async def settled(self, path):
+        """Ждёт, пока документ не пишется на диск: после этого данные из кэша можно менять на месте.
+        Между возвратом и submit() не должно быть других await"""
+        while path in self.flushing:
+            await asyncio.wait([self.flushing[path].future])
+
+    async def written(self, path):
+        """Ждёт, пока документ не окажется на диске вместе со всеми поставленными в очередь версиями.
+        Вызывать под path_lock, иначе очередь может пополниться снова"""
+        while path in self.pending or path in self.flushing:
+            entry = self.flushing.get(path) or self.pending[path]
+            await asyncio.wait([entry.future])
+
+    async def drain(self):
+        """Ждёт, пока вся очередь не окажется на диске (остановка сервера)"""
+        while self.pending or self.flushing:
+            await asyncio.wait([entry.future for entry in (*self.flushing.values(), *self.pending.values())])
+
+    @staticmethod
+    def _flush(items):
+        """Пишет пачку; возвращает {путь: исключение} для неудавшихся"""
+        errors = {}
+        if STORAGE is not None:
+            stored = [(path, data) for path, data in items if storage_key(path) is not None]
+            if stored:
+                try:
+                    write_json_many(stored)  # одна транзакция SQLite
+                except Exception as e:
+                    errors.update((path, e) for path, _ in stored)
+                items = [(path, data) for path, data in items if storage_key(path) is None]
+        directories = set()
+        for path, data in items:
+            try:
+                write_json(path, data, sync_dir=False)
+                directories.add(os.path.dirname(path))
+            except Exception as e:
+                errors[path] = e
+        for directory in directories:
+            try:
+                fsync_dir(directory)
+            except OSError as e:
+                log(f"fsync {directory}: {e}", "WARNING")
+        return errors
+
+    @classmethod
+    def _write(cls, items):
+        """Пачка и mtime/размер записанных файлов (для DOC_CACHE) — одним заданием в пуле"""
+        errors = cls._flush(items)
+        return errors, doc_stats([path for path, _ in items if path not in errors])
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            # окно накопления: повторные сохранения за это время сливаются в одну запись
+            await asyncio.sleep(CONFIG["write_coalesce_ms"] / 1000)
+            self.wakeup.clear()
+            if not self.pending:
+                continue
+            self.flushing, self.pending = self.pending, {}
+            batch = self.flushing
+            try:
+                errors, stats = await run_io(self._write, [(path, entry.data) for path, entry in batch.items()])
+            except Exception as e:
+                errors, stats = {path: e for path in batch}, {}
+            self.flushing = {}
+            self.writes += len(batch) - len(errors)
+            for path, entry in batch.items():
+                error = errors.get(path)
+                if error is None:
+                    DOC_CACHE.refresh(path, entry.data, stats.get(path))
+                    if not entry.future.done():
+                        entry.future.set_result(True)
+                else:
+                    log(f"Write error {path}: {error}", "ERROR")
+                    DOC_CACHE.invalidate(path)
+                    if not entry.future.done():
+                        entry.future.set_exception(error)
+                        entry.future.exception()  # ожидающего может уже не быть — без "never retrieved"
+
+    def flush_sync(self):
+        """При остановке процесса: дописать всё, что осталось в очереди"""
+        items = {**self.flushing, **self.pending}
+        self.flushing, self.pending = {}, {}
+        if items:
+            self._flush([(path, entry.data) for path, entry in items.items()])
+
+
+WRITER = JsonWriter()
+atexit.register(WRITER.flush_sync)
+
+
+# === КЭШ ДОКУМЕНТОВ ===
+class CacheEntry:
+    __slots__ = ("mtime_ns", "size", "version", "data", "body", "etag", "cost")
+
+    def __init__(self, mtime_ns, size, version, data, body):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.version = version
+        self.data = data
+        self.body = body  # готовый JSON для ответа — повторно не кодируем
+        # хэш содержимого: одинаковые данные дают одинаковый etag и после перезапуска
+        self.etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        # грубая оценка: сериализованный текст + разобранные объекты примерно того же порядка
+        self.cost = len(body) * 3
+
+
+class DocumentCache:
+    """Разобранные JSON-документы в памяти.
+
+    Ключ — нормализованный путь из get_full_path. Запись считается актуальной,
+    пока у файла не изменились mtime и размер; при каждой перезагрузке или
+    записи через put() версия увеличивается. Вытеснение LRU по бюджету doc_cache_mb.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.total_cost = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stat(file_path):
+        return doc_stat(file_path)
+
+    def _build(self, file_path, mtime_ns, size, data=_MISSING):
+        """Чтение, разбор и сериализация — в пуле ввода-вывода, а не в event loop"""
+        if data is _MISSING:
+            data = read_json(file_path)
+        return CacheEntry(mtime_ns, size, 0, data, json.dumps(data, ensure_ascii=False))
+
+    def _store(self, file_path, entry):
+        self.version += 1
+        entry.version = self.version
+        self.invalidate(file_path)
+        self.entries[file_path] = entry
+        self.total_cost += entry.cost
+        budget = CONFIG["doc_cache_mb"] * 1024 * 1024
+        while self.total_cost > budget and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.total_cost -= old.cost
+        return entry
+
+    def invalidate(self, file_path):
+        old = self.entries.pop(file_path, None)
+        if old:
+            self.total_cost -= old.cost
+
+    async def get(self, file_path):
+        """Возвращает CacheEntry; файл читается и разбирается только если изменился"""
+        mtime_ns, size = await run_io(self._stat, file_path)
+        entry = self.entries.get(file_path)
+        if entry and entry.mtime_ns == mtime_ns and entry.size == size:
+            self.entries.move_to_end(file_path)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = await run_io(self._build, file_path, mtime_ns, size)
+        return self._store(file_path, entry)
+
+    def refresh(self, file_path, data, stat):
+        """Запись сброшена на диск: кэш с этими же данными становится актуальным для нового mtime.
+        stat — doc_stat после записи (снят в пуле WRITER), None — файла нет"""
+        entry = self.entries.get(file_path)
+        if entry is None or entry.data is not data:
+            return
+        if stat is None:
+            self.invalidate(file_path)
+        else:
+            entry.mtime_ns, entry.size = stat
+
+    async def put(self, file_path, data):
+        """Вызывается при записи документа: новые данные сразу попадают в кэш"""
+        try:
+            mtime_ns, size = await run_io(self._stat, file_path)
+        except OSError:
+            self.invalidate(file_path)
+            return None
+        entry = await run_io(self._build, file_path, mtime_ns, size, data)
+        return self._store(file_path, entry)
+
+
+DOC_CACHE = DocumentCache()
+
+
+# === ПАТЧИ КАРТ ===
+MAP_COLLECTIONS = ("switches", "plan_switches", "soaps", "legends", "magistrals", "users")
+def _find_entity(items, entity_id):
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and item.get("id") == entity_id:
+            return i
+    raise ValueError(f"Entity {entity_id} not found")
+
+
+def apply_map_ops(map_data, ops):
+    """Применяет операции set/insert/delete к карте на месте.
+
+    Либо применяются все операции, либо (при любой ошибке) изменения откатываются
+    и выбрасывается ValueError.
+    """
+    undo = []
+
+    def section(key, kind):
+        if key not in map_data:
+            map_data[key] = kind()
+            undo.append(lambda: map_data.pop(key, None))
+        if not isinstance(map_data[key], kind):
+            raise ValueError(f"Invalid section: {key}")
+        return map_data[key]
+
+    try:
+        if not isinstance(map_data, dict):
+            raise ValueError("Map is not an object")
+        for op in ops:
+            if not isinstance(op, dict):
+                raise ValueError(f"Invalid operation: {op!r}")
+            kind = op.get("op")
+            collection = op.get("collection")
+            if collection == "map" and kind == "set":
+                target = section("map", dict)
+            elif isinstance(collection, str) and collection in MAP_COLLECTIONS:
+                items = section(collection, list)
+                if kind == "insert":
+                    item = op.get("item")
+                    if not isinstance(item, dict) or not item.get("id"):
+                        raise ValueError("insert requires item with id")
+                    if any(isinstance(x, dict) and x.get("id") == item["id"] for x in items):
+                        raise ValueError(f"Entity {item['id']} already exists")
+                    items.append(item)
+                    undo.append(lambda items=items: items.pop())
+                    continue
+                index = _find_entity(items, op.get("id"))
+                if kind == "delete":
+                    removed = items.pop(index)
+                    undo.append(lambda items=items, index=index, removed=removed: items.insert(index, removed))
+                    continue
+                target = items[index]
+                if not isinstance(target, dict):
+                    raise ValueError(f"Invalid entity: {op.get('id')}")
+            else:
+                raise ValueError(f"Unknown collection: {collection}")
+
+            if kind != "set" or not isinstance(op.get("fields"), dict):
+                raise ValueError(f"Invalid operation: {kind}")
+            for key, value in op["fields"].items():
+                if key == "id":
+                    continue
+                old = target.get(key, _MISSING)
+                target[key] = value
+                undo.append(lambda target=target, key=key, old=old:
+                            target.pop(key, None) if old is _MISSING else target.__setitem__(key, old))
+    except Exception as e:
+        for revert in reversed(undo):
+            revert()
+        if isinstance(e, ValueError):
+            raise
+        raise ValueError(f"Invalid operation: {e}") from e
+
+
+def publish_map_patch(file_path, ops, etag):
+    """Остальные операторы с открытой картой получают сами операции, а не весь документ"""
+    subscribers = PING_SUBSCRIBERS.get(file_path)
+    if not subscribers:
+        return
+    message = json.dumps({
+        "action": "map_patched",
+        "path": os.path.relpath(file_path, DATA_DIR).replace(os.sep, "/"),
+        "ops": ops,
+        "etag": etag,
+        "version": etag  # base_version для следующей правки этого оператора
+    }, ensure_ascii=False)
+    websockets.broadcast(subscribers, message)
+
+
+# === ПОИСК УСТРОЙСТВ ПО ВСЕМ КАРТАМ ===
+SEARCH_FIELDS = ("ip", "mac", "name", "model", "master", "location")
+DEVICE_COLLECTIONS = ("switches", "plan_switches")
+
+
+class MapDevices:
+    """Устройства одной карты в виде, удобном для поиска.
+
+    По каждому полю — одна строка из значений всех устройств через "\n" (в нижнем
+    регистре) и смещения начала каждого значения: подстрока ищется str.find по
+    всей строке сразу, номер устройства — bisect по смещениям.
+    """
+    __slots__ = ("stat", "version", "map_name", "devices", "texts", "starts")
+
+    def __init__(self, stat, version, data):
+        self.stat = stat
+        self.version = version
+        self.map_name = str((data.get("map") or {}).get("name", "")) if isinstance(data, dict) else ""
+        self.devices = []
+        values = {field: [] for field in SEARCH_FIELDS}
+        for collection in DEVICE_COLLECTIONS:
+            items = data.get(collection) if isinstance(data, dict) else None
+            for dev in items or []:
+                if not isinstance(dev, dict):
+                    continue
+                self.devices.append({"collection": collection, "id": dev.get("id"),
+                                     **{field: dev.get(field, "") for field in SEARCH_FIELDS}})
+                for field in SEARCH_FIELDS:
+                    values[field].append(str(dev.get(field) or "").lower().replace("\n", " "))
+        self.texts = {}
+        self.starts = {}
+        for field, items in values.items():
+            starts, offset = [], 0
+            for value in items:
+                starts.append(offset)
+                offset += len(value) + 1
+            self.texts[field] = "".join(f"\n{value}" for value in items)
+            self.starts[field] = starts
+
+    def search(self, field, query, prefix):
+        """Номера устройств, у которых field содержит query (или начинается с него)"""
+        text, starts = self.texts[field], self.starts[field]
+        needle = "\n" + query if prefix else query
+        pos = text.find(needle)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            yield i
+            if i + 1 >= len(starts):
+                break
+            pos = text.find(needle, starts[i + 1])
+
+
+class DeviceIndex:
+    """Индекс switches/plan_switches всех карт для device_search.
+
+    Карта переиндексируется целиком, когда меняется сама (file_put, map_patch
+    помечают её сразу, правки извне видны по mtime/размеру). Данные берутся из
+    DOC_CACHE под path_lock, разбор — в пуле ввода-вывода.
+    """
+
+    def __init__(self):
+        self.maps = {}  # путь карты -> MapDevices
+        self.dirty = set()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.builds = 0
+
+    def touch(self, file_path):
+        """Карта записана: переиндексировать в фоне, не дожидаясь поиска"""
+        if os.path.dirname(file_path) != MAPS_DIR:
+            return
+        self.dirty.add(file_path)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._refresh_later())
+
+    async def _refresh_later(self):
+        await asyncio.sleep(CONFIG["write_coalesce_ms"] / 1000)
+        try:
+            await self.refresh()
+        except Exception as e:
+            log(f"Device index refresh error: {e}", "ERROR")
+
+    async def _reindex(self, file_path):
+        async with path_lock(file_path):
+            try:
+                entry = await DOC_CACHE.get(file_path)
+            except (OSError, ValueError) as e:
+                log(f"Device index: error reading {file_path}: {e}", "WARNING")
+                self.maps.pop(file_path, None)
+                return
+            stat = (entry.mtime_ns, entry.size)
+            current = self.maps.get(file_path)
+            if current and current.version == entry.version:
+                current.stat = stat  # та же версия документа, изменилась только отметка на диске
+                return
+            # под path_lock документ никто не меняет — можно читать его из пула
+            self.maps[file_path] = await run_io(MapDevices, stat, entry.version, entry.data)
+            self.builds += 1
+
+    async def refresh(self):
+        """Переиндексирует новые и изменённые карты, убирает удалённые"""
+        async with self.lock:
+            names = await run_io(list_json_files, MAPS_DIR)
+            paths = {os.path.join(MAPS_DIR, name) for name in names}
+            for file_path in set(self.maps) - paths:
+                del self.maps[file_path]
+            dirty, self.dirty = self.dirty, set()
+            stats = await run_io(doc_stats, sorted(paths))
+            for file_path, stat in stats.items():
+                current = self.maps.get(file_path)
+                if current is None or file_path in dirty or current.stat != stat:
+                    await self._reindex(file_path)
+
+    async def search(self, query, field=None, prefix=False, limit=100):
+        await self.refresh()
+        query = query.lower().replace("\n", " ")
+        fields = (field,) if field else SEARCH_FIELDS
+        results, total = [], 0
+        for file_path, devices in sorted(self.maps.items()):
+            found = {}
+            for name in fields:
+                for i in devices.search(name, query, prefix):
+                    found.setdefault(i, name)
+            total += len(found)
+            for i in sorted(found):
+                if len(results) >= limit:
+                    break
+                results.append({"map": os.path.basename(file_path), "map_name": devices.map_name,
+                                "matched": found[i], **devices.devices[i]})
+        return results, total
+
+    def start(self):
+        """Первичная индексация при запуске, чтобы первый поиск не ждал"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._refresh_later())
+
+
+DEVICES = DeviceIndex()
+
+
 # === РАБОТА С CSV ===
 def read_csv(path):
     """Читает CSV файл и возвращает список словарей"""
@@ -78,7 +1122,7 @@ def read_csv(path):
             reader = csv.DictReader(f)
             return list(reader)
     except Exception as e:
-        log(f"Error reading CSV {path}: {e}")
+        log(f"Error reading CSV {path}: {e}", "ERROR")
         return []
 
 
@@ -94,468 +1138,2883 @@ def write_csv(path, data):
         fieldnames = ["id", "date", "description", "tickets", "master", "executor",
                       "created", "transferred", "callback", "work_start", "call_history",
                       "device_type", "device_id", "device_name", "device_ip"]
-        with open(full_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
+        atomic_write(full_path, lambda f: csv.DictWriter(f, fieldnames=fieldnames).writeheader(), newline='')
         return True
 
+    def write_rows(f):
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(data)
+
     try:
         fieldnames = list(data[0].keys())
-        with open(full_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(data)
+        atomic_write(full_path, write_rows, newline='')
         return True
     except Exception as e:
-        log(f"Error writing CSV {path}: {e}")
+        log(f"Error writing CSV {path}: {e}", "ERROR")
         return False
 
 
-# === ОБРАБОТЧИК КЛИЕНТА ===
-async def handler(websocket):
-    client_ip = websocket.remote_address[0] if websocket.remote_address else "unknown"
-    log(f"Client connected: {client_ip}")
+# === ЖУРНАЛ ГЛОБАЛЬНЫХ ПРОБЛЕМ ===
+ISSUES_CSV_PATH = os.path.join(GLOBALS_DIR, "issues.csv")
+ISSUES_JOURNAL_PATH = os.path.join(GLOBALS_DIR, "issues.journal")
+ISSUE_FIELDS = ["id", "date", "description", "tickets", "master", "executor", "created", "transferred",
+                "callback", "work_start", "call_history", "reaction_time", "severity_type", "device_type",
+                "device_id", "device_name", "device_ip"]
+
+
+class IssueJournal:
+    """Глобальные проблемы: журнал только на дозапись (JSON Lines) + индексы в памяти.
+
+    Строка журнала — {"op": "create" | "update" | "delete", "id", "fields", "ts"}.
+    Создание и правка проблемы дописывают одну строку, поэтому стоят O(1) ввода-вывода
+    при любой длине истории. Индексы: по id, по device_ip и по дате (сортированный список).
+    При первом запуске журнал заполняется из issues.csv.
+    """
+
+    def __init__(self, path, csv_path):
+        self.path = path
+        self.csv_path = csv_path
+        self.issues = {}
+        self.by_device = {}
+        self.by_date = []  # [(date, id)] по возрастанию
+        self.records = 0
+        self.loaded = False
+        self.lock = None
+
+    # --- индексы ---
+    def _unindex(self, issue):
+        self.by_device.get(issue.get("device_ip"), set()).discard(issue["id"])
+        key = (issue.get("date", ""), issue["id"])
+        i = bisect.bisect_left(self.by_date, key)
+        if i < len(self.by_date) and self.by_date[i] == key:
+            del self.by_date[i]
+
+    def _index(self, issue):
+        if issue.get("device_ip"):
+            self.by_device.setdefault(issue["device_ip"], set()).add(issue["id"])
+        bisect.insort(self.by_date, (issue.get("date", ""), issue["id"]))
+
+    def _apply(self, record):
+        self.records += 1
+        issue_id = str(record["id"])
+        old = self.issues.get(issue_id)
+        if old:
+            self._unindex(old)
+        if record["op"] == "delete":
+            self.issues.pop(issue_id, None)
+            return None
+        issue = dict(old or {}) if record["op"] == "update" else {}
+        issue.update(record.get("fields", {}))
+        issue["id"] = issue_id
+        self.issues[issue_id] = issue
+        self._index(issue)
+        return issue
+
+    # --- диск ---
+    def _load(self):
+        if STORAGE is not None:
+            rows = STORAGE.issue_rows()
+            for row in rows:
+                self._apply({"op": "create", "id": row["id"], "fields": row})
+            if rows:
+                self.loaded = True
+                return
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._apply(json.loads(line))
+            if STORAGE is not None:
+                # переход на SQLite: текущее состояние журнала переносится в таблицу issues
+                STORAGE.apply_issues(list(self.issues.values()))
+            # много правок поверх небольшого числа проблем — переписываем журнал снимком
+            elif self.records > 2 * len(self.issues) + 1000:
+                self._compact()
+        elif os.path.exists(self.csv_path):
+            with open(self.csv_path, "r", newline="", encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            records = [{"op": "create", "id": row.get("id") or str(i), "fields": row, "ts": time.time()}
+                       for i, row in enumerate(rows, 1)]
+            self._write(records)
+            for record in records:
+                self._apply(record)
+        self.loaded = True
+
+    def _write(self, records):
+        if STORAGE is not None:
+            self._write_sqlite(records)
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_sqlite(self, records):
+        """В SQLite хранится итоговое состояние строк, а не история правок"""
+        changed, deleted = {}, set()
+        for record in records:
+            issue_id = str(record["id"])
+            if record["op"] == "delete":
+                changed.pop(issue_id, None)
+                deleted.add(issue_id)
+                continue
+            base = {} if record["op"] == "create" else changed.get(issue_id) or self.issues.get(issue_id) or {}
+            changed[issue_id] = {**base, **record.get("fields", {}), "id": issue_id}
+            deleted.discard(issue_id)
+        STORAGE.apply_issues(list(changed.values()), deleted)
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for issue in self.issues.values():
+                f.write(json.dumps({"op": "create", "id": issue["id"], "fields": issue, "ts": time.time()},
+                                   ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self.records = len(self.issues)
+
+    async def ensure_loaded(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        if not self.loaded:
+            async with self.lock:
+                if not self.loaded:
+                    await run_io(self._load)
+
+    async def commit(self, records):
+        """Дописывает записи одним вызовом и применяет их к индексам.
+
+        records — список или функция, которая строит его по текущему состоянию под блокировкой.
+        Записям create с id None номер выдаётся здесь же, под блокировкой: одновременные
+        создания (операторы, csv_write, сканер) не получат один и тот же id.
+        """
+        await self.ensure_loaded()
+        async with self.lock:
+            if callable(records):
+                records = records()
+            if not records:
+                return []
+            next_id = int(self.next_id(records))
+            for record in records:
+                if record["id"] is None:
+                    record["id"] = str(next_id)
+                    next_id += 1
+            await run_io(self._write, records)
+            return [self._apply(record) for record in records]
+
+    def next_id(self, records=()):
+        """Следующий свободный номер с учётом id, уже занятых в records"""
+        ids = [i for i in self.issues if i.isdigit()]
+        ids += [str(r["id"]) for r in records if r["id"] is not None and str(r["id"]).isdigit()]
+        return str(max(map(int, ids), default=0) + 1)
+
+    # --- операции ---
+    async def create(self, fields):
+        await self.ensure_loaded()
+        # полный набор колонок issues.csv, чтобы csv_read отдавал единообразные строки
+        fields = {**{f: "" for f in ISSUE_FIELDS}, **fields}
+        del fields["id"]
+        if not fields["date"]:
+            fields["date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        (issue,) = await self.commit([{"op": "create", "id": None, "fields": fields, "ts": time.time()}])
+        return issue
+
+    async def update(self, issue_id, fields):
+        await self.ensure_loaded()
+        issue_id = str(issue_id)
+        if issue_id not in self.issues:
+            raise KeyError(issue_id)
+        fields = {k: v for k, v in fields.items() if k != "id"}
+        (issue,) = await self.commit([{"op": "update", "id": issue_id, "fields": fields, "ts": time.time()}])
+        return issue
+
+    async def replace_all(self, rows):
+        """Совместимость с csv_write: в журнал попадают только реально изменившиеся строки"""
+        def build():
+            # под блокировкой журнала: разница считается с тем, что уже записано
+            records = []
+            seen = set()
+            for row in rows:
+                issue_id = str(row.get("id") or "")
+                if not issue_id:
+                    records.append({"op": "create", "id": None, "fields": {k: v for k, v in row.items() if k != "id"},
+                                    "ts": time.time()})
+                    continue
+                seen.add(issue_id)
+                current = self.issues.get(issue_id)
+                if current is None:
+                    records.append({"op": "create", "id": issue_id, "fields": dict(row, id=issue_id), "ts": time.time()})
+                else:
+                    changed = {k: v for k, v in row.items() if current.get(k) != v and k != "id"}
+                    if changed:
+                        records.append({"op": "update", "id": issue_id, "fields": changed, "ts": time.time()})
+            records += [{"op": "delete", "id": i, "ts": time.time()} for i in self.issues if i not in seen]
+            return records
+
+        return len(await self.commit(build))
+
+    def query(self, date_from=None, date_to=None, device_ip=None, master=None, severity=None,
+              offset=0, limit=100):
+        """Фильтры + постранично, новые сверху; возвращает (страница, всего найдено)"""
+        if device_ip:
+            ids = self.by_device.get(device_ip, set())
+            candidates = sorted(((self.issues[i].get("date", ""), i) for i in ids), reverse=True)
+        else:
+            lo = bisect.bisect_left(self.by_date, (date_from or "",))
+            hi = bisect.bisect_right(self.by_date, (date_to + "\uffff",)) if date_to else len(self.by_date)
+            candidates = reversed(self.by_date[lo:hi])
+        found = []
+        for date, issue_id in candidates:
+            issue = self.issues[issue_id]
+            if date_from and date < date_from:
+                continue
+            if date_to and date > date_to + "\uffff":
+                continue
+            if master and issue.get("master") != master:
+                continue
+            if severity and issue.get("severity_type") != severity:
+                continue
+            found.append(issue)
+        return found[offset:offset + limit], len(found)
+
+    def rows(self):
+        return sorted(self.issues.values(), key=lambda i: (int(i["id"]) if i["id"].isdigit() else 0, i["id"]))
+
+
+ISSUES = IssueJournal(ISSUES_JOURNAL_PATH, ISSUES_CSV_PATH)
+
+
+# === АВТОМАТИЧЕСКИЕ ПРОБЛЕМЫ ПО РЕЗУЛЬТАТАМ СКАНЕРА ===
+class AutoIssues:
+    """Открывает проблему при переходе устройства из «доступно» в «недоступно».
+
+    - на устройство не больше одной открытой автоматической проблемы;
+    - если устройство упало снова в течение auto_issue_flap_window после
+      восстановления, переоткрывается прежняя проблема (с пометкой в call_history),
+      а не создаётся новая строка;
+    - при восстановлении проблема закрывается;
+    - все изменения одного прохода сканера уходят в журнал одной записью на диск.
+    Состояние восстанавливается из журнала по полям auto / status / closed.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.open = {}    # ip -> id открытой проблемы
+        self.closed = {}  # ip -> (id, время закрытия)
+        self.restored = False
+
+    async def restore(self):
+        await self.journal.ensure_loaded()
+        for issue in self.journal.issues.values():
+            if issue.get("auto") != "1" or not issue.get("device_ip"):
+                continue
+            if issue.get("status") == "open":
+                self.open[issue["device_ip"]] = issue["id"]
+            elif issue.get("closed"):
+                try:
+                    closed_at = datetime.strptime(issue["closed"], "%Y-%m-%d %H:%M:%S").timestamp()
+                except ValueError:
+                    continue
+                if closed_at > self.closed.get(issue["device_ip"], (None, 0))[1]:
+                    self.closed[issue["device_ip"]] = (issue["id"], closed_at)
+        self.restored = True
+
+    @staticmethod
+    def _description(ip, dev):
+        cut = TOPOLOGY.blast_radius(ip)[2]
+        text = f"{ip} ({dev.get('name', '')}) down"
+        return f"{text}, за ним без связи {len(cut)} устр." if cut else text
+
+    @staticmethod
+    def _note(issue, text):
+        history = issue.get("call_history") or ""
+        return f"{history}; {text}" if history else text
+
+    async def process(self, transitions):
+        """transitions: [(dev, typ, ok)] — устройства, у которых на карте сменился pingok"""
+        if not CONFIG["auto_issues"] or not transitions:
+            return
+        if not self.restored:
+            await self.restore()
+        now = time.time()
+        stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        records = []
+        created = []  # (номер записи, ip): id выдаст журнал
+        for dev, typ, ok in transitions:
+            ip = dev["ip"]
+            if ok:
+                issue_id = self.open.pop(ip, None)
+                if issue_id and issue_id in self.journal.issues:
+                    issue = self.journal.issues[issue_id]
+                    records.append({"op": "update", "id": issue_id, "ts": now, "fields": {
+                        "status": "closed", "closed": stamp,
+                        "call_history": self._note(issue, f"{stamp} восстановлен")}})
+                    self.closed[ip] = (issue_id, now)
+                continue
+
+            if ip in self.open:
+                continue  # уже есть открытая проблема — дубликат не нужен
+            issue_id, closed_at = self.closed.get(ip, (None, 0))
+            if issue_id in self.journal.issues and now - closed_at < CONFIG["auto_issue_flap_window"]:
+                # «моргающее» устройство: переоткрываем прежнюю проблему
+                issue = self.journal.issues[issue_id]
+                records.append({"op": "update", "id": issue_id, "ts": now, "fields": {
+                    "status": "open", "closed": "",
+                    "flaps": str(int(issue.get("flaps") or 0) + 1),
+                    "call_history": self._note(issue, f"{stamp} снова недоступен")}})
+            else:
+                issue_id = None
+                created.append((len(records), ip))
+                fields = {f: "" for f in ISSUE_FIELDS if f != "id"}
+                fields.update({
+                    "date": stamp, "created": stamp,
+                    "description": self._description(ip, dev),
+                    "master": dev.get("master", ""),
+                    "severity_type": CONFIG["auto_issue_severity"],
+                    "device_type": "switch" if typ == "switches" else "plan_switch",
+                    "device_id": dev.get("id", ""), "device_name": dev.get("name", ""), "device_ip": ip,
+                    "auto": "1", "status": "open", "closed": "", "flaps": "0"
+                })
+                records.append({"op": "create", "id": issue_id, "ts": now, "fields": fields})
+            self.open[ip] = issue_id
+
+        if records:
+            try:
+                issues = await self.journal.commit(records)
+            except Exception:
+                for _, ip in created:
+                    self.open.pop(ip, None)  # не записано — при следующем переходе попробуем снова
+                raise
+            for index, ip in created:
+                self.open[ip] = issues[index]["id"]
+            log(f"Auto issues: {len(records)} changes")
+
+
+AUTO_ISSUES = AutoIssues(ISSUES)
+
+
+# === СПРАВОЧНИК ОПЕРАТОРОВ И ГРУПП ===
+USERS_PATH = os.path.join(OPERATORS_DIR, "users.json")
+GROUPS_PATH = os.path.join(OPERATORS_DIR, "groups.json")
+
+
+class OperatorDirectory:
+    """users.json и groups.json в памяти с индексами по login и id.
+
+    Файл перечитывается, только если изменились его mtime/размер (правка извне)
+    или после save_operators/save_groups. last_activity копится в памяти и
+    сбрасывается на диск одной записью раз в activity_flush_interval секунд.
+    """
+
+    def __init__(self):
+        self.users = []
+        self.by_login = {}
+        self.by_id = {}
+        self.groups = []
+        self.groups_by_id = {}
+        self.stats = {USERS_PATH: None, GROUPS_PATH: None}
+        self.activity = {}  # id оператора -> last_activity, ещё не записанное на диск
+        self.generation = 0  # растёт при каждой перезагрузке — сессии пересчитывают права
+        self.task = None
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return doc_stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _set_users(self, users):
+        self.generation += 1
+        self.users = users if isinstance(users, list) else []
+        # при повторах логина или id побеждает первая запись — как при прежнем поиске перебором
+        self.by_login = {u.get("login"): u for u in reversed(self.users) if u.get("login")}
+        self.by_id = {u.get("id"): u for u in reversed(self.users) if u.get("id") is not None}
+        for user_id, stamp in self.activity.items():
+            if user_id in self.by_id:
+                self.by_id[user_id]["last_activity"] = stamp
+
+    def _set_groups(self, groups):
+        self.generation += 1
+        self.groups = groups if isinstance(groups, list) else []
+        self.groups_by_id = {g.get("id"): g for g in self.groups if g.get("id") is not None}
+
+    async def _refresh(self, path, setter, default):
+        stat = await run_io(self._stat, path)
+        if stat == self.stats[path]:
+            return
+        data = await load_json(path, default) if stat else default
+        self.stats[path] = stat
+        setter(data)
+
+    async def ensure_users(self):
+        """False — файла users.json нет"""
+        await self._refresh(USERS_PATH, self._set_users, [])
+        return self.stats[USERS_PATH] is not None
+
+    async def ensure_groups(self):
+        await self._refresh(GROUPS_PATH, self._set_groups, [])
+
+    def permissions(self, user):
+        """Права группы оператора; явно заданные у самого оператора имеют приоритет"""
+        merged = dict(self.groups_by_id.get(user.get("group"), {}).get("permissions") or {})
+        merged.update(user.get("permissions") or {})
+        return merged
+
+    @staticmethod
+    def public(user):
+        return {k: v for k, v in user.items() if k != "password"}
+
+    async def authenticate(self, login, password_hash):
+        """Оператор без пароля или None"""
+        await self.ensure_users()
+        user = self.by_login.get(login)
+        if not user or not hmac.compare_digest(str(user.get("password", "")), str(password_hash)):
+            return None
+        stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        user["last_activity"] = stamp
+        if user.get("id") is not None:
+            self.activity[user["id"]] = stamp
+        return self.public(user)
+
+    async def list_users(self):
+        await self.ensure_users()
+        return [self.public(u) for u in self.users]
+
+    async def save_users(self, users):
+        self._set_users(users)  # накопленные last_activity переносятся в новый список
+        self.activity.clear()
+        async with path_lock(USERS_PATH):
+            written = WRITER.submit(USERS_PATH, self.users)
+        await written
+        self.stats[USERS_PATH] = await run_io(self._stat, USERS_PATH)
+
+    async def save_groups(self, groups):
+        async with path_lock(GROUPS_PATH):
+            written = WRITER.submit(GROUPS_PATH, groups)
+            self._set_groups(groups)
+        await written
+        self.stats[GROUPS_PATH] = await run_io(self._stat, GROUPS_PATH)
+
+    def invalidate(self, file_path):
+        """Файл записан в обход справочника (file_put) — перечитать при следующем обращении"""
+        if file_path in self.stats:
+            self.stats[file_path] = None
+
+    async def flush(self):
+        if not self.activity:
+            return
+        await self.ensure_users()
+        pending, self.activity = self.activity, {}
+        async with path_lock(USERS_PATH):
+            written = WRITER.submit(USERS_PATH, self.users)
+        try:
+            await written
+        except Exception:
+            # не потерять отметки: вернуть их в очередь, новые важнее старых
+            pending.update(self.activity)
+            self.activity = pending
+            raise
+        self.stats[USERS_PATH] = await run_io(self._stat, USERS_PATH)
+        log_action(f"last_activity flushed: {len(pending)} operators")
+
+    def flush_sync(self):
+        # при остановке процесса event loop уже может не работать
+        WRITER.flush_sync()  # сначала очередь — иначе она перезапишет users.json старой версией
+        if self.activity and self.users:
+            write_json(USERS_PATH, self.users)
+            self.activity.clear()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(CONFIG["activity_flush_interval"])
+            try:
+                await self.flush()
+            except Exception as e:
+                log(f"last_activity flush error: {e}", "ERROR")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_loop())
+            atexit.register(self.flush_sync)
+
+
+OPERATORS = OperatorDirectory()
+
+
+# === СЕССИИ И ПРАВА ===
+# Действия без входа; остальные требуют сессию на этом подключении
+PUBLIC_ACTIONS = {"auth_login", "resume_session", "logout", "cancel"}
+# Управление сервером из GUI на той же машине (GUI не логинится)
+LOCAL_ACTIONS = {"scanner_status", "scanner_config", "backup_now", "backup_status", "server_stats",
+                 "server_shutdown"}
+LOOPBACK_IPS = {"127.0.0.1", "::1", "localhost"}
+
+# Действие -> право из permissions группы; None — достаточно войти
+ACTION_PERMISSIONS = {
+    "file_put": "edit_maps",
+    "map_patch": "edit_maps",
+    "save_model": "edit_maps",
+    "delete_model": "edit_maps",
+    "upload_image": "edit_maps",
+    "save_engineers": "edit_maps",
+    "save_masters": "edit_maps",
+    "save_firmwares": "edit_maps",
+    "save_mngmt_vlan": "edit_maps",
+    "list_operators": "view_operators",
+    "save_operators": "edit_operators",
+    "save_groups": "edit_operators",
+    "scanner_config": "edit_operators",
+    "server_stats": "edit_operators",
+    "backup_now": "edit_operators",
+    "backup_status": "edit_operators",
+    "issue_query": "view_global_problems",
+    "issue_create": "add_global_problems",
+    "issue_update": "add_global_problems",
+}
 
-    try:
-        async for message in websocket:
-            # Prepare a default response in case something goes wrong before we set it
-            response = {"request_id": None, "success": False, "error": "Unknown action"}
 
+def required_permission(action, data):
+    """Право для действия с учётом пути: operators/* и issues.csv защищены отдельно"""
+    if action in ("file_get", "file_put", "csv_read", "csv_write", "backup_restore"):
+        write = action in ("file_put", "csv_write", "backup_restore")
+        try:
+            path = get_full_path(data.get("path") or data.get("filename") or "")
+        except (ValueError, TypeError):
+            return None  # путь всё равно будет отклонён проверкой схемы или обработчиком
+        if path.startswith(OPERATORS_DIR + os.sep):
+            return "edit_operators" if write else "view_operators"
+        if path == ISSUES_CSV_PATH:
+            return "add_global_problems" if write else "view_global_problems"
+        return "edit_maps" if write else None
+    return ACTION_PERMISSIONS.get(action)
+
+
+class Session:
+    __slots__ = ("token", "user_id", "login", "permissions", "generation", "expires")
+
+    def __init__(self, token, user):
+        self.token = token
+        self.user_id = user.get("id")
+        self.login = user.get("login")
+        self.permissions = {}
+        self.generation = -1
+        self.expires = 0
+
+
+class SessionStore:
+    """Сессии операторов: токен для повторного подключения без пароля и кэш прав.
+
+    Права пересчитываются из OPERATORS только при смене его generation
+    (save_operators/save_groups/правка файла), поэтому проверка — поиск в словаре.
+    Сессии живут в памяти: после перезапуска сервера нужен обычный вход.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sessions = {}  # token -> Session
+
+    def _touch(self, session):
+        session.expires = time.time() + CONFIG["session_ttl_hours"] * 3600
+
+    def _sync(self, session):
+        """False — оператор удалён"""
+        if session.generation != self.directory.generation:
+            user = self.directory.by_id.get(session.user_id) or self.directory.by_login.get(session.login)
+            if user is None:
+                return False
+            session.permissions = self.directory.permissions(user)
+            session.generation = self.directory.generation
+        return True
+
+    def create(self, user):
+        session = Session(secrets.token_urlsafe(32), user)
+        self._touch(session)
+        self._sync(session)
+        self.sessions[session.token] = session
+        self._expire()
+        return session
+
+    def resume(self, token):
+        session = self.sessions.get(token)
+        if session is None or session.expires < time.time() or not self._sync(session):
+            self.sessions.pop(token, None)
+            return None
+        self._touch(session)
+        return session
+
+    def drop(self, token):
+        self.sessions.pop(token, None)
+
+    def _expire(self):
+        now = time.time()
+        for token in [t for t, s in self.sessions.items() if s.expires < now]:
+            del self.sessions[token]
+
+    def check(self, conn, action, data):
+        """Текст ошибки, если действие запрещено, иначе None"""
+        if not CONFIG["auth_required"] or action in PUBLIC_ACTIONS:
+            return None
+        if action in LOCAL_ACTIONS and conn.client_ip in LOOPBACK_IPS:
+            return None
+        session = conn.session
+        if session is None:
+            return "Требуется вход"
+        if session.expires < time.time() or not self._sync(session):
+            conn.session = None
+            self.drop(session.token)
+            return "Сессия истекла, войдите снова"
+        permission = required_permission(action, data)
+        if permission and not session.permissions.get(permission):
+            return f"Недостаточно прав: {permission}"
+        return None
+
+
+SESSIONS = SessionStore(OPERATORS)
+
+
+# === ПОДПИСКИ НА СТАТУС ПИНГА ===
+PING_SUBSCRIBERS = {}  # полный путь карты -> set(websocket)
+
+
+def map_ping_states(map_data):
+    """pingok всех устройств карты: [{"id", "type", "ip", "pingok"}]"""
+    return [{"id": dev["id"], "type": typ, "ip": dev.get("ip"), "pingok": dev.get("pingok")}
+            for typ in ("switches", "plan_switches")
+            for dev in map_data.get(typ, []) if dev.get("id")]
+
+
+def publish_ping_changes(file_path, changes):
+    """Одна рассылка всем подписчикам карты: сообщение сериализуется один раз"""
+    subscribers = PING_SUBSCRIBERS.get(file_path)
+    if not subscribers or not changes:
+        return
+    message = json.dumps({
+        "action": "ping_update",
+        "path": os.path.relpath(file_path, DATA_DIR).replace(os.sep, "/"),
+        "changes": changes
+    }, ensure_ascii=False)
+    websockets.broadcast(subscribers, message)
+
+
+def unsubscribe_all(websocket):
+    for file_path in list(PING_SUBSCRIBERS):
+        subscribers = PING_SUBSCRIBERS[file_path]
+        subscribers.discard(websocket)
+        if not subscribers:
+            del PING_SUBSCRIBERS[file_path]
+
+
+# === СОСТОЯНИЕ УСТРОЙСТВ ===
+DEVICE_STATE = {}  # ip -> {"ip", "success", "rtt_ms", "checked", "changed", "unreachable", "via"}
+
+
+def record_ping(result):
+    """Результат PingScanner в таблицу состояний; True — если статус изменился (разовые проверки — record_probe)"""
+    now = time.time()
+    state = DEVICE_STATE.get(result["ip"])
+    changed = state is None or state["success"] != result["success"]
+    DEVICE_STATE[result["ip"]] = {
+        "ip": result["ip"],
+        "success": result["success"],
+        "rtt_ms": result.get("rtt_ms"),
+        "checked": now,
+        "changed": now if changed else state["changed"],
+        # не пинговался: все вышестоящие устройства недоступны (см. NetworkTopology)
+        "unreachable": result.get("unreachable", False),
+        "via": result.get("via", [])
+    }
+    HISTORY.record(result, now)
+    return changed
+
+
+def record_probe(result):
+    """Разовая проверка по запросу клиента (ping, ping_switches): только в историю.
+
+    DEVICE_STATE меняет один PingScanner — с повторами scan_confirm_* и обычным таймаутом;
+    иначе пинг с таймаутом клиента (хоть 0) объявил бы устройство недоступным, а по нему
+    dead_parents — и всё, что ниже."""
+    HISTORY.record(result, time.time())
+
+
+def is_down(ip):
+    state = DEVICE_STATE.get(ip)
+    return state is not None and state["success"] is False
+
+
+def fresh_state(ip, max_age_ms):
+    state = DEVICE_STATE.get(ip)
+    if state and max_age_ms > 0 and (time.time() - state["checked"]) * 1000 <= max_age_ms:
+        return state
+    return None
+
+
+async def probe_device(ip):
+    """Проверка для сканера: до packet_count попыток с паузой packet_interval"""
+    result = None
+    for attempt in range(max(1, CONFIG["packet_count"])):
+        if attempt:
+            await asyncio.sleep(CONFIG["packet_interval"] / 1000)
+        result = await ping_device(ip, CONFIG["ping_timeout_ms"])
+        if result["success"]:
+            break
+    return result
+
+
+# === ИСТОРИЯ ПРОВЕРОК ===
+class PingHistory:
+    """Каждая проверка (сканер, ping, ping_switches) попадает в HistoryStore (см. history_store.py).
+
+    В event loop — только запись в кольцо в памяти; на диск раз в
+    history_flush_interval одной пачкой в пуле ввода-вывода. Запросы тоже в пуле:
+    к записанному на диск добавляются ещё не сброшенные проверки из памяти.
+    """
+
+    def __init__(self):
+        self.store = HistoryStore(HISTORY_DIR)
+        self.task = None
+        self.flushed = 0
+
+    def record(self, result, now):
+        if not CONFIG["history_enabled"]:
+            return
+        if result.get("unreachable"):
+            status = UNREACHABLE
+        else:
+            status = UP if result["success"] else DOWN
+        self.store.record(result["ip"], now, result.get("rtt_ms"), status)
+
+    async def flush(self):
+        batch = self.store.take_pending()
+        if not batch:
+            return
+        errors = await run_io(self.store.flush, batch)
+        self.flushed += len(batch) - len(errors)
+        for ip, error in list(errors.items())[:5]:
+            log(f"History: error writing {ip}: {error}", "ERROR")
+
+    def flush_sync(self):
+        self.store.flush(self.store.take_pending())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(CONFIG["history_flush_interval"])
             try:
-                try:
-                    data = json.loads(message)
-                except json.JSONDecodeError:
-                    # Cannot parse JSON — respond with generic error (no request_id available)
-                    await websocket.send(json.dumps({"request_id": None, "success": False, "error": "Invalid JSON"}, ensure_ascii=False))
-                    continue
+                await self.flush()
+            except Exception as e:
+                log(f"History flush error: {e}", "ERROR")
+
+    def start(self):
+        if self.task is None:
+            self.store.memory_samples = max(8, CONFIG["history_memory_samples"])
+            self.task = asyncio.create_task(self._flush_loop())
+            atexit.register(self.flush_sync)
+
+    async def device(self, ip, start, end, outages=True):
+        return await run_io(self.store.summary, ip, start, end, self.store.recent(ip), outages)
+
+    async def devices(self, ips, start, end):
+        recent = {ip: self.store.recent(ip) for ip in ips}
+        return await run_io(lambda: [self.store.summary(ip, start, end, recent[ip], outages=False) for ip in ips])
+
+
+HISTORY = PingHistory()
+
+
+def parse_time(value, default):
+    """unix-время или строка «YYYY-MM-DD[ HH:MM[:SS]]» (локальное время сервера)"""
+    if value is None or value == "":
+        return int(default)
+    if isinstance(value, (int, float)):
+        return int(value)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            pass
+    raise ValueError(f"Bad time: {value}")
+
+
+# === ТОПОЛОГИЯ СЕТИ ===
+class NetworkTopology:
+    """Граф связей из magistrals всех карт.
+
+    Магистраль направлена от startid (вышестоящее устройство) к endid. Узел —
+    устройство с IP (одно и то же IP на разных картах — один узел, так карты
+    связываются между собой) или, без IP, пара (карта, id): мыльницы и
+    устройства без адреса только передают связь дальше.
+    Для сканера считаются ближайшие вышестоящие устройства с IP (parents) и
+    глубина от корня (depth): проверка идёт волнами от корня к краю сети.
+    Граф пересобирается, только если изменилась какая-то карта.
+    """
+
+    def __init__(self):
+        self.maps = {}      # путь карты -> (версия документа в DOC_CACHE, узлы, связи)
+        self.changed = False
+        self.up = {}        # узел -> set(узлы выше)
+        self.down = {}      # узел -> set(узлы ниже)
+        self.devices = {}   # ip -> {"name", "maps"}
+        self.parents = {}   # ip -> set(ближайшие вышестоящие ip)
+        self.depth = {}     # ip -> глубина от корня
+
+    @staticmethod
+    def _extract(data):
+        nodes = {}  # id -> (ip или None, имя)
+        for collection in DEVICE_COLLECTIONS + ("soaps",):
+            for item in data.get(collection) or []:
+                if isinstance(item, dict) and item.get("id") is not None:
+                    ip = item.get("ip")
+                    nodes[item["id"]] = (ip if ip and ip != "—" else None, item.get("name", ""))
+        links = [(m["startid"], m["endid"]) for m in data.get("magistrals") or []
+                 if isinstance(m, dict) and m.get("startid") and m.get("endid")]
+        return nodes, links
+
+    def update_map(self, file_path, entry):
+        known = self.maps.get(file_path)
+        if known and known[0] == entry.version:
+            return
+        self.maps[file_path] = (entry.version, *self._extract(entry.data))
+        self.changed = True
+
+    def retain(self, paths):
+        for file_path in set(self.maps) - set(paths):
+            del self.maps[file_path]
+            self.changed = True
+
+    def resolve(self, file_path, device_id):
+        """Узел графа для устройства карты"""
+        known = self.maps.get(file_path)
+        ip = known[1].get(device_id, (None, ""))[0] if known else None
+        return ip or (file_path, device_id)
+
+    def rebuild(self):
+        if not self.changed:
+            return
+        self.changed = False
+        up, down, devices = {}, {}, {}
+        for file_path, (_, nodes, links) in self.maps.items():
+            name = os.path.basename(file_path)
+            for ip, dev_name in nodes.values():
+                if ip:
+                    info = devices.setdefault(ip, {"name": dev_name, "maps": []})
+                    if name not in info["maps"]:  # одно IP у нескольких устройств карты
+                        info["maps"].append(name)
+            for start, end in links:
+                a, b = self.resolve(file_path, start), self.resolve(file_path, end)
+                if a != b:
+                    down.setdefault(a, set()).add(b)
+                    up.setdefault(b, set()).add(a)
+        self.up, self.down, self.devices = up, down, devices
+        self.parents = {ip: self._nearest_ips(ip, up) for ip in devices}
+
+        # глубина: обход в ширину от корней; узлы в кольцах без корня — сами себе корни
+        children = {ip: self._nearest_ips(ip, down) for ip in devices}
+        self.depth = {}
+        pending = [ip for ip in sorted(devices) if not self.parents[ip]]
+        rest = iter(sorted(devices))
+        while True:
+            level = [ip for ip in pending if ip not in self.depth]
+            if not level:
+                level = [next((ip for ip in rest if ip not in self.depth), None)]
+                if level[0] is None:
+                    break
+            depth = 0
+            while level:
+                for ip in level:
+                    self.depth[ip] = depth
+                level = sorted({c for ip in level for c in children[ip] if c not in self.depth})
+                depth += 1
+            pending = []
+
+    @staticmethod
+    def _nearest_ips(node, links):
+        """Ближайшие по связям узлы с IP (узлы без IP проходятся насквозь)"""
+        found, seen = set(), {node}
+        stack = list(links.get(node, ()))
+        while stack:
+            other = stack.pop()
+            if other in seen:
+                continue
+            seen.add(other)
+            if isinstance(other, str):
+                found.add(other)
+            else:
+                stack.extend(links.get(other, ()))
+        return found
+
+    @staticmethod
+    def _reach(starts, links, exclude=None):
+        seen = set()
+        stack = [n for n in starts if n != exclude]
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            stack.extend(n for n in links.get(node, ()) if n != exclude and n not in seen)
+        return seen
+
+    def waves(self, ips):
+        """Адреса, сгруппированные по глубине: сначала ближе к корню"""
+        levels = {}
+        for ip in ips:
+            levels.setdefault(self.depth.get(ip, 0), []).append(ip)
+        return [levels[depth] for depth in sorted(levels)]
+
+    def dead_parents(self, ip):
+        """Вышестоящие ip, если все они недоступны, иначе None"""
+        parents = self.parents.get(ip)
+        if parents and all(is_down(p) for p in parents):
+            return sorted(parents)
+        return None
+
+    def dependents(self, ip):
+        """Ближайшие нижестоящие ip"""
+        return self._nearest_ips(ip, self.down)
+
+    def blast_radius(self, node):
+        """(выше, ниже, отрезаны): отрезаны — устройства ниже node, к которым нет пути от корня в обход node"""
+        above = self._reach(self.up.get(node, ()), self.up)
+        below = self._reach(self.down.get(node, ()), self.down)
+        nodes = set(self.up) | set(self.down) | set(self.devices)
+        # корни — как в rebuild(): узлы без связей выше и устройства глубины 0 (корни колец)
+        roots = {n for n in nodes if not self.up.get(n)} | {n for n in self.devices if self.depth.get(n) == 0}
+        if not any(not self.up.get(n) for n in above):
+            # node сам в кольце без корня: остальные узлы кольца питаются друг от друга
+            roots |= above & below
+        alive = self._reach(roots, self.down, exclude=node)
+        ips = lambda group: {n for n in group if isinstance(n, str) and n != node}
+        return ips(above), ips(below), ips(below - alive)
+
+
+TOPOLOGY = NetworkTopology()
+
+
+# === ФОНОВЫЙ СКАНЕР ===
+class PingScanner:
+    """Пингует все устройства всех карт внутри процесса сервера.
+
+    Адреса собираются в один набор без повторов, результаты попадают в DEVICE_STATE,
+    а карты переписываются (под path_lock, через DOC_CACHE) только если у
+    устройства изменился pingok — с рассылкой подписчикам.
+
+    У каждого IP свой срок следующей проверки (schedule):
+    - стабильно доступные: интервал растёт от scan_interval до scan_up_max_interval;
+    - первая неудача: scan_confirm_count повторов через scan_confirm_interval,
+      и только потом устройство объявляется недоступным;
+    - недоступные: интервал удваивается от scan_down_min_interval до scan_down_max_interval;
+    - при смене статуса интервал сбрасывается к началу.
+
+    Проверка идёт волнами по глубине TOPOLOGY. Если все вышестоящие устройства
+    недоступны, устройство не пингуется (ждать таймаут бессмысленно), а
+    помечается unreachable с перечнем via; раз в scan_down_max_interval оно всё
+    же проверяется на случай неполной схемы. При первой потере связи
+    вышестоящие устройства ставятся на проверку сразу, раньше подтверждения.
+    """
+
+    TARGETS_REFRESH = 5  # как часто (с) пересобирать список адресов с карт
+
+    def __init__(self):
+        self.task = None
+        self.wakeup = None
+        self.running = False
+        self.last_cycle = {}
+        self.targets = {}
+        self.targets_at = 0
+        self.schedule = {}  # ip -> {"due", "interval", "fails"}
+        self.probes = 0
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def trigger(self):
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def collect_targets(self):
+        """ip -> set(путь карты); заодно обновляет TOPOLOGY"""
+        targets = {}
+        paths = []
+        for name in await run_io(list_json_files, MAPS_DIR):
+            file_path = os.path.join(MAPS_DIR, name)
+            paths.append(file_path)
+            try:
+                entry = await DOC_CACHE.get(file_path)
+            except Exception as e:
+                log(f"Scanner: error reading {name}: {e}", "WARNING")
+                continue
+            TOPOLOGY.update_map(file_path, entry)
+            for typ in ("switches", "plan_switches"):
+                for dev in entry.data.get(typ, []):
+                    ip = dev.get("ip")
+                    if ip and ip != "—":
+                        targets.setdefault(ip, set()).add(file_path)
+        TOPOLOGY.retain(paths)
+        TOPOLOGY.rebuild()
+        return targets
+
+    async def probe_all(self, ips):
+        semaphore = asyncio.Semaphore(CONFIG["scan_concurrency"])
+
+        async def probe(ip):
+            async with semaphore:
+                return await probe_device(ip)
+
+        return await asyncio.gather(*(probe(ip) for ip in ips))
+
+    async def apply_to_map(self, file_path):
+        """Переносит DEVICE_STATE в pingok карты; пишет файл только при изменениях.
+
+        Возвращает [(устройство, тип, новый pingok)] для переходов, где прежний pingok был известен.
+        """
+        transitions = []
+        async with path_lock(file_path):
+            try:
+                entry = await DOC_CACHE.get(file_path)
+            except Exception as e:
+                log(f"Scanner: error reading {file_path}: {e}", "WARNING")
+                return transitions
+            await WRITER.settled(file_path)
+            changes = []
+            for typ in ("switches", "plan_switches"):
+                for dev in entry.data.get(typ, []):
+                    state = DEVICE_STATE.get(dev.get("ip"))
+                    if state and dev.get("pingok") != state["success"]:
+                        if isinstance(dev.get("pingok"), bool):
+                            transitions.append((dev, typ, state["success"]))
+                        dev["pingok"] = state["success"]
+                        changes.append({"id": dev.get("id"), "type": typ, "ip": dev["ip"], "pingok": state["success"],
+                                        "unreachable": state["unreachable"]})
+            if not changes:
+                return transitions
+            written = WRITER.submit(file_path, entry.data)
+            await DOC_CACHE.put(file_path, entry.data)
+        try:
+            await written
+        except Exception as e:
+            log(f"Scanner: error writing {file_path}: {e}", "ERROR")
+            return transitions
+        publish_ping_changes(file_path, changes)
+        return transitions
+
+    def reschedule(self, ip, result, now):
+        """Обновляет срок следующей проверки; возвращает итоговый статус или None, пока идёт подтверждение"""
+        entry = self.schedule.setdefault(ip, {"due": now, "interval": 0, "fails": 0})
+        state = DEVICE_STATE.get(ip)
+        was_up = state["success"] if state else None
+
+        if result["success"]:
+            entry["fails"] = 0
+            if was_up:
+                entry["interval"] = min(max(entry["interval"], CONFIG["scan_interval"]) * 1.5,
+                                        CONFIG["scan_up_max_interval"])
+            else:
+                entry["interval"] = CONFIG["scan_interval"]
+            entry["due"] = now + entry["interval"]
+            return True
+
+        entry["fails"] += 1
+        if was_up is not False and entry["fails"] <= CONFIG["scan_confirm_count"]:
+            # одна потеря — ещё не авария: быстро перепроверяем
+            entry["due"] = now + CONFIG["scan_confirm_interval"]
+            return None
+        if was_up is False:
+            entry["interval"] = min(max(entry["interval"], CONFIG["scan_down_min_interval"] / 2) * 2,
+                                    CONFIG["scan_down_max_interval"])
+        else:
+            entry["interval"] = CONFIG["scan_down_min_interval"]
+        entry["due"] = now + entry["interval"]
+        return False
 
-                action = data.get("action")
-                request_id = data.get("request_id")
-                response = {"request_id": request_id, "success": False, "error": "Unknown action"}
+    async def refresh_targets(self, force=False):
+        now = time.time()
+        if not force and now - self.targets_at < self.TARGETS_REFRESH:
+            return
+        self.targets = await self.collect_targets()
+        self.targets_at = now
+        for ip in list(self.schedule):
+            if ip not in self.targets:
+                del self.schedule[ip]
+
+    async def run_due(self):
+        """Проверяет только адреса, у которых подошёл срок"""
+        await self.refresh_targets()
+        now = time.time()
+        due = [ip for ip in self.targets if ip not in self.schedule or self.schedule[ip]["due"] <= now]
+        if not due:
+            return
+        start = time.time()
+        results = []
+        probed = set()
+        changed_maps = set()
+        confirming = 0
+        unreachable = 0
+        for wave in TOPOLOGY.waves(due):
+            now = time.time()
+            to_probe = []
+            for ip in wave:
+                via = TOPOLOGY.dead_parents(ip) if CONFIG["scan_dependencies"] else None
+                last_probe = self.schedule.get(ip, {}).get("probed", now)
+                if via and now - last_probe < CONFIG["scan_down_max_interval"]:
+                    self.mark_unreachable(ip, via, now)
+                    changed_maps |= self.targets.get(ip, set())
+                    unreachable += 1
+                else:
+                    to_probe.append(ip)
+            wave_results = await self.probe_all(to_probe)
+            self.probes += len(wave_results)
+            probed.update(to_probe)
+            results += wave_results
+
+            now = time.time()
+            for result in wave_results:
+                ip = result["ip"]
+                was_down = is_down(ip)
+                status = self.reschedule(ip, result, now)
+                self.schedule[ip]["probed"] = now
+                if not status:
+                    self.check_upstream(ip, probed, now)
+                if status is None:
+                    # статус ещё не подтверждён, но в историю проверка попадает
+                    HISTORY.record(result, now)
+                    confirming += 1
+                    continue
+                if status and was_down:
+                    self.wake_dependents(ip, now)
+                record_ping(result)
+                changed_maps |= self.targets.get(ip, set())
+        # сверяем все карты с этими устройствами: заодно исправляется pingok, затёртый file_put
+        transitions = {}
+        for file_path in changed_maps:
+            for dev, typ, ok in await self.apply_to_map(file_path):
+                transitions.setdefault(dev["ip"], (dev, typ, ok))  # устройство на нескольких картах — один раз
+        # за недоступным узлом проблемы не открываются: причина одна — он сам
+        transitions = [t for t in transitions.values() if t[2] or not DEVICE_STATE[t[0]["ip"]]["unreachable"]]
+        try:
+            await AUTO_ISSUES.process(transitions)
+        except Exception as e:
+            log(f"Auto issues error: {e}", "ERROR")
+
+        up = sum(1 for r in results if r["success"])
+        self.last_cycle = {
+            "finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": round(time.time() - start, 2),
+            "devices": len(self.targets),
+            "probed": len(results),
+            "up": sum(1 for ip in self.targets if DEVICE_STATE.get(ip, {}).get("success")),
+            "down": sum(1 for ip in self.targets if DEVICE_STATE.get(ip, {}).get("success") is False),
+            "confirming": confirming,
+            "unreachable": unreachable
+        }
+        log(f"Scan: probed {len(results)} of {len(self.targets)} ({up} ok, {confirming} confirming, "
+            f"{unreachable} behind down uplinks) in {self.last_cycle['duration']}s", "DEBUG")
+
+    def mark_unreachable(self, ip, via, now):
+        """Все вышестоящие недоступны: не пингуем, проверим снова вместе с ними"""
+        entry = self.schedule.setdefault(ip, {"due": now, "interval": 0, "fails": 0})
+        entry["due"] = now + CONFIG["scan_down_min_interval"]
+        entry.setdefault("probed", now)  # отсчёт до контрольной проверки — с первого пропуска
+        record_ping({"ip": ip, "success": False, "rtt_ms": None, "unreachable": True, "via": via})
+
+    def check_upstream(self, ip, probed, now):
+        """Потеря связи: вышестоящие, не проверенные в этом проходе, — на проверку немедленно"""
+        for parent in TOPOLOGY.parents.get(ip, ()):
+            entry = self.schedule.get(parent)
+            if parent not in probed and entry and not is_down(parent):
+                entry["due"] = min(entry["due"], now)
+
+    def wake_dependents(self, ip, now):
+        """Устройство снова доступно: нижестоящие, помеченные unreachable, — проверить сразу"""
+        for child in TOPOLOGY.dependents(ip):
+            entry = self.schedule.get(child)
+            if entry and DEVICE_STATE.get(child, {}).get("unreachable"):
+                entry["due"] = now
+
+    def next_wakeup(self):
+        if not self.schedule:
+            return self.TARGETS_REFRESH
+        delay = min(entry["due"] for entry in self.schedule.values()) - time.time()
+        return max(0.2, min(delay, self.TARGETS_REFRESH))
+
+    def scan_now(self):
+        """Все устройства — на проверку немедленно"""
+        for entry in self.schedule.values():
+            entry["due"] = 0
+        self.targets_at = 0
+        self.trigger()
+
+    async def run(self):
+        while True:
+            delay = self.TARGETS_REFRESH
+            if CONFIG["scanner_enabled"]:
+                self.running = True
+                try:
+                    await self.run_due()
+                except Exception as e:
+                    log(f"Scanner error: {e}", "ERROR")
+                finally:
+                    self.running = False
+                delay = self.next_wakeup()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def status(self):
+        return {
+            "enabled": CONFIG["scanner_enabled"],
+            "running": self.running,
+            "interval": CONFIG["scan_interval"],
+            "devices": len(self.targets),
+            "probes_total": self.probes,
+            "last_cycle": self.last_cycle
+        }
+
+
+SCANNER = PingScanner()
+# настройка -> (допустимые типы, минимум); None — флаг
+SCANNER_SETTINGS = {
+    "ping_timeout_ms": ((int, float), 1),
+    "packet_count": (int, 1),
+    "packet_interval": ((int, float), 0),
+    "scan_interval": ((int, float), 1),
+    "scan_concurrency": (int, 1),
+    "scanner_enabled": (bool, None),
+    "scan_up_max_interval": ((int, float), 1),
+    "scan_confirm_interval": ((int, float), 1),
+    "scan_confirm_count": (int, 0),
+    "scan_down_min_interval": ((int, float), 1),
+    "scan_down_max_interval": ((int, float), 1),
+    "scan_dependencies": (bool, None),
+}
 
-                log(f"Action: {action} | Path: {data.get('path', data.get('filename', ''))} | Client: {client_ip}")
 
-                # === ПИНГ ===
-                if action == "ping":
-                    ip = data.get("ip")
-                    timeout = data.get("timeout", CONFIG["ping_timeout_ms"])
-                    if ip:
-                        result = ping_device(ip, timeout)
-                        response = {"request_id": request_id, **result}
-                    else:
-                        response["error"] = "IP not provided"
-
-                # === СПИСОК КАРТ ===
-                elif action == "list_maps":
-                    try:
-                        files = [f for f in os.listdir(MAPS_DIR) if f.endswith(".json")]
-                        response = {"request_id": request_id, "success": True, "files": files}
-                    except Exception as e:
-                        response["error"] = str(e)
-
-                # === ЧТЕНИЕ ФАЙЛА (универсально) ===
-                elif action == "file_get":
-                    path = data.get("path") or data.get("filename")
-                    if not path:
-                        response["error"] = "No path or filename"
-                    else:
-                        try:
-                            file_path = get_full_path(path)
-                        except Exception as e:
-                            response["error"] = f"Invalid path: {e}"
-                        else:
-                            if os.path.exists(file_path) and file_path.endswith(".json"):
-                                try:
-                                    with open(file_path, "r", encoding="utf-8") as f:
-                                        file_data = json.load(f)
-                                    response = {"request_id": request_id, "success": True, "data": file_data}
-                                except Exception as e:
-                                    response["error"] = f"Read error: {e}"
-                            else:
-                                response["error"] = "File not found or not JSON"
-
-                # === СОХРАНЕНИЕ ФАЙЛА (универсально) ===
-                elif action == "file_put":
-                    path = data.get("path") or data.get("filename")
-                    file_data = data.get("data")
-                    if not path or not isinstance(file_data, (dict, list)):
-                        response["error"] = "Invalid path or data"
-                    else:
-                        try:
-                            file_path = get_full_path(path)
-                        except Exception as e:
-                            response["error"] = f"Invalid path: {e}"
-                        else:
-                            try:
-                                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                                with open(file_path, "w", encoding="utf-8") as f:
-                                    json.dump(file_data, f, ensure_ascii=False, indent=4)
-                                response = {"request_id": request_id, "success": True}
-                            except Exception as e:
-                                response["error"] = f"Write error: {e}"
-
-                # === ЧТЕНИЕ CSV ===
-                elif action == "csv_read":
-                    path = data.get("path")
-                    if not path:
-                        response["error"] = "No path provided"
-                    else:
-                        csv_data = read_csv(path)
-                        response = {"request_id": request_id, "success": True, "data": csv_data}
-
-                # === ЗАПИСЬ CSV ===
-                elif action == "csv_write":
-                    path = data.get("path")
-                    csv_data = data.get("data")
-                    if not path or not isinstance(csv_data, list):
-                        response["error"] = "Invalid path or data"
-                    else:
-                        success = write_csv(path, csv_data)
-                        if success:
-                            response = {"request_id": request_id, "success": True}
-                        else:
-                            response["error"] = "Write error"
-
-                # === АУТЕНТИФИКАЦИЯ ===
-                elif action == "auth_login":
-                    login = data.get("login")
-                    password_hash = data.get("password_hash")
-                    if not login or not password_hash:
-                        response["error"] = "Логин и пароль обязательны"
-                    else:
-                        users_path = os.path.join(OPERATORS_DIR, "users.json")
-                        if not os.path.exists(users_path):
-                            response["error"] = "Пользователи не найдены"
-                        else:
-                            try:
-                                with open(users_path, "r", encoding="utf-8") as f:
-                                    users = json.load(f)
-                                user = next((u for u in users if u.get("login") == login), None)
-                                if user and user.get("password") == password_hash:
-                                    # Убираем пароль из ответа
-                                    safe_user = {k: v for k, v in user.items() if k != "password"}
-                                    safe_user["last_activity"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    # Обновляем last_activity
-                                    for u in users:
-                                        if u.get("id") == user.get("id"):
-                                            u["last_activity"] = safe_user["last_activity"]
-                                    with open(users_path, "w", encoding="utf-8") as f:
-                                        json.dump(users, f, ensure_ascii=False, indent=4)
-                                    response = {"request_id": request_id, "success": True, "user": safe_user}
-                                else:
-                                    response["error"] = "Неверный логин или пароль"
-                            except Exception as e:
-                                response["error"] = f"Ошибка: {e}"
-
-                # === ОПЕРАТОРЫ ===
-                elif action == "list_operators":
-                    users_path = os.path.join(OPERATORS_DIR, "users.json")
-                    if not os.path.exists(users_path):
-                        response["error"] = "Файл пользователей не найден"
-                    else:
-                        try:
-                            with open(users_path, "r", encoding="utf-8") as f:
-                                users = json.load(f)
-                            # не возвращаем пароли
-                            for u in users:
-                                u.pop("password", None)
-                            response = {"request_id": request_id, "success": True, "operators": users}
-                        except Exception as e:
-                            response["error"] = f"Ошибка чтения: {e}"
-
-                elif action == "save_operators":
-                    users = data.get("operators")
-                    users_path = os.path.join(OPERATORS_DIR, "users.json")
-                    try:
-                        with open(users_path, "w", encoding="utf-8") as f:
-                            json.dump(users, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи операторов: {e}"
-
-                # === ГРУППЫ ===
-                elif action == "list_groups":
-                    groups_path = os.path.join(OPERATORS_DIR, "groups.json")
-                    try:
-                        if os.path.exists(groups_path):
-                            with open(groups_path, "r", encoding="utf-8") as f:
-                                groups = json.load(f)
-                        else:
-                            groups = []
-                        response = {"request_id": request_id, "success": True, "groups": groups}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения групп: {e}"
-
-                elif action == "save_groups":
-                    groups = data.get("groups")
-                    groups_path = os.path.join(OPERATORS_DIR, "groups.json")
-                    try:
-                        with open(groups_path, "w", encoding="utf-8") as f:
-                            json.dump(groups, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи групп: {e}"
-
-                # === ENGINEERS / MASTERS ===
-                elif action == "list_engineers":
-                    engineers_path = os.path.join(LISTS_DIR, "engineers.json")
-                    try:
-                        if os.path.exists(engineers_path):
-                            with open(engineers_path, "r", encoding="utf-8") as f:
-                                engineers = json.load(f)
-                        else:
-                            engineers = []
-                        response = {"request_id": request_id, "success": True, "engineers": engineers}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения инженеров: {e}"
-
-                elif action == "save_engineers":
-                    engineers = data.get("engineers", [])
-                    engineers_path = os.path.join(LISTS_DIR, "engineers.json")
-                    try:
-                        with open(engineers_path, "w", encoding="utf-8") as f:
-                            json.dump(engineers, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи инженеров: {e}"
-
-                elif action == "list_masters":
-                    masters_path = os.path.join(LISTS_DIR, "masters.json")
-                    try:
-                        if os.path.exists(masters_path):
-                            with open(masters_path, "r", encoding="utf-8") as f:
-                                masters = json.load(f)
-                        else:
-                            masters = []
-                        response = {"request_id": request_id, "success": True, "masters": masters}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения мастеров: {e}"
-
-                elif action == "save_masters":
-                    masters = data.get("masters", [])
-                    masters_path = os.path.join(LISTS_DIR, "masters.json")
-                    try:
-                        with open(masters_path, "w", encoding="utf-8") as f:
-                            json.dump(masters, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи мастеров: {e}"
-
-                # === ПРОШИВКИ ===
-                elif action == "list_firmwares":
-                    fw_path = os.path.join(LISTS_DIR, "firmware.json")
-                    try:
-                        if os.path.exists(fw_path):
-                            with open(fw_path, "r", encoding="utf-8") as f:
-                                firmwares = json.load(f)
-                        else:
-                            firmwares = []
-                        response = {"request_id": request_id, "success": True, "firmwares": firmwares}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения прошивок: {e}"
-
-                elif action == "save_firmwares":
-                    firmwares = data.get("firmwares", [])
-                    fw_path = os.path.join(LISTS_DIR, "firmware.json")
-                    try:
-                        with open(fw_path, "w", encoding="utf-8") as f:
-                            json.dump(firmwares, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи прошивок: {e}"
-
-                # === MODELS ===
-                elif action == "list_models":
-                    path = os.path.join(MODELS_DIR, "models.json")
-                    try:
-                        if os.path.exists(path):
-                            with open(path, "r", encoding="utf-8") as f:
-                                models = json.load(f)
-                        else:
-                            models = []
-                        response = {"request_id": request_id, "success": True, "models": models}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения models.json: {e}"
-
-                elif action == "load_model":
-                    model_id = data.get("id")
-                    path = os.path.join(MODELS_DIR, f"{model_id}.json")
-                    try:
-                        with open(path, "r", encoding="utf-8") as f:
-                            model_data = json.load(f)
-                        response = {"request_id": request_id, "success": True, "model": model_data}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения модели: {e}"
-
-                elif action == "save_model":
-                    model_id = data.get("id")
-                    model_data = data.get("model")
-                    path = os.path.join(MODELS_DIR, f"{model_id}.json")
-
-                    try:
-                        # Обновляем список моделей (models.json)
-                        models_list_path = os.path.join(MODELS_DIR, "models.json")
-                        models = []
-                        if os.path.exists(models_list_path):
-                            with open(models_list_path, "r", encoding="utf-8") as f:
-                                models = json.load(f)
-
-                        models = [m for m in models if m.get("id") != model_id]
-                        models.append({"id": model_id, "model_name": model_data.get("model_name", "")})
-
-                        with open(models_list_path, "w", encoding="utf-8") as f:
-                            json.dump(models, f, ensure_ascii=False, indent=4)
-
-                        # Сохраняем тело модели
-                        with open(path, "w", encoding="utf-8") as f:
-                            json.dump(model_data, f, ensure_ascii=False, indent=4)
-
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка сохранения модели: {e}"
-
-                elif action == "delete_model":
-                    model_id = data.get("id")
-                    models_list_path = os.path.join(MODELS_DIR, "models.json")
-                    model_file_path = os.path.join(MODELS_DIR, f"{model_id}.json")
-
-                    try:
-                        if os.path.exists(model_file_path):
-                            os.remove(model_file_path)
-
-                        if os.path.exists(models_list_path):
-                            with open(models_list_path, "r", encoding="utf-8") as f:
-                                models = json.load(f)
-                            models = [m for m in models if m.get("id") != model_id]
-                            with open(models_list_path, "w", encoding="utf-8") as f:
-                                json.dump(models, f, ensure_ascii=False, indent=4)
-
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка удаления модели: {e}"
-
-                # === IMAGES ===
-                elif action == "upload_image":
-                    filename = data.get("filename")
-                    base64_data = data.get("image")
-
-                    try:
-                        if not filename or not base64_data:
-                            raise ValueError("filename or image missing")
-
-                        image_bytes = base64.b64decode(base64_data)
-                        image_path = os.path.join(IMAGES_DIR, filename)
-
-                        with open(image_path, "wb") as f:
-                            f.write(image_bytes)
-
-                        response = {"request_id": request_id, "success": True}
-
-                    except Exception as e:
-                        response["error"] = f"Ошибка загрузки изображения: {e}"
-
-                elif action == "download_image":
-                    filename = data.get("filename")
-                    path = os.path.join(IMAGES_DIR, filename)
-                    try:
-                        if not os.path.exists(path):
-                            raise FileNotFoundError("Image not found")
-                        with open(path, "rb") as f:
-                            b64 = base64.b64encode(f.read()).decode()
-                        response = {"request_id": request_id, "success": True, "image": b64}
-                    except Exception as e:
-                        response = {"request_id": request_id, "success": False, "image": None, "error": str(e)}
-
-                # === MANAGEMENT VLAN ===
-                elif action == "list_mngmt_vlan":
-                    path = os.path.join(LISTS_DIR, "mngmtvlan.json")
-                    try:
-                        if os.path.exists(path):
-                            with open(path, "r", encoding="utf-8") as f:
-                                vlans = json.load(f)
-                        else:
-                            vlans = []
-                        response = {"request_id": request_id, "success": True, "vlans": vlans}
-                    except Exception as e:
-                        response["error"] = f"Ошибка чтения VLAN: {e}"
-
-                elif action == "save_mngmt_vlan":
-                    vlans = data.get("vlans")
-                    path = os.path.join(LISTS_DIR, "mngmtvlan.json")
-                    try:
-                        os.makedirs(os.path.dirname(path), exist_ok=True)
-                        with open(path, "w", encoding="utf-8") as f:
-                            json.dump(vlans, f, ensure_ascii=False, indent=4)
-                        response = {"request_id": request_id, "success": True}
-                    except Exception as e:
-                        response["error"] = f"Ошибка записи VLAN: {e}"
-
-                # === MASS PING (последним) ===
-                elif action == "ping_switches":
-                    ping_data = data.get("ping_data", [])  # [{ "index": int, "ip": str }, ...]
-                    timeout_ms = data.get("timeout_ms", CONFIG["ping_timeout_ms"])
-
-                    if not ping_data:
-                        response["error"] = "No devices to ping"
+def check_scanner_settings(settings):
+    """Текст ошибки или None: 0 параллельных пингов повесил бы сканер, строка вместо числа — уронила"""
+    for key, value in settings.items():
+        if key not in SCANNER_SETTINGS:
+            continue
+        types, minimum = SCANNER_SETTINGS[key]
+        if minimum is None:
+            if not isinstance(value, bool):
+                return f"Неверный тип поля {key}"
+        elif isinstance(value, bool) or not isinstance(value, types):
+            return f"Неверный тип поля {key}"
+        elif value < minimum:
+            return f"Поле {key} должно быть не меньше {minimum}"
+    return None
+
+
+# === РЕЗЕРВНОЕ КОПИРОВАНИЕ ===
+class BackupScheduler:
+    """Снимки data по расписанию в отдельном потоке (см. backup_engine.py).
+
+    JSON пишется атомарно (временный файл + rename) через WRITER, сброс очереди
+    идёт вне path_lock. Снимок берёт path_lock файла и ждёт окончания текущего
+    сброса этого пути; от перезаписи посреди чтения защищает _read_stable.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.task = None
+        self.running = None  # asyncio.Task текущего снимка
+        self.last = None     # сводка последнего снимка или ошибка
+        self.loop = None
+
+    @contextmanager
+    def _guard(self, path):
+        if STORAGE is not None and path == STORAGE_DB_PATH:
+            # база SQLite: WAL сброшен в основной файл, писатель стоит на время чтения
+            with STORAGE.frozen():
+                yield
+            return
+        # вызывается из потока снимка: блокировка берётся в event loop сервера
+        lock = asyncio.run_coroutine_threadsafe(self._acquire(path), self.loop).result()
+        try:
+            yield
+        finally:
+            self.loop.call_soon_threadsafe(lock.release)
+
+    @staticmethod
+    async def _acquire(path):
+        lock = path_lock(path)
+        await lock.acquire()
+        try:
+            await WRITER.settled(path)
+        except BaseException:
+            lock.release()
+            raise
+        return lock
+
+    def restore_document(self, name, rel_path):
+        """Режим SQLite: документ берётся из копии базы в снимке и записывается в текущую базу"""
+        tmp = os.path.join(BASE_DIR, "cache", f"restore-{os.getpid()}.sqlite3")
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        try:
+            self.engine.restore_file(name, os.path.relpath(STORAGE_DB_PATH, DATA_DIR).replace(os.sep, "/"), tmp)
+            data = SqliteStore(tmp, readonly=True).read(rel_path)
+        except FileNotFoundError:
+            raise BackupError(f"В снимке {name} нет документа {rel_path}")
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        STORAGE.write(rel_path.replace(os.sep, "/"), data)
+        return len(json.dumps(data, ensure_ascii=False))
+
+    def _snapshot(self):
+        if STORAGE is not None:
+            # сбросить WAL заранее: иначе база выглядит неизменённой и снимок возьмёт прошлую копию
+            with STORAGE.frozen():
+                pass
+        stats = self.engine.snapshot(guard=self._guard)
+        stats["pruned"] = self.engine.prune(CONFIG["backup_keep"])
+        return stats
+
+    async def _run_once(self):
+        started = time.time()
+        try:
+            stats = await asyncio.to_thread(self._snapshot)
+            stats["duration"] = round(time.time() - started, 1)
+            self.last = stats
+            log(f"Backup {stats['name']}: files {stats['files']}, new chunks {stats['new_chunks']} "
+                f"({stats['new_bytes'] // 1024} KB), {stats['duration']}s")
+        except Exception as e:
+            self.last = {"error": str(e)}
+            log(f"Backup error: {e}", "ERROR")
+        return self.last
+
+    def backup_now(self):
+        """Запускает снимок, если он ещё не идёт; возвращает задачу"""
+        if self.running is None or self.running.done():
+            self.running = asyncio.create_task(self._run_once())
+        return self.running
+
+    def _age(self):
+        names = self.engine.list_snapshots()
+        if not names:
+            return None
+        try:
+            return time.time() - datetime.strptime(names[-1][:15], "%Y%m%d_%H%M%S").timestamp()
+        except ValueError:
+            return None
+
+    async def run(self):
+        while True:
+            interval = CONFIG["backup_interval_hours"] * 3600
+            if interval > 0:
+                age = await asyncio.to_thread(self._age)
+                if age is None or age >= interval:
+                    await self.backup_now()
+                    age = 0
+                await asyncio.sleep(max(60, interval - age))
+            else:
+                await asyncio.sleep(300)  # расписание выключено, ждём смены конфига
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def status(self):
+        return {"running": bool(self.running and not self.running.done()), "last": self.last,
+                "snapshots": self.engine.list_snapshots()}
+
+
+BACKUPS = BackupScheduler(BackupEngine(DATA_DIR, BACKUP_DIR))
+
+
+# === ИЗОБРАЖЕНИЯ: БИНАРНАЯ ПЕРЕДАЧА ===
+# Бинарный кадр: [1 байт: длина request_id][request_id, utf-8][4 байта: номер куска][данные].
+# Так куски разных загрузок одного клиента не путаются, даже если идут вперемешку.
+IMAGE_HASHES = {}  # путь -> (mtime_ns, size, sha256)
+
+
+def image_path(filename):
+    """Путь к файлу в data/images; подкаталоги и выход наружу запрещены"""
+    if not filename or os.path.basename(filename) != filename or filename in (".", ".."):
+        raise ValueError("Invalid image filename")
+    return os.path.join(IMAGES_DIR, filename)
+
+
+def pack_binary_frame(request_id, seq, payload):
+    rid = str(request_id).encode("utf-8")[:255]
+    return struct.pack("!B", len(rid)) + rid + struct.pack("!I", seq) + payload
+
+
+def unpack_binary_frame(frame):
+    rid_len = frame[0]
+    request_id = frame[1:1 + rid_len].decode("utf-8")
+    (seq,) = struct.unpack("!I", frame[1 + rid_len:5 + rid_len])
+    return request_id, seq, frame[5 + rid_len:]
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def image_hash(path):
+    """sha256 файла; пересчитывается только при изменении mtime/размера"""
+    st = await run_io(os.stat, path)
+    cached = IMAGE_HASHES.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    digest = await run_io(hash_file, path)
+    IMAGE_HASHES[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+async def send_file_binary(websocket, request_id, path, digest):
+    """Заголовок JSON, затем файл кусками image_chunk_size — целиком в память не читается.
+    Файл открывается до заголовка: если его нет (миниатюру вытеснили), клиенту ещё ничего не ушло"""
+    chunk_size = CONFIG["image_chunk_size"]
+    f = await run_io(open, path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        await send_message(websocket, json.dumps({
+            "request_id": request_id, "success": True, "binary": True, "size": size, "sha256": digest,
+            "chunk_size": chunk_size, "chunks": (size + chunk_size - 1) // chunk_size
+        }, ensure_ascii=False))
+        seq = 0
+        while True:
+            chunk = await run_io(f.read, chunk_size)
+            if not chunk:
+                break
+            await send_message(websocket, pack_binary_frame(request_id, seq, chunk))
+            seq += 1
+    finally:
+        await run_io(f.close)
+
+
+class UploadBuffer:
+    """Куски одной бинарной загрузки между чтением сокета и receive_file_binary.
+
+    Цикл чтения в handler() не ждёт места в очереди, пока загрузку никто не читает
+    (задача ещё ждёт слот или блокировку файла): переполненная до старта загрузка
+    отбрасывается, и клиент получает ошибку вместо зависшего подключения.
+    """
+    __slots__ = ("chunks", "started", "dropped")
+
+    def __init__(self):
+        self.chunks = asyncio.Queue(maxsize=32)
+        self.started = False
+        self.dropped = None  # причина, если загрузка отброшена
+
+    async def put(self, seq, chunk):
+        if self.dropped:
+            return
+        if not self.chunks.full():
+            self.chunks.put_nowait((seq, chunk))
+        elif not self.started:
+            self.dropped = "chunks arrived before the upload started"
+        else:
+            # приём идёт — очередь разгружается записью на диск, ждём её
+            try:
+                await asyncio.wait_for(self.chunks.put((seq, chunk)), CONFIG["upload_chunk_timeout"])
+            except asyncio.TimeoutError:
+                self.dropped = "disk writes too slow"
+
+
+def upload_too_large(size):
+    return size > CONFIG["upload_max_mb"] * 1024 * 1024
+
+
+async def receive_file_binary(conn, request_id, path, size, expected_hash=None):
+    """Принимает куски от клиента во временный файл и атомарно переименовывает его"""
+    upload = conn.uploads.get(str(request_id))
+    if upload is None or upload.dropped:
+        conn.uploads.pop(str(request_id), None)
+        raise ValueError(f"upload dropped: {upload.dropped if upload else 'no chunks expected'}")
+    upload.started = True
+    chunks = upload.chunks
+    tmp_path = path + ".part"
+    digest = hashlib.sha256()
+    received = 0
+    expected_seq = 0
+    f = await run_io(open, tmp_path, "wb")
+    try:
+        while received < size:
+            seq, chunk = await asyncio.wait_for(chunks.get(), CONFIG["upload_chunk_timeout"])
+            if upload.dropped:
+                raise ValueError(f"upload dropped: {upload.dropped}")
+            if seq != expected_seq:
+                raise ValueError(f"Chunk {expected_seq} expected, got {seq}")
+            expected_seq += 1
+            await run_io(f.write, chunk)
+            digest.update(chunk)
+            received += len(chunk)
+        await run_io(f.close)
+        if received != size:
+            raise ValueError(f"Size mismatch: {received} != {size}")
+        if expected_hash and digest.hexdigest() != expected_hash:
+            raise ValueError("sha256 mismatch")
+        await run_io(os.replace, tmp_path, path)
+    except BaseException:
+        await run_io(f.close)
+        if os.path.exists(tmp_path):
+            await run_io(os.remove, tmp_path)
+        raise
+    finally:
+        conn.uploads.pop(str(request_id), None)
+    return digest.hexdigest()
+
+
+# === МИНИАТЮРЫ ИЗОБРАЖЕНИЙ ===
+THUMB_FORMATS = {"jpeg": "jpg", "png": "png", "webp": "webp"}
+THUMB_MAX_SIDE = 4096
+
+
+class ThumbnailCache:
+    """Уменьшенные копии из data/images в cache/images.
+
+    Имя файла = sha256 оригинала + размер + формат, поэтому изменённый оригинал
+    просто даёт новый ключ, а старые копии уходят по LRU при превышении бюджета.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = OrderedDict()  # имя файла -> размер; порядок = давность использования
+        self.total = 0
+        self.loaded = False
+
+    def _load(self):
+        # после перезапуска порядок восстанавливается по mtime: get() обновляет его при каждом
+        # попадании (atime на многих дисках не обновляется — noatime/relatime)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part") or not os.path.isfile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue  # удалён между listdir и stat
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+        self.loaded = True
+
+    def _evict(self):
+        budget = CONFIG["thumb_cache_mb"] * 1024 * 1024
+        while self.total > budget and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            path = os.path.join(self.directory, name)
+            IMAGE_HASHES.pop(path, None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _render(src, dst, width, height, fmt):
+        with Image.open(src) as img:
+            img.thumbnail((width, height))
+            if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            tmp = dst + ".part"
+            img.save(tmp, format=fmt.upper(), quality=85)
+        os.replace(tmp, dst)
+        return os.path.getsize(dst)
+
+    async def get(self, src, source_hash, width, height, fmt):
+        """Путь к миниатюре; создаётся при первом запросе"""
+        if not self.loaded:
+            await run_io(self._load)
+        name = f"{source_hash}_{width}x{height}.{THUMB_FORMATS[fmt]}"
+        path = os.path.join(self.directory, name)
+        async with path_lock(path):
+            if name in self.entries and await run_io(self._touch, path):
+                self.entries.move_to_end(name)
+                return path
+            size = await run_io(self._render, src, path, width, height, fmt)
+            self.total += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self._evict()
+        log_action(f"Thumbnail created: {name}")
+        return path
+
+
+THUMBNAILS = ThumbnailCache(THUMBS_DIR)
+
+
+async def image_variant(path, digest, data):
+    """Оригинал или миниатюра по max_width/max_height/format; возвращает (путь, sha256)"""
+    width = data.get("max_width")
+    height = data.get("max_height")
+    fmt = (data.get("format") or "").lower() or None
+    if not width and not height and not fmt:
+        return path, digest
+    if fmt is not None and fmt not in THUMB_FORMATS:
+        raise ValueError(f"Unsupported format: {fmt}")
+    if Image is None:
+        # Pillow не установлен — клиент получит оригинал и сам уменьшит его
+        return path, digest
+    width = max(1, min(int(width or THUMB_MAX_SIDE), THUMB_MAX_SIDE))
+    height = max(1, min(int(height or THUMB_MAX_SIDE), THUMB_MAX_SIDE))
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower().lstrip(".")
+        fmt = {"jpg": "jpeg", "jpeg": "jpeg", "png": "png", "webp": "webp"}.get(ext, "png")
+    thumb = await THUMBNAILS.get(path, digest, width, height, fmt)
+    return thumb, await image_hash(thumb)
+
+
+# === ПОТОКОВАЯ ВЫДАЧА РЕЗУЛЬТАТОВ ПИНГА ===
+async def stream_ping_results(websocket, request_id, ping_data, known, ips_to_ping, timeout_ms):
+    """Шлёт частичные кадры {"partial": true, "results": [...]} по мере ответов устройств.
+
+    Готовые результаты копятся не дольше stream_flush_ms и уходят одним кадром.
+    Возвращает сводку для финального кадра.
+    """
+    indexes = {}
+    for item in ping_data:
+        indexes.setdefault(item.get("ip"), []).append(item.get("index"))
+    pending = []
+    summary = {"total": len(ping_data), "up": 0, "down": 0}
+
+    def add(ip, res):
+        for index in indexes.get(ip, []):
+            ok = bool(res and res["success"])
+            summary["up" if ok else "down"] += 1
+            pending.append({"index": index, "success": ok, "rtt_ms": res["rtt_ms"] if res else None})
+
+    async def flush():
+        if pending:
+            await send_message(websocket, json.dumps({"request_id": request_id, "partial": True,
+                                                      "results": pending}, ensure_ascii=False))
+            pending.clear()
+
+    # результаты из таблицы состояний и устройства без IP — сразу первым кадром
+    for ip in indexes:
+        if not ip:
+            add(ip, None)
+        elif ip in known:
+            add(ip, known[ip])
+    await flush()
+
+    tasks = {asyncio.ensure_future(ping_device(ip, timeout_ms)) for ip in ips_to_ping}
+    try:
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, timeout=CONFIG["stream_flush_ms"] / 1000)
+            for task in done:
+                res = task.result()
+                record_probe(res)
+                add(res["ip"], res)
+            await flush()
+    finally:
+        for task in tasks:
+            task.cancel()
+    return summary
+
+
+# === ПОДКЛЮЧЕНИЕ КЛИЕНТА ===
+class ClientConnection:
+    """Состояние одного подключения, общее для всех его запросов"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.client_ip = websocket.remote_address[0] if websocket.remote_address else "unknown"
+        self.uploads = {}  # request_id -> UploadBuffer бинарной загрузки
+        self.session = None  # Session после auth_login / resume_session
+
+
+# === РЕЕСТР ДЕЙСТВИЙ ===
+NUMBER = (int, float)
+ACTIONS = {}  # имя действия -> ActionSpec
+
+
+class ActionSpec:
+    __slots__ = ("name", "func", "required", "schema")
+
+    def __init__(self, name, func, required, schema):
+        self.name = name
+        self.func = func
+        self.required = required
+        self.schema = schema
+
+    def validate(self, data):
+        """Текст ошибки или None; типы проверяются только у переданных полей"""
+        for field in self.required:
+            if data.get(field) in (None, ""):
+                return f"Не указано поле {field}"
+        for field, types in self.schema.items():
+            value = data.get(field)
+            # bool — подкласс int, но числом в запросе не считается
+            if value is not None and (not isinstance(value, types) or
+                                      (isinstance(value, bool) and bool not in _as_tuple(types))):
+                return f"Неверный тип поля {field}"
+        return None
+
+
+def _as_tuple(types):
+    return types if isinstance(types, tuple) else (types,)
+
+
+def action(name, required=(), schema=None):
+    """Регистрирует обработчик: async def on_x(conn, data, request_id, response) -> ответ.
+
+    Обработчик возвращает dict (или уже сериализованную строку) для отправки
+    клиенту либо None, если ответ отправлен им самим (потоковые действия).
+    """
+    def register(func):
+        ACTIONS[name] = ActionSpec(name, func, required, schema or {})
+        return func
+    return register
+
+
+# === МЕТРИКИ ДЕЙСТВИЙ ===
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SENT_BYTES = contextvars.ContextVar("sent_bytes", default=None)
+
+
+class ActionMetrics:
+    """Счётчики одного действия; задержки — гистограмма по LATENCY_BUCKETS_MS"""
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "buckets", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, elapsed_ms, ok, bytes_in, bytes_out):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def percentile(self, p):
+        """Верхняя граница корзины, в которую попадает p-й процентиль"""
+        rank = self.count * p / 100
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return round(self.max_ms, 1)
+
+    def snapshot(self):
+        count = self.count or 1
+        return {
+            "count": self.count, "errors": self.errors, "error_rate": round(self.errors / count, 4),
+            "avg_ms": round(self.total_ms / count, 2), "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95), "p99_ms": self.percentile(99), "max_ms": round(self.max_ms, 1),
+            "avg_bytes_in": self.bytes_in // count, "avg_bytes_out": self.bytes_out // count,
+            "histogram": dict(zip([*map(str, LATENCY_BUCKETS_MS), "inf"], self.buckets)),
+        }
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.actions = {}  # имя -> ActionMetrics; неизвестные действия копятся в "<unknown>"
+        self.connections = 0
+        self.inflight = 0
+
+    def record(self, name, elapsed_ms, ok, bytes_in, bytes_out):
+        metrics = self.actions.get(name)
+        if metrics is None:
+            metrics = self.actions[name] = ActionMetrics()
+        metrics.record(elapsed_ms, ok, bytes_in, bytes_out)
+
+    def snapshot(self):
+        return {
+            "uptime": round(time.time() - self.started), "connections": self.connections,
+            "inflight": self.inflight, "actions": {name: m.snapshot() for name, m in sorted(self.actions.items())},
+        }
+
+
+METRICS = ServerMetrics()
+
+
+async def send_message(websocket, message):
+    """websocket.send с учётом отправленных байт в метриках текущего запроса"""
+    counter = SENT_BYTES.get()
+    if counter is not None:
+        counter[0] += len(message)
+    await websocket.send(message)
+
+
+# === ПИНГ ===
+@action("ping", required=("ip",), schema={"ip": str, "timeout": NUMBER, "max_age_ms": NUMBER})
+async def on_ping(conn, data, request_id, response):
+    ip = data.get("ip")
+    timeout = data.get("timeout", CONFIG["ping_timeout_ms"])
+    # max_age_ms > 0 — можно ответить из результатов сканера, если они свежие
+    state = fresh_state(ip, data.get("max_age_ms", 0))
+    if state:
+        response = {"request_id": request_id, "success": state["success"], "ip": ip,
+                    "rtt_ms": state["rtt_ms"], "cached": True}
+    elif ip:
+        result = await ping_device(ip, timeout)
+        record_probe(result)
+        response = {"request_id": request_id, **result}
+    else:
+        response["error"] = "IP not provided"
+    return response
+
+
+# === ПОДПИСКА НА СТАТУС ПИНГА ===
+@action("subscribe_ping", schema={"path": str, "filename": str})
+async def on_subscribe_ping(conn, data, request_id, response):
+    websocket = conn.websocket
+    path = data.get("path") or data.get("filename")
+    try:
+        file_path = get_full_path(path or "")
+    except Exception as e:
+        response["error"] = f"Invalid path: {e}"
+    else:
+        if not path or not json_exists(file_path) or not file_path.endswith(".json"):
+            response["error"] = "File not found"
+        else:
+            entry = await DOC_CACHE.get(file_path)
+            PING_SUBSCRIBERS.setdefault(file_path, set()).add(websocket)
+            response = {"request_id": request_id, "success": True,
+                        "states": map_ping_states(entry.data)}
+    return response
+
+
+@action("unsubscribe_ping", schema={"path": str, "filename": str})
+async def on_unsubscribe_ping(conn, data, request_id, response):
+    websocket = conn.websocket
+    path = data.get("path") or data.get("filename")
+    try:
+        file_path = get_full_path(path or "")
+    except Exception as e:
+        response["error"] = f"Invalid path: {e}"
+    else:
+        subscribers = PING_SUBSCRIBERS.get(file_path, set())
+        subscribers.discard(websocket)
+        if not subscribers:
+            PING_SUBSCRIBERS.pop(file_path, None)
+        response = {"request_id": request_id, "success": True}
+    return response
+
+
+# Старые клиенты опрашивают каждые 12 с — статус теперь приходит через subscribe_ping
+@action("check_ping_updates")
+async def on_check_ping_updates(conn, data, request_id, response):
+    response = {"request_id": request_id, "success": True, "updates": [], "push": "subscribe_ping"}
+    return response
+
+
+# === УПРАВЛЕНИЕ СКАНЕРОМ (GUI) ===
+@action("scanner_status")
+async def on_scanner_status(conn, data, request_id, response):
+    response = {"request_id": request_id, "success": True, "scanner": SCANNER.status()}
+    return response
+
+
+@action("scanner_config", schema={"config": dict})
+async def on_scanner_config(conn, data, request_id, response):
+    settings = data.get("config") or {}
+    error = check_scanner_settings(settings)
+    if error:
+        response["error"] = error
+        return response
+    CONFIG.update({k: v for k, v in settings.items() if k in SCANNER_SETTINGS})
+    if data.get("scan_now"):
+        SCANNER.scan_now()
+    else:
+        SCANNER.trigger()
+    response = {"request_id": request_id, "success": True, "scanner": SCANNER.status()}
+    return response
+
+
+# === РЕЗЕРВНЫЕ КОПИИ ===
+@action("backup_now")
+async def on_backup_now(conn, data, request_id, response):
+    BACKUPS.loop = asyncio.get_running_loop()
+    task = BACKUPS.backup_now()
+    if data.get("wait"):
+        await task
+    response = {"request_id": request_id, "success": True, "backup": BACKUPS.status()}
+    return response
+
+
+@action("backup_status")
+async def on_backup_status(conn, data, request_id, response):
+    response = {"request_id": request_id, "success": True,
+                "backup": await run_io(BACKUPS.status)}
+    return response
+
+
+@action("backup_list")
+async def on_backup_list(conn, data, request_id, response):
+    names = await run_io(BACKUPS.engine.list_snapshots)
+    response = {"request_id": request_id, "success": True, "snapshots": names}
+    return response
+
+
+@action("backup_restore", required=("snapshot", "path"), schema={"snapshot": str, "path": str})
+async def on_backup_restore(conn, data, request_id, response):
+    client_ip = conn.client_ip
+    # восстановление одного файла (обычно карты) из снимка
+    snapshot = data.get("snapshot")
+    path = data.get("path")
+    try:
+        file_path = get_full_path(path)
+        rel_path = os.path.relpath(file_path, DATA_DIR).replace(os.sep, "/")
+        async with path_lock(file_path):
+            # отложенная запись из очереди иначе перезапишет восстановленный файл
+            await WRITER.written(file_path)
+            if storage_key(file_path) is not None:
+                size = await run_io(BACKUPS.restore_document, snapshot, rel_path)
+            else:
+                size = await run_io(BACKUPS.engine.restore_file, snapshot, rel_path)
+            DOC_CACHE.invalidate(file_path)
+            OPERATORS.invalidate(file_path)
+        log(f"Restored {rel_path} from backup {snapshot} ({client_ip})")
+        response = {"request_id": request_id, "success": True, "size": size}
+    except (BackupError, ValueError, OSError) as e:
+        response["error"] = f"Ошибка восстановления: {e}"
+    return response
+
+
+@action("device_states", schema={"ips": list})
+async def on_device_states(conn, data, request_id, response):
+    ips = data.get("ips")
+    states = [DEVICE_STATE[ip] for ip in ips if ip in DEVICE_STATE] if ips else list(DEVICE_STATE.values())
+    response = {"request_id": request_id, "success": True, "states": states}
+    return response
+
+
+# === СПИСОК КАРТ ===
+@action("list_maps")
+async def on_list_maps(conn, data, request_id, response):
+    try:
+        files = await run_io(list_json_files, MAPS_DIR)
+        response = {"request_id": request_id, "success": True, "files": files}
+    except Exception as e:
+        response["error"] = str(e)
+    return response
+
+
+# === ПОИСК УСТРОЙСТВ ===
+@action("device_search", required=("query",), schema={"query": str, "field": str, "match": str, "limit": int})
+async def on_device_search(conn, data, request_id, response):
+    query = data["query"].strip()
+    field = data.get("field") or None
+    if not query:
+        response["error"] = "Empty query"
+    elif field is not None and field not in SEARCH_FIELDS:
+        response["error"] = f"Unknown field {field}, expected one of: {', '.join(SEARCH_FIELDS)}"
+    elif data.get("match", "substring") not in ("substring", "prefix"):
+        response["error"] = "match must be 'substring' or 'prefix'"
+    else:
+        devices, total = await DEVICES.search(
+            query, field=field, prefix=data.get("match") == "prefix",
+            limit=max(1, min(1000, int(data.get("limit", 100))))
+        )
+        response = {"request_id": request_id, "success": True, "devices": devices, "total": total}
+    return response
+
+
+# === ТОПОЛОГИЯ: ЗОНА ПОРАЖЕНИЯ ===
+@action("blast_radius", schema={"ip": str, "path": str, "id": (str, int)})
+async def on_blast_radius(conn, data, request_id, response):
+    await SCANNER.refresh_targets()
+    if data.get("ip"):
+        node = data["ip"]
+    elif data.get("path") and data.get("id") is not None:
+        try:
+            node = TOPOLOGY.resolve(get_full_path(data["path"]), data["id"])
+        except ValueError as e:
+            response["error"] = f"Invalid path: {e}"
+            return response
+    else:
+        response["error"] = "ip or path + id required"
+        return response
+
+    def describe(ip):
+        state = DEVICE_STATE.get(ip, {})
+        return {"ip": ip, **TOPOLOGY.devices.get(ip, {"name": "", "maps": []}),
+                "depth": TOPOLOGY.depth.get(ip), "pingok": state.get("success"),
+                "unreachable": state.get("unreachable", False)}
+
+    above, below, cut = TOPOLOGY.blast_radius(node)
+    response = {"request_id": request_id, "success": True,
+                "device": describe(node) if isinstance(node, str) else {"path": data["path"], "id": data["id"]},
+                "parents": sorted(TOPOLOGY.parents.get(node, ())) if isinstance(node, str) else [],
+                "upstream": [describe(ip) for ip in sorted(above)],
+                "downstream": [describe(ip) for ip in sorted(below)],
+                "isolated": sorted(cut)}
+    return response
+
+
+# === ИСТОРИЯ ДОСТУПНОСТИ ===
+def history_range(data):
+    now = time.time()
+    end = parse_time(data.get("to"), now)
+    start = parse_time(data.get("from"), end - 24 * 3600)
+    if start >= end:
+        raise ValueError("'from' must be earlier than 'to'")
+    return start, end
+
+
+@action("ping_history", required=("ip",), schema={"ip": str, "from": (str, int, float), "to": (str, int, float)})
+async def on_ping_history(conn, data, request_id, response):
+    try:
+        start, end = history_range(data)
+    except ValueError as e:
+        response["error"] = str(e)
+    else:
+        history = await HISTORY.device(data["ip"], start, end)
+        response = {"request_id": request_id, "success": True, "history": history}
+    return response
+
+
+@action("map_history", schema={"path": str, "filename": str, "from": (str, int, float), "to": (str, int, float)})
+async def on_map_history(conn, data, request_id, response):
+    path = data.get("path") or data.get("filename")
+    try:
+        start, end = history_range(data)
+        file_path = get_full_path(path or "")
+        entry = await DOC_CACHE.get(file_path)
+    except (ValueError, OSError) as e:
+        response["error"] = str(e)
+        return response
+    if not isinstance(entry.data, dict):
+        response["error"] = "Not a map"
+        return response
+    ips = sorted({dev["ip"] for typ in DEVICE_COLLECTIONS for dev in entry.data.get(typ) or []
+                  if isinstance(dev, dict) and isinstance(dev.get("ip"), str) and dev["ip"] not in ("", "—")})
+    devices = await HISTORY.devices(ips, start, end)
+    observed = sum(d["observed_s"] for d in devices)
+    down = sum(d["down_s"] for d in devices)
+    # худшие — первыми
+    devices.sort(key=lambda d: (d["availability"] is None, d["availability"] or 0))
+    response = {"request_id": request_id, "success": True, "from": start, "to": end,
+                "availability": round(100 * (observed - down) / observed, 3) if observed else None,
+                "outages_total": sum(d["outages_total"] for d in devices), "devices": devices}
+    return response
+
+
+# === ЧТЕНИЕ ФАЙЛА (универсально) ===
+@action("file_get", schema={"path": str, "filename": str, "if_none_match": str})
+async def on_file_get(conn, data, request_id, response):
+    path = data.get("path") or data.get("filename")
+    if not path:
+        response["error"] = "No path or filename"
+    else:
+        try:
+            file_path = get_full_path(path)
+        except Exception as e:
+            response["error"] = f"Invalid path: {e}"
+        else:
+            if file_path.endswith(".json") and json_exists(file_path):
+                try:
+                    entry = await DOC_CACHE.get(file_path)
+                    if data.get("if_none_match") == entry.etag:
+                        # у клиента уже есть эта версия — документ не пересылаем
+                        response = {"request_id": request_id, "success": True,
+                                    "not_modified": True, "etag": entry.etag}
                     else:
-                        # Собираем только те, у кого есть IP
-                        ips_to_ping = [item["ip"] for item in ping_data if item.get("ip")]
-                        tasks = [asyncio.to_thread(ping_device, ip, timeout_ms) for ip in ips_to_ping]
-
-                        try:
-                            ping_results = await asyncio.gather(*tasks)
-
-                            # Формируем ответ
-                            results = []
-                            ping_idx = 0
-                            for item in ping_data:
-                                idx = item.get("index")
-                                if item.get("ip"):
-                                    res = ping_results[ping_idx]
-                                    results.append({"index": idx, "success": res["success"]})
-                                    ping_idx += 1
-                                else:
-                                    results.append({"index": idx, "success": False})
-
-                            response = {
-                                "request_id": request_id,
-                                "success": True,
-                                "results": results
-                            }
-                            log(f"Ping switches completed: {len(results)} devices (map from {client_ip})")
-                        except Exception as e:
-                            response["error"] = f"Ping error: {str(e)}"
-                            log(f"Ping switches error: {e}")
-
-                # === НЕИЗВЕСТНОЕ ДЕЙСТВИЕ ===
+                        # ответ собирается из уже сериализованного документа
+                        response = (f'{{"request_id": {json.dumps(request_id, ensure_ascii=False)}, '
+                                    f'"success": true, "etag": "{entry.etag}", "data": {entry.body}}}')
+                except Exception as e:
+                    response["error"] = f"Read error: {e}"
+            else:
+                response["error"] = "File not found or not JSON"
+    return response
+
+
+# === СОХРАНЕНИЕ ФАЙЛА (универсально) ===
+@action("file_put", required=("data",), schema={"path": str, "filename": str, "data": (dict, list)})
+async def on_file_put(conn, data, request_id, response):
+    path = data.get("path") or data.get("filename")
+    file_data = data.get("data")
+    if not path or not isinstance(file_data, (dict, list)):
+        response["error"] = "Invalid path or data"
+    else:
+        try:
+            file_path = get_full_path(path)
+        except Exception as e:
+            response["error"] = f"Invalid path: {e}"
+        else:
+            async with path_lock(file_path):
+                written = WRITER.submit(file_path, file_data)
+                OPERATORS.invalidate(file_path)
+                entry = await DOC_CACHE.put(file_path, file_data)
+                DEVICES.touch(file_path)
+            try:
+                # ответ — после того, как файл на диске (несколько записей подряд сольются в одну)
+                await written
+                response = {"request_id": request_id, "success": True,
+                            "etag": entry.etag if entry else None}
+            except Exception as e:
+                response["error"] = f"Write error: {e}"
+    return response
+
+
+# === ЧАСТИЧНОЕ ИЗМЕНЕНИЕ КАРТЫ ===
+class VersionConflict(Exception):
+    """map_patch: документ изменился после base_version"""
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+
+@action("map_patch", required=("ops",), schema={"path": str, "filename": str, "ops": list, "base_version": str})
+async def on_map_patch(conn, data, request_id, response):
+    # версия документа — его etag (хэш содержимого, как в file_get): не зависит от других
+    # документов и перезапуска сервера. base_version — версия, которую правил клиент;
+    # если документ с тех пор изменился, правка отклоняется (conflict), а не затирает чужую
+    path = data.get("path") or data.get("filename")
+    ops = data.get("ops")
+    if not path or not isinstance(ops, list) or not ops:
+        response["error"] = "Invalid path or ops"
+    else:
+        try:
+            file_path = get_full_path(path)
+        except Exception as e:
+            response["error"] = f"Invalid path: {e}"
+        else:
+            written = None
+            async with path_lock(file_path):
+                try:
+                    if not file_path.endswith(".json") or not json_exists(file_path):
+                        raise FileNotFoundError("File not found or not JSON")
+                    entry = await DOC_CACHE.get(file_path)
+                    base_version = data.get("base_version")
+                    if base_version is not None and base_version != entry.etag:
+                        raise VersionConflict(entry.etag)
+                    await WRITER.settled(file_path)
+                    apply_map_ops(entry.data, ops)
+                except VersionConflict as e:
+                    response.update(error="Conflict: map changed since base_version", conflict=True,
+                                    version=e.version)
+                except Exception as e:
+                    # откат уже сделан, но документ в кэше мог быть изменён на месте — пусть перечитается
+                    DOC_CACHE.invalidate(file_path)
+                    response["error"] = f"Patch error: {e}"
                 else:
-                    response = {"request_id": request_id, "success": False, "error": "Unknown action"}
+                    written = WRITER.submit(file_path, entry.data)
+                    entry = await DOC_CACHE.put(file_path, entry.data)
+                    DEVICES.touch(file_path)
+            if written is not None:
+                try:
+                    await written
+                    response = {"request_id": request_id, "success": True,
+                                "etag": entry.etag, "version": entry.etag}
+                    publish_map_patch(file_path, ops, entry.etag)
+                except Exception as e:
+                    # кэш уже сброшен WRITER'ом — данные перечитаются с диска
+                    response["error"] = f"Write error: {e}"
+    return response
+
+
+# === ЧТЕНИЕ CSV ===
+@action("csv_read", required=("path",), schema={"path": str})
+async def on_csv_read(conn, data, request_id, response):
+    path = data.get("path")
+    if not path:
+        response["error"] = "No path provided"
+    elif get_full_path(path) == ISSUES_CSV_PATH:
+        # глобальные проблемы живут в журнале, CSV-вид собирается из индекса
+        await ISSUES.ensure_loaded()
+        response = {"request_id": request_id, "success": True, "data": ISSUES.rows()}
+    else:
+        csv_data = await run_io(read_csv, path)
+        response = {"request_id": request_id, "success": True, "data": csv_data}
+    return response
+
+
+# === ЗАПИСЬ CSV ===
+@action("csv_write", required=("path", "data"), schema={"path": str, "data": list})
+async def on_csv_write(conn, data, request_id, response):
+    path = data.get("path")
+    csv_data = data.get("data")
+    if not path or not isinstance(csv_data, list):
+        response["error"] = "Invalid path or data"
+    elif get_full_path(path) == ISSUES_CSV_PATH:
+        changed = await ISSUES.replace_all(csv_data)
+        response = {"request_id": request_id, "success": True, "changed": changed}
+    else:
+        success = await run_io(write_csv, path, csv_data)
+        if success:
+            response = {"request_id": request_id, "success": True}
+        else:
+            response["error"] = "Write error"
+    return response
+
+
+# === ГЛОБАЛЬНЫЕ ПРОБЛЕМЫ ===
+@action("issue_create", required=("issue",), schema={"issue": dict})
+async def on_issue_create(conn, data, request_id, response):
+    fields = data.get("issue")
+    if not isinstance(fields, dict):
+        response["error"] = "Invalid issue"
+    else:
+        issue = await ISSUES.create(fields)
+        response = {"request_id": request_id, "success": True, "issue": issue}
+    return response
+
+
+@action("issue_update", required=("id", "fields"), schema={"fields": dict})
+async def on_issue_update(conn, data, request_id, response):
+    fields = data.get("fields")
+    if not data.get("id") or not isinstance(fields, dict):
+        response["error"] = "Invalid id or fields"
+    else:
+        try:
+            issue = await ISSUES.update(data["id"], fields)
+            response = {"request_id": request_id, "success": True, "issue": issue}
+        except KeyError:
+            response["error"] = "Issue not found"
+    return response
+
+
+@action("issue_query", schema={"offset": int, "limit": int})
+async def on_issue_query(conn, data, request_id, response):
+    await ISSUES.ensure_loaded()
+    issues, total = ISSUES.query(
+        date_from=data.get("date_from"), date_to=data.get("date_to"),
+        device_ip=data.get("device_ip"), master=data.get("master"), severity=data.get("severity"),
+        offset=max(0, int(data.get("offset", 0))), limit=max(1, min(1000, int(data.get("limit", 100))))
+    )
+    response = {"request_id": request_id, "success": True, "issues": issues, "total": total}
+    return response
+
+
+# === АУТЕНТИФИКАЦИЯ ===
+@action("auth_login", schema={"login": str, "password_hash": str})
+async def on_auth_login(conn, data, request_id, response):
+    login = data.get("login")
+    password_hash = data.get("password_hash")
+    if not login or not password_hash:
+        response["error"] = "Логин и пароль обязательны"
+    else:
+        try:
+            if not await OPERATORS.ensure_users():
+                response["error"] = "Пользователи не найдены"
+            else:
+                safe_user = await OPERATORS.authenticate(login, password_hash)
+                if safe_user:
+                    if conn.session:
+                        SESSIONS.drop(conn.session.token)
+                    conn.session = SESSIONS.create(safe_user)
+                    response = {"request_id": request_id, "success": True, "user": safe_user,
+                                "token": conn.session.token}
+                else:
+                    response["error"] = "Неверный логин или пароль"
+        except Exception as e:
+            response["error"] = f"Ошибка: {e}"
+    return response
 
-                # === ОТПРАВКА ОТВЕТА ===
-                await websocket.send(json.dumps(response, ensure_ascii=False))
 
-            except Exception as e:
-                log(f"Handler error: {e}")
-                # Попробуем отправить ошибку клиенту (если есть request_id)
+@action("resume_session", required=("token",), schema={"token": str})
+async def on_resume_session(conn, data, request_id, response):
+    # повторное подключение клиента без ввода пароля
+    try:
+        await OPERATORS.ensure_users()
+        session = SESSIONS.resume(data.get("token") or "")
+        if session is None:
+            response["error"] = "Сессия не найдена или истекла"
+        else:
+            conn.session = session
+            user = OPERATORS.by_id.get(session.user_id) or OPERATORS.by_login.get(session.login)
+            response = {"request_id": request_id, "success": True, "user": OPERATORS.public(user)}
+    except Exception as e:
+        response["error"] = f"Ошибка: {e}"
+    return response
+
+
+@action("logout")
+async def on_logout(conn, data, request_id, response):
+    if conn.session:
+        SESSIONS.drop(conn.session.token)
+        conn.session = None
+    response = {"request_id": request_id, "success": True}
+    return response
+
+
+# === ОПЕРАТОРЫ ===
+@action("list_operators")
+async def on_list_operators(conn, data, request_id, response):
+    try:
+        if not await OPERATORS.ensure_users():
+            response["error"] = "Файл пользователей не найден"
+        else:
+            # пароли не возвращаются
+            response = {"request_id": request_id, "success": True, "operators": await OPERATORS.list_users()}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения: {e}"
+    return response
+
+
+@action("save_operators", required=("operators",), schema={"operators": list})
+async def on_save_operators(conn, data, request_id, response):
+    users = data.get("operators")
+    try:
+        await OPERATORS.save_users(users)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        OPERATORS.invalidate(USERS_PATH)
+        response["error"] = f"Ошибка записи операторов: {e}"
+    return response
+
+
+# === ГРУППЫ ===
+@action("list_groups")
+async def on_list_groups(conn, data, request_id, response):
+    try:
+        await OPERATORS.ensure_groups()
+        response = {"request_id": request_id, "success": True, "groups": OPERATORS.groups}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения групп: {e}"
+    return response
+
+
+@action("save_groups", required=("groups",), schema={"groups": list})
+async def on_save_groups(conn, data, request_id, response):
+    groups = data.get("groups")
+    try:
+        await OPERATORS.save_groups(groups)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        OPERATORS.invalidate(GROUPS_PATH)
+        response["error"] = f"Ошибка записи групп: {e}"
+    return response
+
+
+# === ENGINEERS / MASTERS ===
+@action("list_engineers")
+async def on_list_engineers(conn, data, request_id, response):
+    engineers_path = os.path.join(LISTS_DIR, "engineers.json")
+    try:
+        engineers = await load_json(engineers_path, [])
+        response = {"request_id": request_id, "success": True, "engineers": engineers}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения инженеров: {e}"
+    return response
+
+
+@action("save_engineers", schema={"engineers": list})
+async def on_save_engineers(conn, data, request_id, response):
+    engineers = data.get("engineers", [])
+    engineers_path = os.path.join(LISTS_DIR, "engineers.json")
+    try:
+        await save_json(engineers_path, engineers)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка записи инженеров: {e}"
+    return response
+
+
+@action("list_masters")
+async def on_list_masters(conn, data, request_id, response):
+    masters_path = os.path.join(LISTS_DIR, "masters.json")
+    try:
+        masters = await load_json(masters_path, [])
+        response = {"request_id": request_id, "success": True, "masters": masters}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения мастеров: {e}"
+    return response
+
+
+@action("save_masters", schema={"masters": list})
+async def on_save_masters(conn, data, request_id, response):
+    masters = data.get("masters", [])
+    masters_path = os.path.join(LISTS_DIR, "masters.json")
+    try:
+        await save_json(masters_path, masters)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка записи мастеров: {e}"
+    return response
+
+
+# === ПРОШИВКИ ===
+@action("list_firmwares")
+async def on_list_firmwares(conn, data, request_id, response):
+    fw_path = os.path.join(LISTS_DIR, "firmware.json")
+    try:
+        firmwares = await load_json(fw_path, [])
+        response = {"request_id": request_id, "success": True, "firmwares": firmwares}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения прошивок: {e}"
+    return response
+
+
+@action("save_firmwares", schema={"firmwares": list})
+async def on_save_firmwares(conn, data, request_id, response):
+    firmwares = data.get("firmwares", [])
+    fw_path = os.path.join(LISTS_DIR, "firmware.json")
+    try:
+        await save_json(fw_path, firmwares)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка записи прошивок: {e}"
+    return response
+
+
+# === MODELS ===
+@action("list_models")
+async def on_list_models(conn, data, request_id, response):
+    path = os.path.join(MODELS_DIR, "models.json")
+    try:
+        models = await load_json(path, [])
+        response = {"request_id": request_id, "success": True, "models": models}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения models.json: {e}"
+    return response
+
+
+@action("load_model", required=("id",))
+async def on_load_model(conn, data, request_id, response):
+    model_id = data.get("id")
+    path = os.path.join(MODELS_DIR, f"{model_id}.json")
+    try:
+        model_data = await load_json(path)
+        response = {"request_id": request_id, "success": True, "model": model_data}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения модели: {e}"
+    return response
+
+
+@action("save_model", required=("id", "model"), schema={"model": dict})
+async def on_save_model(conn, data, request_id, response):
+    model_id = data.get("id")
+    model_data = data.get("model")
+    path = os.path.join(MODELS_DIR, f"{model_id}.json")
+
+    try:
+        # Обновляем список моделей (models.json)
+        models_list_path = os.path.join(MODELS_DIR, "models.json")
+        models = await load_json(models_list_path, [])
+
+        models = [m for m in models if m.get("id") != model_id]
+        models.append({"id": model_id, "model_name": model_data.get("model_name", "")})
+
+        # список и тело модели — одной записью (в SQLite атомарно)
+        await save_json_many([(models_list_path, models), (path, model_data)])
+
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка сохранения модели: {e}"
+    return response
+
+
+@action("delete_model", required=("id",))
+async def on_delete_model(conn, data, request_id, response):
+    model_id = data.get("id")
+    models_list_path = os.path.join(MODELS_DIR, "models.json")
+    model_file_path = os.path.join(MODELS_DIR, f"{model_id}.json")
+
+    try:
+        items = [(model_file_path, None)]
+        if await run_io(json_exists, models_list_path):
+            models = await load_json(models_list_path)
+            items.append((models_list_path, [m for m in models if m.get("id") != model_id]))
+        await save_json_many(items)
+
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка удаления модели: {e}"
+    return response
+
+
+# === IMAGES ===
+@action("upload_image", required=("filename",), schema={"filename": str, "image": str, "size": int, "sha256": str})
+async def on_upload_image(conn, data, request_id, response):
+    filename = data.get("filename")
+    base64_data = data.get("image")
+
+    try:
+        if data.get("binary"):
+            # файл придёт следом бинарными кадрами с тем же request_id
+            size = int(data.get("size", -1))
+            if size < 0:
+                raise ValueError("size missing")
+            if upload_too_large(size):
+                raise ValueError(f"file larger than {CONFIG['upload_max_mb']} MB")
+            digest = await receive_file_binary(conn, request_id, image_path(filename), size,
+                                               data.get("sha256"))
+            response = {"request_id": request_id, "success": True, "sha256": digest, "size": size}
+        else:
+            if not filename or not base64_data:
+                raise ValueError("filename or image missing")
+
+            image_bytes = base64.b64decode(base64_data)
+            await run_io(write_binary, image_path(filename), image_bytes)
+
+            response = {"request_id": request_id, "success": True}
+
+    except Exception as e:
+        response["error"] = f"Ошибка загрузки изображения: {e}"
+    return response
+
+
+@action("download_image", required=("filename",), schema={"filename": str, "max_width": int, "max_height": int, "format": str})
+async def on_download_image(conn, data, request_id, response):
+    websocket = conn.websocket
+    filename = data.get("filename")
+    try:
+        original = image_path(filename)
+        if not os.path.exists(original):
+            raise FileNotFoundError("Image not found")
+        original_digest = await image_hash(original)
+        for attempt in range(2):
+            try:
+                path, digest = await image_variant(original, original_digest, data)
+                if data.get("if_none_match") == digest:
+                    # у клиента в кэше тот же файл
+                    response = {"request_id": request_id, "success": True, "not_modified": True, "sha256": digest}
+                elif data.get("binary"):
+                    await send_file_binary(websocket, request_id, path, digest)
+                    return
+                else:
+                    b64 = base64.b64encode(await run_io(read_binary, path)).decode()
+                    response = {"request_id": request_id, "success": True, "image": b64, "sha256": digest}
+                break
+            except FileNotFoundError:
+                # миниатюру вытеснил параллельный запрос — THUMBNAILS.get() создаст её заново
+                if attempt:
+                    raise
+    except Exception as e:
+        response = {"request_id": request_id, "success": False, "image": None, "error": str(e)}
+    return response
+
+
+# === MANAGEMENT VLAN ===
+@action("list_mngmt_vlan")
+async def on_list_mngmt_vlan(conn, data, request_id, response):
+    path = os.path.join(LISTS_DIR, "mngmtvlan.json")
+    try:
+        vlans = await load_json(path, [])
+        response = {"request_id": request_id, "success": True, "vlans": vlans}
+    except Exception as e:
+        response["error"] = f"Ошибка чтения VLAN: {e}"
+    return response
+
+
+@action("save_mngmt_vlan", schema={"vlans": list})
+async def on_save_mngmt_vlan(conn, data, request_id, response):
+    vlans = data.get("vlans")
+    path = os.path.join(LISTS_DIR, "mngmtvlan.json")
+    try:
+        await save_json(path, vlans)
+        response = {"request_id": request_id, "success": True}
+    except Exception as e:
+        response["error"] = f"Ошибка записи VLAN: {e}"
+    return response
+
+
+# === MASS PING ===
+@action("ping_switches", schema={"ping_data": list, "timeout_ms": NUMBER, "max_age_ms": NUMBER})
+async def on_ping_switches(conn, data, request_id, response):
+    websocket = conn.websocket
+    client_ip = conn.client_ip
+    ping_data = data.get("ping_data", [])  # [{ "index": int, "ip": str }, ...]
+    timeout_ms = data.get("timeout_ms", CONFIG["ping_timeout_ms"])
+
+    if not ping_data:
+        response["error"] = "No devices to ping"
+    else:
+        # max_age_ms > 0 — свежие результаты сканера берём из таблицы состояний, остальные пингуем
+        max_age = data.get("max_age_ms", 0)
+        known = {}
+        for item in ping_data:
+            state = fresh_state(item.get("ip"), max_age)
+            if state:
+                known[item["ip"]] = state
+        ips_to_ping = list({item["ip"] for item in ping_data
+                            if item.get("ip") and item["ip"] not in known})
+
+        try:
+            if data.get("stream"):
+                # частичные кадры уходят по ходу, в конце — короткая сводка
+                summary = await stream_ping_results(websocket, request_id, ping_data, known,
+                                                    ips_to_ping, timeout_ms)
+                await send_message(websocket, json.dumps({"request_id": request_id, "success": True, "done": True,
+                                                         "summary": summary}, ensure_ascii=False))
+                log(f"Ping switches streamed: {summary['total']} devices (map from {client_ip})")
+                return
+
+            for res in await ping_many(ips_to_ping, timeout_ms):
+                record_probe(res)
+                known[res["ip"]] = res
+
+            # Формируем ответ
+            results = []
+            for item in ping_data:
+                res = known.get(item.get("ip"))
+                if res:
+                    results.append({"index": item.get("index"), "success": res["success"], "rtt_ms": res["rtt_ms"]})
+                else:
+                    results.append({"index": item.get("index"), "success": False, "rtt_ms": None})
+
+            response = {
+                "request_id": request_id,
+                "success": True,
+                "results": results
+            }
+            log(f"Ping switches completed: {len(results)} devices (map from {client_ip})")
+        except Exception as e:
+            response["error"] = f"Ping error: {str(e)}"
+            log(f"Ping switches error: {e}", "ERROR")
+    return response
+
+# === УПРАВЛЕНИЕ СЕРВЕРОМ (GUI) ===
+STOPPING = asyncio.Event()  # main() ждёт его вместо вечного Future, потом дописывает данные
+
+
+@action("server_shutdown")
+async def on_server_shutdown(conn, data, request_id, response):
+    # GUI останавливает сервер этим запросом: на Windows terminate() не даёт процессу дописать данные
+    if conn.client_ip not in LOOPBACK_IPS:
+        response["error"] = "Только с этой машины"
+        return response
+    log(f"Shutdown requested ({conn.client_ip})")
+    STOPPING.set()
+    response = {"request_id": request_id, "success": True}
+    return response
+
+
+@action("server_stats")
+async def on_server_stats(conn, data, request_id, response):
+    return {"request_id": request_id, "success": True, "stats": METRICS.snapshot()}
+
+
+# === ОБРАБОТКА ЗАПРОСА ===
+async def process_request(conn, data, size=0):
+    """Выполняет одно действие и отправляет ответ; каждый запрос — отдельная задача"""
+    websocket = conn.websocket
+    action_name = data.get("action")
+    request_id = data.get("request_id")
+    response = {"request_id": request_id, "success": False, "error": "Unknown action"}
+    spec = ACTIONS.get(action_name)
+    sent = [0]
+    SENT_BYTES.set(sent)
+    started = time.perf_counter()
+    ok = False
+    METRICS.inflight += 1
+
+    try:
+        if action_name != "check_ping_updates":
+            log_action(f"Action: {action_name} | Path: {data.get('path', data.get('filename', ''))} | Client: {conn.client_ip}")
+
+        denied = SESSIONS.check(conn, action_name, data)
+        if denied:
+            response["error"] = denied
+        elif spec is not None:
+            invalid = spec.validate(data)
+            if invalid:
+                response["error"] = invalid
+            else:
+                response = await spec.func(conn, data, request_id, response)
+
+        # === ОТПРАВКА ОТВЕТА ===
+        if response is None:
+            ok = True  # ответ уже отправлен обработчиком
+        elif isinstance(response, str):
+            ok = True
+            await send_message(websocket, response)
+        else:
+            ok = bool(response.get("success"))
+            await send_message(websocket, json.dumps(response, ensure_ascii=False))
+
+    except Exception as e:
+        ok = False
+        log(f"Handler error: {e}", "ERROR")
+        # Попробуем отправить ошибку клиенту
+        try:
+            await send_message(websocket, json.dumps({"request_id": request_id, "success": False, "error": str(e)}, ensure_ascii=False))
+        except Exception:
+            # если отправка не удалась — просто логируем
+            log(f"Failed to send error to client: {e}", "ERROR")
+    finally:
+        METRICS.inflight -= 1
+        METRICS.record(action_name if spec else "<unknown>", (time.perf_counter() - started) * 1000,
+                       ok, size, sent[0])
+
+
+# === ОБРАБОТЧИК КЛИЕНТА ===
+async def handler(websocket):
+    conn = ClientConnection(websocket)
+    client_ip = conn.client_ip
+    METRICS.connections += 1
+    log(f"Client connected: {client_ip}")
+
+    # Запросы одного клиента выполняются параллельно (не больше max_inflight),
+    # ответы уходят по мере готовности и сопоставляются клиентом по request_id.
+    # Слот занимает сама задача: сокет читается и когда все слоты заняты — иначе не дошёл бы cancel.
+    slots = asyncio.Semaphore(CONFIG["max_inflight"])
+    tasks = set()
+    by_request_id = {}
+    # запросы к одному и тому же файлу — строго по порядку (file_put, затем file_get видит запись);
+    # путь -> [Lock, число запросов], запись удаляется, когда запросов к пути не осталось
+    path_order = {}
+
+    async def run(data, key, size):
+        if key is None:
+            async with slots:
+                await process_request(conn, data, size)
+            return
+        order = path_order.get(key)
+        if order is None:
+            order = path_order[key] = [asyncio.Lock(), 0]
+        order[1] += 1
+        try:
+            # сначала очередь файла, потом слот: ждущий своей очереди запрос слот не держит
+            async with order[0], slots:
+                await process_request(conn, data, size)
+        finally:
+            order[1] -= 1
+            if not order[1]:
+                del path_order[key]
+
+    async def send_cancelled(request_id):
+        try:
+            await websocket.send(json.dumps({"request_id": request_id, "success": False, "cancelled": True,
+                                             "error": "Cancelled"}, ensure_ascii=False))
+        except websockets.ConnectionClosed:
+            pass
+
+    def forget(task, request_id):
+        tasks.discard(task)
+        if by_request_id.get(request_id) is task:
+            del by_request_id[request_id]
+        conn.uploads.pop(str(request_id), None)
+        # отменён клиентом (action "cancel") — задача могла не успеть даже начаться
+        if task.cancelled() and not closing:
+            asyncio.create_task(send_cancelled(request_id))
+
+    closing = False
+    try:
+        async for message in websocket:
+            # === БИНАРНЫЕ КАДРЫ (куски загружаемого файла) ===
+            if isinstance(message, bytes):
                 try:
-                    await websocket.send(json.dumps({"request_id": data.get("request_id") if 'data' in locals() and isinstance(data, dict) else None, "success": False, "error": str(e)}, ensure_ascii=False))
-                except Exception:
-                    # если отправка не удалась — просто логируем
-                    log(f"Failed to send error to client: {e}")
+                    rid, seq, chunk = unpack_binary_frame(message)
+                except (IndexError, struct.error, UnicodeDecodeError):
+                    log(f"Invalid binary frame from {client_ip}", "WARNING")
+                    continue
+                upload = conn.uploads.get(rid)
+                if upload is None:
+                    log(f"Binary frame for unknown upload {rid} from {client_ip}", "WARNING")
+                    continue
+                await upload.put(seq, chunk)
+                continue
+
+            try:
+                # большие документы (file_put) разбираем вне event loop
+                data = json.loads(message) if len(message) < 65536 else await run_io(json.loads, message)
+                if not isinstance(data, dict):
+                    raise ValueError("Request must be a JSON object")
+            except ValueError:
+                # Cannot parse JSON — respond with generic error (no request_id available)
+                await websocket.send(json.dumps({"request_id": None, "success": False, "error": "Invalid JSON"}, ensure_ascii=False))
+                continue
+
+            request_id = data.get("request_id")
+            if not isinstance(request_id, (str, int, float, type(None))):
+                # request_id — ключ словаря задач: список или объект уронили бы всё подключение
+                await websocket.send(json.dumps({"request_id": None, "success": False,
+                                                 "error": "Invalid request_id"}, ensure_ascii=False))
+                continue
+
+            # === ОТМЕНА ЗАПРОСА ===
+            if data.get("action") == "cancel":
+                target = data.get("target")
+                target = by_request_id.get(target) if isinstance(target, (str, int, float)) else None
+                if target:
+                    target.cancel()
+                await websocket.send(json.dumps({"request_id": request_id, "success": target is not None,
+                                                 **({} if target else {"error": "Request not found"})}, ensure_ascii=False))
+                continue
+
+            if len(tasks) >= CONFIG["max_inflight"] + CONFIG["max_queued"]:
+                # очередь ждущих слота переполнена — отказ сразу, чтение сокета не останавливаем
+                await websocket.send(json.dumps({"request_id": request_id, "success": False,
+                                                 "error": "Server busy"}, ensure_ascii=False))
+                continue
+
+            if data.get("action") == "upload_image" and data.get("binary") and request_id is not None:
+                # очередь регистрируется сразу: куски могут прийти раньше, чем стартует задача
+                upload = conn.uploads[str(request_id)] = UploadBuffer()
+                if not isinstance(data.get("size"), int) or upload_too_large(data["size"]):
+                    upload.dropped = "file too large"  # куски молча выбрасываются, ответит обработчик
+
+            # путь не строкой отклонит проверка схемы действия, порядок для него не нужен
+            key = data.get("path") or data.get("filename")
+            task = asyncio.create_task(run(data, key if isinstance(key, str) else None, len(message)))
+            tasks.add(task)
+            if request_id is not None:
+                by_request_id[request_id] = task
+            task.add_done_callback(lambda t, rid=request_id: forget(t, rid))
 
     except websockets.ConnectionClosed:
         log(f"Client disconnected: {client_ip}")
     except Exception as e:
-        log(f"Connection error: {e}")
+        log(f"Connection error: {e}", "ERROR")
+    finally:
+        closing = True
+        METRICS.connections -= 1
+        for task in list(tasks):
+            task.cancel()
+        unsubscribe_all(websocket)
 
 
 # === ЗАПУСК СЕРВЕРА ===
+async def shutdown():
+    """Дописать на диск то, что копится в памяти: отметки операторов, историю пингов, очередь записи"""
+    for name, flush in (("last_activity", OPERATORS.flush), ("history", HISTORY.flush), ("writer", WRITER.drain)):
+        try:
+            await flush()
+        except Exception as e:
+            log(f"Shutdown flush {name}: {e}", "ERROR")
+
+
 async def main():
     host = "0.0.0.0"  # Слушаем на всех интерфейсах
     port = 8081
+    load_config()
+    open_storage()
+    # SIGTERM по умолчанию убивает процесс без atexit — останавливаемся сами
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, STOPPING.set)
+        except NotImplementedError:
+            # Windows: обработчик сигнала не в event loop, передаём через call_soon_threadsafe
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(STOPPING.set))
     log(f"WebSocket server STARTED → ws://{host}:{port}")
     async with websockets.serve(handler, host, port):
-        await asyncio.Future()
+        SCANNER.start()
+        OPERATORS.start()
+        BACKUPS.start()
+        DEVICES.start()
+        HISTORY.start()
+        await STOPPING.wait()
+        log("WebSocket server STOPPING")
+    await shutdown()
+    log("WebSocket server STOPPED")
 
 
 def run_server():
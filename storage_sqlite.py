@@ -0,0 +1,363 @@
+"""Хранилище JSON-документов data/ в SQLite (режим WAL).
+
+Включается в config.json: "storage": "sqlite". Путь документа — тот же, что и
+в файловой раскладке (maps/map_1.json, lists/engineers.json, ...), поэтому
+действия сервера не знают, где лежат данные.
+
+- карты раскладываются по таблицам: maps (всё, кроме коллекций), devices
+  (switches, plan_switches, users, soaps) и links (magistrals); запись карты
+  меняет только реально изменившиеся строки;
+- прочие документы — целиком в таблице documents; туда же попадает файл из
+  maps/, который не является объектом (read() ищет его и там);
+- глобальные проблемы — таблица issues;
+- все записи идут через один поток-писатель, который объединяет
+  одновременные запросы в одну транзакцию (group commit);
+- чтение — из любых потоков, каждый со своим соединением.
+
+Перенос данных:
+    python storage_sqlite.py import   # data/*.json -> data/storage.sqlite3
+    python storage_sqlite.py export   # обратно в JSON-файлы
+"""
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+DEVICE_COLLECTIONS = ("switches", "plan_switches", "users", "soaps")
+LINK_COLLECTIONS = ("magistrals",)
+ISSUE_COLUMNS = ("date", "device_ip", "severity_type", "master")
+GROUP_COMMIT_MAX = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY, body TEXT NOT NULL, version INTEGER NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY, meta TEXT NOT NULL, version INTEGER NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS devices (
+    map TEXT NOT NULL, collection TEXT NOT NULL, id TEXT NOT NULL, ord INTEGER NOT NULL,
+    ip TEXT, name TEXT, body TEXT NOT NULL, PRIMARY KEY (map, collection, id));
+CREATE INDEX IF NOT EXISTS devices_ip ON devices (ip);
+CREATE TABLE IF NOT EXISTS links (
+    map TEXT NOT NULL, id TEXT NOT NULL, ord INTEGER NOT NULL,
+    start_id TEXT, end_id TEXT, body TEXT NOT NULL, PRIMARY KEY (map, id));
+CREATE TABLE IF NOT EXISTS issues (
+    id TEXT PRIMARY KEY, date TEXT, device_ip TEXT, severity_type TEXT, master TEXT, body TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS issues_date ON issues (date);
+CREATE INDEX IF NOT EXISTS issues_device ON issues (device_ip);
+"""
+
+
+def dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def is_map(path):
+    return path.startswith("maps/")
+
+
+def split_map(data):
+    """Карта -> (meta, строки devices, строки links).
+
+    В meta коллекция, ушедшая в таблицу, заменяется на null: так сохраняется
+    порядок ключей. Коллекция без id у всех элементов или с повторами id
+    остаётся в meta целиком.
+    """
+    meta = dict(data)
+    devices, links = [], []
+    for collection in DEVICE_COLLECTIONS + LINK_COLLECTIONS:
+        items = data.get(collection)
+        if not isinstance(items, list):
+            continue
+        ids = [str(item.get("id")) if isinstance(item, dict) and item.get("id") is not None else None
+               for item in items]
+        if None in ids or len(set(ids)) != len(ids):
+            continue
+        meta[collection] = None
+        for ord_, (item_id, item) in enumerate(zip(ids, items)):
+            body = dumps(item)
+            if collection in LINK_COLLECTIONS:
+                links.append((item_id, ord_, item.get("startid"), item.get("endid"), body))
+            else:
+                devices.append((collection, item_id, ord_, item.get("ip"), item.get("name"), body))
+    return meta, devices, links
+
+
+class SqliteStore:
+    def __init__(self, db_path, readonly=False):
+        self.db_path = db_path
+        self.readonly = readonly
+        self.local = threading.local()
+        self.writes = queue.Queue()
+        self.writer = None
+        self.freeze_lock = threading.Lock()  # удерживается писателем на время транзакции
+        if not readonly:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            conn = self._connect()
+            conn.executescript(SCHEMA)
+            conn.close()
+            self.writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+            self.writer.start()
+
+    def _connect(self):
+        if self.readonly:
+            # копия базы из резервного снимка: без блокировок и без -wal/-shm рядом
+            conn = sqlite3.connect(f"file:{self.db_path}?immutable=1", uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def db(self):
+        """Соединение текущего потока (для чтения)"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    # === ЧТЕНИЕ ===
+    def version(self, path):
+        """Номер версии документа или None, если его нет"""
+        db = self.db
+        row = is_map(path) and db.execute("SELECT version FROM maps WHERE path = ?", (path,)).fetchone()
+        row = row or db.execute("SELECT version FROM documents WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def exists(self, path):
+        return self.version(path) is not None
+
+    def read(self, path):
+        db = self.db
+        if not is_map(path):
+            return self._read_document(db, path)
+        # одна транзакция чтения — карта собирается из согласованного состояния
+        db.execute("BEGIN")
+        try:
+            row = db.execute("SELECT meta FROM maps WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                # карта не объектом (_write_doc положил её в documents)
+                return self._read_document(db, path)
+            data = json.loads(row[0])
+            for collection, body in db.execute(
+                    "SELECT collection, body FROM devices WHERE map = ? ORDER BY collection, ord", (path,)):
+                if data.get(collection) is None:
+                    data[collection] = []
+                data[collection].append(json.loads(body))
+            for (body,) in db.execute("SELECT body FROM links WHERE map = ? ORDER BY ord", (path,)):
+                if data.get("magistrals") is None:
+                    data["magistrals"] = []
+                data["magistrals"].append(json.loads(body))
+        finally:
+            db.execute("COMMIT")
+        for collection in DEVICE_COLLECTIONS + LINK_COLLECTIONS:
+            if collection in data and data[collection] is None:
+                data[collection] = []
+        return data
+
+    @staticmethod
+    def _read_document(db, path):
+        row = db.execute("SELECT body FROM documents WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(path)
+        return json.loads(row[0])
+
+    def list(self, directory):
+        """Имена документов непосредственно в каталоге (как os.listdir)"""
+        prefix = directory.rstrip("/") + "/"
+        rows = self.db.execute("SELECT path FROM documents WHERE path >= ?1 AND path < ?2 "
+                               "UNION SELECT path FROM maps WHERE path >= ?1 AND path < ?2",
+                               (prefix, prefix + "\uffff")).fetchall()
+        return [p[len(prefix):] for (p,) in rows if "/" not in p[len(prefix):]]
+
+    def issue_rows(self):
+        return [json.loads(body) for (body,) in self.db.execute("SELECT body FROM issues")]
+
+    def find_devices(self, ip):
+        return self.db.execute("SELECT map, collection, body FROM devices WHERE ip = ?", (ip,)).fetchall()
+
+    # === ЗАПИСЬ (поток-писатель, group commit) ===
+    def _submit(self, op):
+        if self.writer is None:
+            raise sqlite3.OperationalError("База открыта только для чтения")
+        future = Future()
+        self.writes.put((op, future))
+        return future.result()
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self.writes.get()]
+            while len(batch) < GROUP_COMMIT_MAX:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            with self.freeze_lock:
+                try:
+                    results = self._write_batch(conn, batch)
+                except Exception as e:
+                    # "database is locked" (импорт, внешняя копия) и т. п.: ошибку получает вся пачка,
+                    # поток продолжает работать — иначе _submit ждал бы ответа вечно
+                    if conn.in_transaction:
+                        try:
+                            conn.execute("ROLLBACK")
+                        except sqlite3.Error:
+                            pass
+                    results = [(future, None, e) for _, future in batch]
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    @staticmethod
+    def _write_batch(conn, batch):
+        conn.execute("BEGIN IMMEDIATE")
+        results = []
+        for i, (op, future) in enumerate(batch):
+            # у каждого запроса своя точка отката: ошибка одного не отменяет остальные
+            conn.execute(f"SAVEPOINT w{i}")
+            try:
+                results.append((future, op(conn), None))
+                conn.execute(f"RELEASE w{i}")
+            except Exception as e:
+                conn.execute(f"ROLLBACK TO w{i}")
+                conn.execute(f"RELEASE w{i}")
+                results.append((future, None, e))
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            conn.execute("ROLLBACK")
+            results = [(future, None, e) for future, _, _ in results]
+        return results
+
+    @staticmethod
+    def _next_version(conn, path):
+        # карта может переехать между maps и documents — версия не должна откатиться назад
+        row = conn.execute("SELECT MAX(version) FROM (SELECT version FROM maps WHERE path = ?1 "
+                           "UNION ALL SELECT version FROM documents WHERE path = ?1)", (path,)).fetchone()
+        return (row[0] or 0) + 1
+
+    def _write_map(self, conn, path, data):
+        meta, devices, links = split_map(data)
+        version = self._next_version(conn, path)
+        conn.execute("DELETE FROM documents WHERE path = ?", (path,))
+        conn.execute("INSERT OR REPLACE INTO maps (path, meta, version, updated) VALUES (?, ?, ?, ?)",
+                     (path, dumps(meta), version, time.time()))
+        # строки, которые не изменились, не трогаем
+        old = {(c, i): (o, b) for c, i, o, b in
+               conn.execute("SELECT collection, id, ord, body FROM devices WHERE map = ?", (path,))}
+        changed = [(path, c, i, o, ip, name, b) for c, i, o, ip, name, b in devices if old.pop((c, i), None) != (o, b)]
+        conn.executemany("INSERT OR REPLACE INTO devices (map, collection, id, ord, ip, name, body) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)", changed)
+        conn.executemany("DELETE FROM devices WHERE map = ? AND collection = ? AND id = ?",
+                         [(path, c, i) for c, i in old])
+        old = {i: (o, b) for i, o, b in conn.execute("SELECT id, ord, body FROM links WHERE map = ?", (path,))}
+        changed = [(path, i, o, s, e, b) for i, o, s, e, b in links if old.pop(i, None) != (o, b)]
+        conn.executemany("INSERT OR REPLACE INTO links (map, id, ord, start_id, end_id, body) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", changed)
+        conn.executemany("DELETE FROM links WHERE map = ? AND id = ?", [(path, i) for i in old])
+
+    def _write_doc(self, conn, path, data):
+        if is_map(path) and isinstance(data, dict):
+            self._write_map(conn, path, data)
+            return
+        version = self._next_version(conn, path)
+        if is_map(path):
+            self._delete_map(conn, path)  # read() берёт карту из maps, если она там есть
+        conn.execute("INSERT OR REPLACE INTO documents (path, body, version, updated) VALUES (?, ?, ?, ?)",
+                     (path, dumps(data), version, time.time()))
+
+    def write(self, path, data):
+        self._submit(lambda conn: self._write_doc(conn, path, data))
+
+    @staticmethod
+    def _delete_map(conn, path):
+        conn.execute("DELETE FROM devices WHERE map = ?", (path,))
+        conn.execute("DELETE FROM links WHERE map = ?", (path,))
+        conn.execute("DELETE FROM maps WHERE path = ?", (path,))
+
+    def _delete_doc(self, conn, path):
+        if is_map(path):
+            self._delete_map(conn, path)
+        conn.execute("DELETE FROM documents WHERE path = ?", (path,))
+
+    def write_many(self, items):
+        """Несколько документов одной транзакцией (например, модель и список моделей); None — удалить"""
+        def op(conn):
+            for path, data in items:
+                if data is None:
+                    self._delete_doc(conn, path)
+                else:
+                    self._write_doc(conn, path, data)
+        self._submit(op)
+
+    def delete(self, path):
+        self._submit(lambda conn: self._delete_doc(conn, path))
+
+    def apply_issues(self, upserts, deletes=()):
+        def op(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO issues (id, date, device_ip, severity_type, master, body) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(issue["id"], *(issue.get(c) for c in ISSUE_COLUMNS), dumps(issue)) for issue in upserts])
+            conn.executemany("DELETE FROM issues WHERE id = ?", [(i,) for i in deletes])
+        self._submit(op)
+
+    @contextmanager
+    def frozen(self):
+        """Файл базы согласован и не меняется, пока открыт блок (для резервной копии)"""
+        with self.freeze_lock:
+            # busy = 1 — и после ожидания (timeout соединения) чтение держит кадры WAL,
+            # которых ещё нет в файле базы: копировать такой файл нельзя
+            busy, _, _ = self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if busy:
+                raise sqlite3.OperationalError("WAL checkpoint busy: база занята чтением")
+            yield
+
+    def is_empty(self):
+        db = self.db
+        return not db.execute("SELECT 1 FROM documents LIMIT 1").fetchone() \
+            and not db.execute("SELECT 1 FROM maps LIMIT 1").fetchone()
+
+    # === ПЕРЕНОС ИЗ/В JSON-ФАЙЛЫ ===
+    def import_tree(self, data_dir):
+        items = []
+        for root, _, files in os.walk(data_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                full = os.path.join(root, name)
+                with open(full, "r", encoding="utf-8") as f:
+                    items.append((os.path.relpath(full, data_dir).replace(os.sep, "/"), json.load(f)))
+        self.write_many(items)
+        return len(items)
+
+    def export_tree(self, data_dir):
+        paths = [p for (p,) in self.db.execute("SELECT path FROM documents UNION ALL SELECT path FROM maps")]
+        for path in paths:
+            full = os.path.join(data_dir, *path.split("/"))
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.read(path), f, ensure_ascii=False, indent=4)
+            os.replace(full + ".tmp", full)
+        return len(paths)
+
+
+if __name__ == "__main__":
+    base = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    store = SqliteStore(os.path.join(base, "storage.sqlite3"))
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    target = sys.argv[2] if len(sys.argv) > 2 else base
+    if command == "import":
+        print(f"Импортировано документов: {store.import_tree(target)}")
+    elif command == "export":
+        print(f"Выгружено документов: {store.export_tree(target)}")
+    else:
+        print(__doc__)
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+import server_ws
+
+DEV = {"id": "s1", "name": "sw1", "ip": "10.0.0.1"}
+
+
+@pytest.fixture
+def auto(tmp_path, monkeypatch):
+    monkeypatch.setattr(server_ws, "TOPOLOGY", server_ws.NetworkTopology())
+    monkeypatch.setitem(server_ws.CONFIG, "auto_issues", True)
+    monkeypatch.setitem(server_ws.CONFIG, "auto_issue_flap_window", 600)
+    journal = server_ws.IssueJournal(str(tmp_path / "issues.jsonl"), str(tmp_path / "issues.csv"))
+    return server_ws.AutoIssues(journal)
+
+
+def process(auto, *passes):
+    """Каждый ok — отдельный проход сканера (в одном проходе устройство встречается один раз)"""
+    for ok in passes:
+        asyncio.run(auto.process([(DEV, "switches", ok)]))
+    return list(auto.journal.issues.values())
+
+
+def test_repeated_down_opens_one_issue(auto):
+    process(auto, False)
+    issues = process(auto, False)
+    assert len(issues) == 1
+    assert issues[0]["status"] == "open" and issues[0]["auto"] == "1"
+    assert issues[0]["device_ip"] == "10.0.0.1"
+    assert auto.open == {"10.0.0.1": issues[0]["id"]}
+
+
+def test_recovery_closes_issue(auto):
+    process(auto, False)
+    issues = process(auto, True)
+    assert len(issues) == 1
+    assert issues[0]["status"] == "closed" and issues[0]["closed"]
+    assert "восстановлен" in issues[0]["call_history"]
+    assert auto.open == {}
+
+
+def test_flapping_reopens_same_issue(auto):
+    process(auto, False, True)
+    issues = process(auto, False)
+    assert len(issues) == 1
+    assert issues[0]["status"] == "open" and issues[0]["closed"] == ""
+    assert issues[0]["flaps"] == "1"
+    assert "снова недоступен" in issues[0]["call_history"]
+
+
+def test_down_after_flap_window_opens_new_issue(auto, monkeypatch):
+    monkeypatch.setitem(server_ws.CONFIG, "auto_issue_flap_window", 0)
+    process(auto, False, True)
+    issues = process(auto, False)
+    assert sorted(i["status"] for i in issues) == ["closed", "open"]
+
+
+def test_state_is_restored_from_journal(auto):
+    process(auto, False)
+    restarted = server_ws.AutoIssues(server_ws.IssueJournal(auto.journal.path, auto.journal.csv_path))
+    issues = process(restarted, False)
+    assert len(issues) == 1
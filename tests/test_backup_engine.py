@@ -0,0 +1,81 @@
+import os
+import sqlite3
+
+import pytest
+
+from backup_engine import BackupEngine, BackupError
+
+
+@pytest.fixture
+def engine(tmp_path):
+    data = tmp_path / "data"
+    (data / "maps").mkdir(parents=True)
+    (data / "maps" / "map_1.json").write_text('{"map": 1}', encoding="utf-8")
+    return BackupEngine(str(data), str(tmp_path / "backups"))
+
+
+def test_snapshot_and_restore(engine, tmp_path):
+    name = engine.snapshot()["name"]
+    path = os.path.join(engine.data_dir, "maps", "map_1.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"map": 2}')
+    assert engine.restore_file(name, "maps/map_1.json") == len('{"map": 1}')
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == '{"map": 1}'
+
+
+def test_unchanged_files_reuse_chunks(engine):
+    engine.snapshot()
+    stats = engine.snapshot()
+    assert stats["reused"] == 1 and stats["new_chunks"] == 0
+
+
+@pytest.mark.parametrize("name", ["../secret", "..\\secret", "a/b", "missing", None])
+def test_unknown_snapshot_names_are_rejected(engine, tmp_path, name):
+    engine.snapshot()
+    (tmp_path / "secret.json").write_text('{"files": {}}', encoding="utf-8")
+    with pytest.raises(BackupError):
+        engine.load_manifest(name)
+
+
+def test_snapshot_includes_wal_after_checkpoint(engine, tmp_path):
+    db_path = os.path.join(engine.data_dir, "storage.sqlite3")
+    writer = sqlite3.connect(db_path)
+    writer.execute("PRAGMA journal_mode=WAL")
+    writer.execute("CREATE TABLE t (v TEXT)")
+    writer.execute("INSERT INTO t VALUES ('fresh')")
+    writer.commit()
+    assert os.path.getsize(db_path + "-wal") > 0
+    engine.checkpoint_wal()
+    name = engine.snapshot()["name"]
+    writer.close()
+    target = str(tmp_path / "restored.sqlite3")
+    engine.restore_file(name, "storage.sqlite3", target)
+    reader = sqlite3.connect(target)
+    assert reader.execute("SELECT v FROM t").fetchall() == [("fresh",)]
+    reader.close()
+
+
+def test_restore_is_not_overwritten_by_queued_write(engine, monkeypatch):
+    import asyncio
+    import json
+
+    import server_ws
+
+    monkeypatch.setattr(server_ws, "DATA_DIR", engine.data_dir)
+    monkeypatch.setattr(server_ws.BACKUPS, "engine", engine)
+    monkeypatch.setitem(server_ws.CONFIG, "write_coalesce_ms", 50)
+    name = engine.snapshot()["name"]
+    path = os.path.join(engine.data_dir, "maps", "map_1.json")
+
+    async def scenario():
+        server_ws.WRITER.submit(path, {"map": 2})  # ещё в очереди на момент восстановления
+        request = {"action": "backup_restore", "snapshot": name, "path": "maps/map_1.json"}
+        conn = type("Conn", (), {"client_ip": "127.0.0.1"})()
+        response = await server_ws.on_backup_restore(conn, request, "r1", {"request_id": "r1", "success": False})
+        await server_ws.WRITER.drain()
+        return response
+
+    assert asyncio.run(scenario())["success"]
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {"map": 1}
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+import websockets
+
+import server_ws
+
+
+def test_cancel_reaches_server_when_all_slots_are_busy(monkeypatch):
+    monkeypatch.setitem(server_ws.CONFIG, "max_inflight", 2)
+    started = []
+
+    async def hang(conn, data, request_id, response):
+        started.append(request_id)
+        await asyncio.Event().wait()
+
+    monkeypatch.setitem(server_ws.ACTIONS, "hang", server_ws.ActionSpec("hang", hang, (), {}))
+
+    async def scenario():
+        async with websockets.serve(server_ws.handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as ws:
+                for rid in ("h1", "h2", "h3"):
+                    await ws.send(json.dumps({"action": "hang", "request_id": rid}))
+                while len(started) < 2:
+                    await asyncio.sleep(0.01)
+                # h3 ждёт слот, h1 выполняется — cancel должен дойти до обоих
+                for rid in ("h3", "h1"):
+                    await ws.send(json.dumps({"action": "cancel", "target": rid, "request_id": f"c-{rid}"}))
+                replies = {}
+                while len(replies) < 4:
+                    reply = json.loads(await asyncio.wait_for(ws.recv(), 2))
+                    replies[reply["request_id"]] = reply
+                return replies
+
+    replies = asyncio.run(scenario())
+    assert replies["c-h1"]["success"] and replies["c-h3"]["success"]
+    assert replies["h1"]["cancelled"] and replies["h3"]["cancelled"]
+    assert started == ["h1", "h2"]
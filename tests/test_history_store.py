@@ -0,0 +1,79 @@
+import math
+
+import pytest
+
+from history_store import RAW, DOWN, UNREACHABLE, UP, HistoryStore, RingFile
+
+
+@pytest.fixture
+def ring(tmp_path):
+    return RingFile(str(tmp_path / "raw" / "10.0.0.1.ring"), RAW, 4)
+
+
+def times(records):
+    return [r[0] for r in records]
+
+
+def test_ring_wraps_around(ring):
+    ring.append([(t, 1.0, UP) for t in (10, 20, 30)])
+    assert ring.covers_from() == 0
+    ring.append([(t, 1.0, UP) for t in (40, 50, 60)])
+    assert times(ring.read()) == [30, 40, 50, 60]
+    assert ring.covers_from() == 30
+    assert ring.last()[0] == 60
+
+
+def test_ring_append_more_than_capacity(ring):
+    ring.append([(t, 1.0, UP) for t in range(1, 11)])
+    assert times(ring.read()) == [7, 8, 9, 10]
+
+
+def test_ring_read_range_across_wrap(ring):
+    ring.append([(t, 1.0, UP) for t in (10, 20, 30, 40, 50, 60)])
+    assert times(ring.read(35, 55)) == [40, 50]
+    assert times(ring.read(0, 30)) == [30]
+    assert ring.read(70) == []
+
+
+def test_ring_replace_last(ring):
+    ring.append([(10, 1.0, UP), (20, 1.0, UP)])
+    ring.append([(20, 5.0, DOWN), (30, 1.0, UP)], replace_last=True)
+    records = ring.read()
+    assert times(records) == [10, 20, 30]
+    assert records[1][2] == DOWN
+
+
+def test_missing_ring(tmp_path):
+    ring = RingFile(str(tmp_path / "none.ring"), RAW, 4)
+    assert ring.read() == [] and ring.last() is None and ring.covers_from() is None
+
+
+def test_outage_intervals_from_samples():
+    samples = [(0, 1.0, UP), (100, math.nan, DOWN), (200, math.nan, DOWN), (300, 2.0, UP)]
+    result = HistoryStore._from_samples("ip", 0, 400, samples, [], True)
+    assert result["availability"] == 50.0
+    assert result["outages"] == [{"start": 100, "end": 300, "unreachable": False, "duration_s": 200}]
+    assert result["rtt"]["max"] == 2.0
+
+
+def test_outage_open_at_period_start_and_unreachable():
+    samples = [(50, math.nan, UNREACHABLE), (150, math.nan, UNREACHABLE), (250, 1.0, UP)]
+    result = HistoryStore._from_samples("ip", 100, 300, samples, [], True)
+    assert result["outages"] == [{"start": 100, "end": 250, "unreachable": True, "duration_s": 150}]
+    assert result["down_s"] == 150
+
+
+def test_gap_longer_than_max_gap_is_not_observed():
+    samples = [(0, 1.0, UP), (10000, 1.0, UP)]
+    result = HistoryStore._from_samples("ip", 0, 10000, samples, [], False)
+    assert result["observed_s"] == 0 and result["availability"] is None
+
+
+def test_store_flush_and_summary(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    for ts, status in ((1000, UP), (1100, DOWN), (1200, UP)):
+        store.record("10.0.0.1", ts, 1.0 if status == UP else None, status)
+    assert store.flush(store.take_pending()) == {}
+    result = store.summary("10.0.0.1", 1000, 1300)
+    assert result["resolution"] == "raw" and result["samples"] == 3
+    assert result["outages"][0]["start"] == 1100 and result["outages"][0]["end"] == 1200
@@ -0,0 +1,28 @@
+import struct
+
+import server_ws
+
+
+def echo_reply(seq):
+    return struct.pack("!BBHHH", server_ws.ICMP_ECHO_REPLY, 0, 0, 0x1234, seq) + b"pinger"
+
+
+def ip_header(options=b""):
+    ihl = (20 + len(options)) // 4
+    return bytes([0x40 | ihl]) + bytes(19) + options
+
+
+def test_bare_icmp_is_kept():
+    # Linux SOCK_DGRAM: ядро отдаёт только ICMP
+    assert server_ws.icmp_message(echo_reply(7)) == echo_reply(7)
+
+
+def test_ip_header_is_stripped():
+    # raw-сокет и macOS SOCK_DGRAM: впереди IP-заголовок
+    assert server_ws.icmp_message(ip_header() + echo_reply(7)) == echo_reply(7)
+    assert server_ws.icmp_message(ip_header(bytes(8)) + echo_reply(7)) == echo_reply(7)
+
+
+def test_short_packets():
+    assert server_ws.icmp_message(b"") == b""
+    assert len(server_ws.icmp_message(ip_header()[:10])) < 8
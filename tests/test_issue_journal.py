@@ -0,0 +1,40 @@
+import asyncio
+
+import server_ws
+
+
+def make_journal(tmp_path):
+    return server_ws.IssueJournal(str(tmp_path / "issues.jsonl"), str(tmp_path / "issues.csv"))
+
+
+def test_concurrent_creates_get_distinct_ids(tmp_path):
+    journal = make_journal(tmp_path)
+
+    async def run():
+        return await asyncio.gather(journal.create({"description": "first"}),
+                                    journal.create({"description": "second"}))
+
+    first, second = asyncio.run(run())
+    assert first["id"] != second["id"]
+    assert sorted(i["description"] for i in journal.issues.values()) == ["first", "second"]
+
+
+def test_replace_all_and_create_do_not_collide(tmp_path):
+    journal = make_journal(tmp_path)
+
+    async def run():
+        await journal.create({"description": "a"})
+        await asyncio.gather(journal.replace_all([{"id": "1", "description": "a"}, {"description": "from csv"}]),
+                             journal.create({"description": "operator"}))
+
+    asyncio.run(run())
+    assert sorted(i["description"] for i in journal.issues.values()) == ["a", "from csv", "operator"]
+    assert len(journal.issues) == 3
+
+
+def test_journal_reload_keeps_ids(tmp_path):
+    journal = make_journal(tmp_path)
+    asyncio.run(journal.create({"description": "x"}))
+    reloaded = make_journal(tmp_path)
+    asyncio.run(reloaded.ensure_loaded())
+    assert reloaded.issues == journal.issues
@@ -0,0 +1,68 @@
+import asyncio
+import copy
+import json
+
+import pytest
+
+import server_ws
+
+
+def make_map():
+    return {"map": {"name": "A"}, "switches": [{"id": "s1", "name": "old", "ip": "10.0.0.1"}]}
+
+
+@pytest.mark.parametrize("bad_op", [
+    "bogus",
+    {"op": "set", "collection": "switches", "id": "s1", "fields": ["not", "a", "dict"]},
+    {"op": "set", "collection": "switches", "id": "missing", "fields": {"name": "x"}},
+    {"op": "insert", "collection": "soaps", "item": {"name": "no id"}},
+    {"op": "set", "collection": ["switches"], "id": "s1", "fields": {}},
+])
+def test_failed_patch_is_rolled_back(bad_op):
+    data = make_map()
+    before = copy.deepcopy(data)
+    ops = [{"op": "set", "collection": "switches", "id": "s1", "fields": {"name": "CHANGED"}},
+           {"op": "insert", "collection": "legends", "item": {"id": "l1"}},
+           bad_op]
+    with pytest.raises(ValueError):
+        server_ws.apply_map_ops(data, ops)
+    assert data == before
+
+
+def test_patch_applies_all_ops():
+    data = make_map()
+    server_ws.apply_map_ops(data, [
+        {"op": "set", "collection": "switches", "id": "s1", "fields": {"name": "new"}},
+        {"op": "insert", "collection": "soaps", "item": {"id": "p1"}},
+        {"op": "set", "collection": "map", "fields": {"name": "B"}},
+    ])
+    assert data["switches"][0]["name"] == "new"
+    assert data["soaps"] == [{"id": "p1"}]
+    assert data["map"]["name"] == "B"
+
+
+def test_stale_base_version_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(server_ws, "DATA_DIR", str(tmp_path))
+    (tmp_path / "maps").mkdir()
+    (tmp_path / "maps" / "m.json").write_text(json.dumps(make_map()), encoding="utf-8")
+
+    def patch(name, base_version=None):
+        request = {"action": "map_patch", "path": "maps/m.json", "base_version": base_version,
+                   "ops": [{"op": "set", "collection": "switches", "id": "s1", "fields": {"name": name}}]}
+        return server_ws.on_map_patch(None, request, name, {"request_id": name, "success": False})
+
+    async def scenario():
+        entry = await server_ws.DOC_CACHE.get(server_ws.get_full_path("maps/m.json"))
+        base = entry.etag
+        first = await patch("first", base)
+        second = await patch("second", base)  # второй редактор правил ту же исходную версию
+        third = await patch("third", first["version"])
+        return base, first, second, third
+
+    base, first, second, third = asyncio.run(scenario())
+    assert first["success"] and first["version"] != base
+    assert second["success"] is False and second["conflict"] is True
+    assert second["version"] == first["version"]
+    assert third["success"]
+    saved = json.loads((tmp_path / "maps" / "m.json").read_text(encoding="utf-8"))
+    assert saved["switches"][0]["name"] == "third"
@@ -0,0 +1,8 @@
+import server_ws
+
+
+def test_duplicate_login_resolves_to_first_entry():
+    directory = server_ws.OperatorDirectory()
+    directory._set_users([{"id": 1, "login": "ivan"}, {"id": 2, "login": "ivan"}, {"id": 1, "login": "petr"}])
+    assert directory.by_login["ivan"]["id"] == 1
+    assert directory.by_id[1]["login"] == "ivan"
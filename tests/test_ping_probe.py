@@ -0,0 +1,17 @@
+import asyncio
+
+import server_ws
+
+
+def test_on_demand_ping_does_not_touch_device_state(monkeypatch):
+    async def unreachable(ip, timeout_ms):
+        return {"ip": ip, "success": False, "rtt_ms": None}
+
+    monkeypatch.setattr(server_ws, "ping_device", unreachable)
+    monkeypatch.setattr(server_ws, "DEVICE_STATE", {})
+    request = {"action": "ping", "ip": "10.9.0.1", "timeout": 0}
+    response = asyncio.run(server_ws.on_ping(None, request, "r1", {"request_id": "r1", "success": False}))
+    assert response["success"] is False
+    assert server_ws.DEVICE_STATE == {}
+    assert not server_ws.is_down("10.9.0.1")
+    assert "10.9.0.1" in server_ws.HISTORY.store.devices
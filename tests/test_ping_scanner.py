@@ -0,0 +1,136 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import server_ws
+
+UP = {"success": True}
+DOWN = {"success": False}
+
+
+@pytest.fixture
+def state(monkeypatch):
+    monkeypatch.setattr(server_ws, "DEVICE_STATE", {})
+    for key, value in {"scan_interval": 240, "scan_up_max_interval": 900, "scan_confirm_interval": 5,
+                       "scan_confirm_count": 2, "scan_down_min_interval": 30, "scan_down_max_interval": 1800,
+                       "scan_dependencies": True}.items():
+        monkeypatch.setitem(server_ws.CONFIG, key, value)
+    return server_ws.DEVICE_STATE
+
+
+def set_state(ip, success):
+    server_ws.record_ping({"ip": ip, "success": success, "rtt_ms": None})
+
+
+def test_loss_is_confirmed_before_going_down(state):
+    scanner = server_ws.PingScanner()
+    set_state("10.0.0.1", True)
+    assert scanner.reschedule("10.0.0.1", DOWN, 100) is None
+    assert scanner.schedule["10.0.0.1"]["due"] == 105
+    assert scanner.reschedule("10.0.0.1", DOWN, 105) is None
+    assert scanner.reschedule("10.0.0.1", DOWN, 110) is False
+    assert scanner.schedule["10.0.0.1"] == {"due": 140, "interval": 30, "fails": 3}
+
+
+def test_success_during_confirmation_resets_fails(state):
+    scanner = server_ws.PingScanner()
+    set_state("10.0.0.1", True)
+    scanner.reschedule("10.0.0.1", DOWN, 100)
+    assert scanner.reschedule("10.0.0.1", UP, 105) is True
+    assert scanner.schedule["10.0.0.1"]["fails"] == 0
+    assert scanner.reschedule("10.0.0.1", DOWN, 110) is None
+
+
+def test_unknown_device_is_confirmed_too(state):
+    scanner = server_ws.PingScanner()
+    assert scanner.reschedule("10.0.0.1", DOWN, 0) is None
+    assert scanner.reschedule("10.0.0.1", DOWN, 5) is None
+    assert scanner.reschedule("10.0.0.1", DOWN, 10) is False
+
+
+def test_up_interval_grows_to_cap(state):
+    scanner = server_ws.PingScanner()
+    assert scanner.reschedule("10.0.0.1", UP, 0) is True
+    set_state("10.0.0.1", True)
+    intervals = [scanner.schedule["10.0.0.1"]["interval"]]
+    for _ in range(5):
+        scanner.reschedule("10.0.0.1", UP, 0)
+        intervals.append(scanner.schedule["10.0.0.1"]["interval"])
+    assert intervals == [240, 360, 540, 810, 900, 900]
+
+
+def test_down_interval_doubles_to_cap(state):
+    scanner = server_ws.PingScanner()
+    set_state("10.0.0.1", False)
+    intervals = []
+    for _ in range(8):
+        assert scanner.reschedule("10.0.0.1", DOWN, 0) is False
+        intervals.append(scanner.schedule["10.0.0.1"]["interval"])
+    assert intervals == [30, 60, 120, 240, 480, 960, 1800, 1800]
+    # восстановление сбрасывает интервал к началу
+    assert scanner.reschedule("10.0.0.1", UP, 0) is True
+    assert scanner.schedule["10.0.0.1"]["interval"] == 240
+
+
+def tree():
+    topology = server_ws.NetworkTopology()
+    data = {
+        "switches": [{"id": i, "name": i, "ip": ip} for i, ip in
+                     (("r", "10.1.0.1"), ("x", "10.1.0.2"), ("y", "10.1.0.3"))],
+        "magistrals": [{"startid": "r", "endid": "x"}, {"startid": "x", "endid": "y"}],
+    }
+    topology.update_map("tree.json", SimpleNamespace(version=1, data=data))
+    topology.rebuild()
+    return topology
+
+
+def run_scan(monkeypatch, scanner):
+    probed = []
+
+    async def probe_all(ips):
+        probed.extend(ips)
+        return [{"ip": ip, "success": False, "rtt_ms": None} for ip in ips]
+
+    async def apply_to_map(file_path):
+        return []
+
+    async def process(transitions):
+        pass
+
+    monkeypatch.setattr(scanner, "probe_all", probe_all)
+    monkeypatch.setattr(scanner, "apply_to_map", apply_to_map)
+    monkeypatch.setattr(server_ws, "AUTO_ISSUES", SimpleNamespace(process=process))
+    asyncio.run(scanner.run_due())
+    return probed
+
+
+def make_scanner(monkeypatch):
+    monkeypatch.setattr(server_ws, "TOPOLOGY", tree())
+    scanner = server_ws.PingScanner()
+    scanner.targets = {ip: {"tree.json"} for ip in ("10.1.0.1", "10.1.0.2", "10.1.0.3")}
+    scanner.targets_at = time.time()
+    return scanner
+
+
+def test_children_behind_dead_parent_are_not_probed(state, monkeypatch):
+    scanner = make_scanner(monkeypatch)
+    set_state("10.1.0.1", False)
+    probed = run_scan(monkeypatch, scanner)
+    assert probed == ["10.1.0.1"]
+    assert state["10.1.0.2"]["unreachable"] and state["10.1.0.2"]["via"] == ["10.1.0.1"]
+    assert state["10.1.0.3"]["unreachable"] and state["10.1.0.3"]["via"] == ["10.1.0.2"]
+    assert scanner.last_cycle["unreachable"] == 2
+
+
+def test_unreachable_child_is_probed_after_down_max_interval(state, monkeypatch):
+    scanner = make_scanner(monkeypatch)
+    set_state("10.1.0.1", False)
+    run_scan(monkeypatch, scanner)
+    for entry in scanner.schedule.values():
+        entry["due"] = 0
+    scanner.schedule["10.1.0.2"]["probed"] = time.time() - 1801
+    probed = run_scan(monkeypatch, scanner)
+    assert probed == ["10.1.0.1", "10.1.0.2"]
+    assert not state["10.1.0.2"]["unreachable"]
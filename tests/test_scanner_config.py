@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+import server_ws
+
+
+@pytest.mark.parametrize("settings", [
+    {"scan_concurrency": 0},
+    {"scan_concurrency": "64"},
+    {"scan_concurrency": 2.5},
+    {"packet_count": True},
+    {"scan_interval": -1},
+    {"scanner_enabled": 1},
+])
+def test_bad_settings_are_rejected(settings):
+    before = dict(server_ws.CONFIG)
+    request = {"action": "scanner_config", "config": settings}
+    response = asyncio.run(server_ws.on_scanner_config(None, request, "r1", {"request_id": "r1", "success": False}))
+    assert response["success"] is False and response["error"]
+    assert server_ws.CONFIG == before
+
+
+def test_good_settings_pass():
+    assert server_ws.check_scanner_settings({"scan_concurrency": 8, "scan_interval": 30.5,
+                                             "scanner_enabled": False, "unknown": "x"}) is None
@@ -0,0 +1,82 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import server_ws
+
+
+def rel(path):
+    return os.path.relpath(path, server_ws.DATA_DIR).replace(os.sep, "/")
+
+
+@pytest.mark.parametrize("action,data,expected", [
+    ("file_get", {"path": "maps/map_1.json"}, None),
+    ("file_put", {"path": "maps/map_1.json"}, "edit_maps"),
+    ("file_get", {"path": rel(server_ws.USERS_PATH)}, "view_operators"),
+    ("file_put", {"filename": rel(server_ws.USERS_PATH)}, "edit_operators"),
+    ("csv_read", {"path": rel(server_ws.ISSUES_CSV_PATH)}, "view_global_problems"),
+    ("csv_write", {"path": rel(server_ws.ISSUES_CSV_PATH)}, "add_global_problems"),
+    ("file_get", {"path": ["maps"]}, None),
+    ("file_get", {"path": "../outside.json"}, None),
+    ("scanner_config", {}, "edit_operators"),
+    ("list_maps", {}, None),
+])
+def test_required_permission(action, data, expected):
+    assert server_ws.required_permission(action, data) == expected
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    monkeypatch.setitem(server_ws.CONFIG, "auth_required", True)
+    directory = server_ws.OperatorDirectory()
+    directory._set_groups([{"id": 1, "permissions": {"edit_maps": True}}, {"id": 2, "permissions": {}}])
+    directory._set_users([{"id": 10, "login": "editor", "group": 1}, {"id": 11, "login": "viewer", "group": 2}])
+    return directory, server_ws.SessionStore(directory)
+
+
+def conn(ip="10.0.0.5", session=None):
+    return SimpleNamespace(client_ip=ip, session=session)
+
+
+def test_auth_is_off_by_default():
+    assert server_ws.CONFIG["auth_required"] is False
+    store = server_ws.SessionStore(server_ws.OperatorDirectory())
+    assert store.check(conn(), "file_put", {"path": "maps/map_1.json"}) is None
+
+
+def test_session_required_and_public_actions(sessions):
+    _, store = sessions
+    assert store.check(conn(), "list_maps", {}) == "Требуется вход"
+    assert store.check(conn(), "auth_login", {}) is None
+
+
+def test_permissions_from_group(sessions):
+    directory, store = sessions
+    editor = conn(session=store.create(directory.by_login["editor"]))
+    viewer = conn(session=store.create(directory.by_login["viewer"]))
+    data = {"path": "maps/map_1.json"}
+    assert store.check(editor, "file_put", data) is None
+    assert store.check(viewer, "file_put", data) == "Недостаточно прав: edit_maps"
+    assert store.check(viewer, "file_get", data) is None
+
+
+def test_expired_and_deleted_sessions(sessions):
+    directory, store = sessions
+    expired = conn(session=store.create(directory.by_login["editor"]))
+    expired.session.expires = time.time() - 1
+    assert store.check(expired, "list_maps", {}) == "Сессия истекла, войдите снова"
+    assert expired.session is None
+    removed = conn(session=store.create(directory.by_login["viewer"]))
+    directory._set_users([{"id": 10, "login": "editor", "group": 1}])
+    assert store.check(removed, "list_maps", {}) == "Сессия истекла, войдите снова"
+
+
+def test_local_actions_only_from_loopback(sessions):
+    _, store = sessions
+    for ip in server_ws.LOOPBACK_IPS:
+        assert store.check(conn(ip), "scanner_status", {}) is None
+    assert store.check(conn("10.0.0.5"), "scanner_status", {}) == "Требуется вход"
+    # с этой машины без входа — только действия GUI
+    assert store.check(conn("127.0.0.1"), "file_put", {"path": "maps/map_1.json"}) == "Требуется вход"
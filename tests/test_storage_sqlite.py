@@ -0,0 +1,81 @@
+import sqlite3
+
+import pytest
+
+from storage_sqlite import SqliteStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteStore(str(tmp_path / "storage.sqlite3"))
+
+
+def test_document_round_trip(store):
+    store.write("lists/engineers.json", [{"name": "A"}])
+    assert store.read("lists/engineers.json") == [{"name": "A"}]
+    assert store.version("lists/engineers.json") == 1
+    store.write("lists/engineers.json", [])
+    assert store.version("lists/engineers.json") == 2
+
+
+def test_map_round_trip(store):
+    data = {"map": {"name": "A"}, "switches": [{"id": "s1", "ip": "10.0.0.1"}],
+            "magistrals": [{"id": "m1", "startid": "s1", "endid": "s2"}]}
+    store.write("maps/map_1.json", data)
+    assert store.read("maps/map_1.json")["switches"] == data["switches"]
+    assert store.read("maps/map_1.json")["magistrals"] == data["magistrals"]
+    assert [row[0] for row in store.find_devices("10.0.0.1")] == ["maps/map_1.json"]
+    assert store.list("maps") == ["map_1.json"]
+
+
+def test_delete(store):
+    store.write("maps/map_1.json", {"map": {}})
+    store.delete("maps/map_1.json")
+    with pytest.raises(FileNotFoundError):
+        store.read("maps/map_1.json")
+
+
+def test_writer_survives_failed_batch(store, monkeypatch):
+    original = SqliteStore._write_batch
+    calls = []
+
+    def locked_once(conn, batch):
+        calls.append(len(batch))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return original(conn, batch)
+
+    monkeypatch.setattr(SqliteStore, "_write_batch", staticmethod(locked_once))
+    with pytest.raises(sqlite3.OperationalError):
+        store.write("lists/a.json", [1])
+    store.write("lists/a.json", [2])
+    assert store.read("lists/a.json") == [2]
+
+
+def test_map_that_is_not_an_object(store):
+    store.write("maps/odd.json", [1, 2])
+    assert store.read("maps/odd.json") == [1, 2]
+    assert store.version("maps/odd.json") == 1
+    assert store.list("maps") == ["odd.json"]
+    store.write("maps/odd.json", {"map": {"name": "ok"}})
+    assert store.read("maps/odd.json")["map"] == {"name": "ok"}
+    assert store.version("maps/odd.json") == 2
+    store.write("maps/odd.json", "text")
+    assert store.read("maps/odd.json") == "text"
+    assert store.version("maps/odd.json") == 3
+
+
+def test_frozen_fails_while_wal_is_pinned(store, tmp_path):
+    store.db.execute("PRAGMA busy_timeout = 50")
+    store.write("lists/a.json", [1])
+    reader = sqlite3.connect(str(tmp_path / "storage.sqlite3"))
+    reader.execute("BEGIN")
+    reader.execute("SELECT * FROM documents").fetchall()  # снимок держит кадры WAL
+    store.write("lists/a.json", [2])
+    with pytest.raises(sqlite3.OperationalError):
+        with store.frozen():
+            pass
+    reader.execute("COMMIT")
+    reader.close()
+    with store.frozen():
+        pass
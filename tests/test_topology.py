@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import server_ws
+
+
+def link(a, b):
+    return {"startid": a, "endid": b}
+
+
+def build():
+    topology = server_ws.NetworkTopology()
+    ring = {
+        "switches": [{"id": i, "name": i, "ip": ip} for i, ip in
+                     (("a", "10.0.0.1"), ("b", "10.0.0.2"), ("c", "10.0.0.3"), ("d", "10.0.0.4"))],
+        "magistrals": [link("a", "b"), link("b", "c"), link("c", "a"), link("b", "d")],
+    }
+    tree = {
+        "switches": [{"id": i, "name": i, "ip": ip} for i, ip in
+                     (("r", "10.1.0.1"), ("x", "10.1.0.2"), ("y", "10.1.0.3"))],
+        "magistrals": [link("r", "x"), link("x", "y")],
+    }
+    topology.update_map("ring.json", SimpleNamespace(version=1, data=ring))
+    topology.update_map("tree.json", SimpleNamespace(version=1, data=tree))
+    topology.rebuild()
+    return topology
+
+
+def test_ring_without_root_is_not_cut_off():
+    topology = build()
+    for node in ("10.0.0.1", "10.0.0.3"):
+        above, below, cut = topology.blast_radius(node)
+        assert "10.0.0.4" in below
+        assert cut == set()
+
+
+def test_ring_branch_is_cut_behind_its_parent():
+    topology = build()
+    assert topology.blast_radius("10.0.0.2")[2] == {"10.0.0.4"}
+
+
+def test_tree_blast_radius():
+    topology = build()
+    above, below, cut = topology.blast_radius("10.1.0.2")
+    assert above == {"10.1.0.1"}
+    assert below == cut == {"10.1.0.3"}
+
+
+def test_device_maps_are_listed_once():
+    topology = build()
+    repeated = {
+        "switches": [{"id": "s1", "name": "a", "ip": "10.0.0.1"}, {"id": "s2", "name": "a2", "ip": "10.0.0.1"}],
+        "plan_switches": [{"id": "p1", "name": "a3", "ip": "10.0.0.1"}],
+        "magistrals": [link("s1", "s2")],
+    }
+    topology.update_map("repeated.json", SimpleNamespace(version=1, data=repeated))
+    topology.rebuild()
+    assert topology.devices["10.0.0.1"]["maps"] == ["ring.json", "repeated.json"]